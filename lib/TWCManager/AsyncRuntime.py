@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import traceback
+from TWCManager.DaemonExecutor import DaemonExecutor
+from TWCManager.Protocol.SLIP import FrameReader
+
+
+logger = logging.getLogger("\u26FD Runtime")
+
+
+class AsyncRuntime:
+    # Runs the core of TWCManager on one asyncio event loop, in the main
+    # thread, when the runtime setting is "asyncio". This replaces a number
+    # of threads which spend most of their time waiting, which matters on
+    # small devices such as the Pi Zero:
+    #
+    #   * Each bus waits on its interface's file descriptor for data to
+    #     arrive, rather than polling it, and its heartbeats are timed by the
+    #     loop, rather than each bus having a thread of its own.
+    #   * The background tasks are handed to their pool's executor once they
+    #     are due by a coroutine (see TaskScheduler), rather than by a timer
+    #     thread and idle worker threads.
+    #   * The HTTP server accepts connections on the loop, rather than in a
+    #     thread of its own, and hands them to its pool of workers.
+    #   * The network traffic of the MQTT clients is handled on the loop,
+    #     rather than by a thread per client.
+    #
+    # Anything which blocks (the background tasks, HTTP requests, and
+    # interfaces without a file descriptor to wait on) is run in a pool of
+    # threads, so that it doesn't hold up the loop. The pools' threads are
+    # only started when they are needed.
+
+    # Most seconds to wait before connecting to an MQTT broker again
+    mqttReconnectDelayMax = 60
+
+    def __init__(self, master):
+        self.master = master
+        # The loop's default executor can't be replaced by one whose threads
+        # are daemon threads, so ours is passed to run_in_executor() instead
+        self.executor = DaemonExecutor(8, "Runtime")
+        self.loop = asyncio.new_event_loop()
+
+    def acceptRequest(self, server):
+        # Accept every connection which is waiting. This doesn't block, as the
+        # server hands each one to its workers, or refuses it if they are too
+        # busy.
+        while True:
+            try:
+                request, clientAddress = server.get_request()
+            except OSError:
+                return
+            if server.verify_request(request, clientAddress):
+                server.process_request(request, clientAddress)
+            else:
+                server.shutdown_request(request)
+
+    def attachMQTT(self, client):
+        # Handle the network traffic of an MQTT client, on which
+        # connect_async() has been called, on the loop instead of calling
+        # loop_start(). This, and the client's callbacks, may be called from
+        # any thread, so the loop is only changed from its own thread.
+        def onSocketOpen(client, userdata, sock):
+            self.loop.call_soon_threadsafe(
+                self.loop.add_reader, sock.fileno(), client.loop_read
+            )
+
+        def onSocketClose(client, userdata, sock):
+            self.loop.call_soon_threadsafe(self.loop.remove_reader, sock.fileno())
+
+        def onSocketRegisterWrite(client, userdata, sock):
+            self.loop.call_soon_threadsafe(
+                self.loop.add_writer, sock.fileno(), client.loop_write
+            )
+
+        def onSocketUnregisterWrite(client, userdata, sock):
+            self.loop.call_soon_threadsafe(self.loop.remove_writer, sock.fileno())
+
+        client.on_socket_open = onSocketOpen
+        client.on_socket_close = onSocketClose
+        client.on_socket_register_write = onSocketRegisterWrite
+        client.on_socket_unregister_write = onSocketUnregisterWrite
+        asyncio.run_coroutine_threadsafe(self.runMQTT(client), self.loop)
+
+    def join(self):
+        # Run the loop until every background task which is due has finished
+        self.loop.run_until_complete(
+            self.loop.run_in_executor(self.executor, self.master.backgroundTasks.join)
+        )
+
+    def run(self, taskHandler, handlers, periodic, interval=0.1):
+        # Start the background tasks and buses, and call periodic() every
+        # interval seconds, until we are interrupted
+        asyncio.set_event_loop(self.loop)
+        self.master.backgroundTasks.startAsync(taskHandler, self.loop)
+        self.master.startBuses(handlers)
+        self.loop.create_task(self.runPeriodic(periodic, interval))
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+
+    async def runBus(self, bus):
+        # The asyncio version of TWCBus.run()
+        while True:
+            try:
+                if bus.pendingFrames:
+                    bus.handleNextFrame()
+                    # Let anything else which is waiting run between messages
+                    await asyncio.sleep(0)
+                    continue
+
+                wait = bus.sendMessages()
+                fileno = bus.interface.getFileno()
+                if fileno is None:
+                    # We can't wait for this interface on the loop, so wait
+                    # for it in the executor instead
+                    if wait is not None and wait < bus.interface.readTimeout:
+                        await asyncio.sleep(max(wait, 0))
+                        continue
+                    bus.addFrames(
+                        await self.loop.run_in_executor(
+                            self.executor, bus.interface.getFrames
+                        )
+                    )
+                else:
+                    # Wake at least every msgTimeout seconds, even if we have
+                    # nothing to send, so that a partial message is dropped
+                    timeout = FrameReader.msgTimeout
+                    if wait is not None:
+                        timeout = min(max(wait, 0), timeout)
+                    if await self.waitReadable(fileno, timeout):
+                        bus.addFrames(bus.interface.getFrames())
+                    elif timeout >= bus.interface.readTimeout:
+                        # Nothing arrived. As TWCBus.poll() does, let the
+                        # interface drop a partial message which has timed
+                        # out. This may wait for up to readTimeout, so it is
+                        # done in the executor.
+                        bus.addFrames(
+                            await self.loop.run_in_executor(
+                                self.executor, bus.interface.getFrames
+                            )
+                        )
+            except Exception:
+                traceback.print_exc()
+                logger.info("Unhandled Exception:" + traceback.format_exc())
+                await asyncio.sleep(5)
+
+    async def runMQTT(self, client):
+        # Connect the client, and keep it connected, as loop_start() would
+        from paho.mqtt.client import MQTT_ERR_SUCCESS
+
+        delay = 1
+        while True:
+            try:
+                await self.loop.run_in_executor(self.executor, client.reconnect)
+                delay = 1
+                while client.loop_misc() == MQTT_ERR_SUCCESS:
+                    await asyncio.sleep(1)
+            except Exception as e:
+                logger.log(logging.INFO4, "Error connecting to MQTT Broker")
+                logger.debug(str(e))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.mqttReconnectDelayMax)
+
+    async def runPeriodic(self, callback, interval):
+        while True:
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+                logger.info("Unhandled Exception:" + traceback.format_exc())
+            await asyncio.sleep(interval)
+
+    def serve(self, server):
+        # Accept connections to server on the loop. The server handles them
+        # in its own pool of workers (see PooledHTTPServer)
+        server.socket.setblocking(False)
+        self.loop.add_reader(server.fileno(), self.acceptRequest, server)
+
+    def startBus(self, bus):
+        self.loop.create_task(self.runBus(bus))
+
+    async def waitReadable(self, fileno, timeout):
+        # Returns True once there is data waiting to be read from fileno, or
+        # False if timeout seconds pass first. A timeout of None waits for as
+        # long as it takes.
+        readable = self.loop.create_future()
+        self.loop.add_reader(
+            fileno, lambda: readable.done() or readable.set_result(True)
+        )
+        try:
+            await asyncio.wait_for(readable, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.loop.remove_reader(fileno)
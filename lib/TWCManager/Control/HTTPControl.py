@@ -1,13 +1,12 @@
 import jinja2
 import json
 import logging
-import math
 import mimetypes
 import os
 import pathlib
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from socketserver import ThreadingMixIn
 from datetime import datetime, timedelta
+import io
 import re
 import subprocess
 import sys
@@ -15,12 +14,370 @@ import threading
 import time
 import urllib.parse
 import uuid
+from TWCManager.DaemonExecutor import DaemonExecutor
 
 logger = logging.getLogger("\U0001F3AE HTTP")
 
 
-class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+class PooledHTTPServer(HTTPServer):
+    # Handles connections in a fixed size pool of worker threads, rather than
+    # starting a thread for each one, so that however often the web interface
+    # and API are polled, they can't take more than their share of the CPU
+    # from the TWC buses.
+    #
+    # Connections are kept open between requests (HTTP/1.1 keep-alive), and
+    # wait for a worker when they are all busy. Once queueSize connections are
+    # waiting, any more are refused with 503 Service Unavailable until the
+    # workers catch up. While connections are waiting, a worker closes its
+    # connection after each response, so that idle keep-alive connections
+    # don't hold up the ones waiting.
+    #
+    # Clients of /api/streamStatus stay connected for as long as the web
+    # interface is open, so those connections are handed over from the pool
+    # to a thread of their own, up to maxStreams of them at once.
+
+    def __init__(self, address, handler, workers=4, queueSize=16, maxStreams=8):
+        # Let a browser's burst of connections wait to be accepted, rather
+        # than being refused
+        self.request_queue_size = max(int(queueSize), 5)
+        HTTPServer.__init__(self, address, handler)
+        self.active = 0
+        self.detached = set()
+        self.executor = DaemonExecutor(workers, "HTTP")
+        self.lock = threading.Lock()
+        self.maxStreams = maxStreams
+        self.queueSize = queueSize
+        self.rejected = 0
+        self.streams = 0
+        self.workers = max(int(workers), 1)
+
+    def detachRequest(self, request, target):
+        # Call target() in a thread of its own, which closes request when it
+        # returns, rather than the worker closing it once the handler returns.
+        # Returns False if there are already maxStreams detached requests.
+        with self.lock:
+            if self.streams >= self.maxStreams:
+                return False
+            self.streams += 1
+            self.detached.add(request)
+        threading.Thread(
+            target=self.runDetached,
+            args=(request, target),
+            name="HTTP-Stream",
+            daemon=True,
+        ).start()
+        return True
+
+    def isBusy(self):
+        # Returns True if there are connections waiting for a worker
+        return self.active > self.workers
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            full = self.active >= self.workers + self.queueSize
+            if full:
+                self.rejected += 1
+            else:
+                self.active += 1
+        if full:
+            self.rejectRequest(request)
+        else:
+            self.executor.submit(self.processRequestWorker, request, client_address)
+
+    def processRequestWorker(self, request, client_address):
+        # The connection may have been accepted from a non-blocking socket
+        request.setblocking(True)
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            with self.lock:
+                detached = request in self.detached
+                self.detached.discard(request)
+                self.active -= 1
+            if not detached:
+                self.shutdown_request(request)
+
+    def rejectRequest(self, request):
+        # Sent without reading the request, so that a flood of requests costs
+        # us as little as possible
+        try:
+            request.sendall(
+                b"HTTP/1.1 503 Service Unavailable\r\n"
+                b"Retry-After: 1\r\n"
+                b"Content-Length: 0\r\n"
+                b"Connection: close\r\n\r\n"
+            )
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def runDetached(self, request, target):
+        try:
+            target()
+        finally:
+            self.shutdown_request(request)
+            with self.lock:
+                self.streams -= 1
+
+
+# Building a jinja2 environment is expensive, and each environment keeps its
+# own cache of compiled templates. We keep a single environment for the
+# current theme and only build a new one when webControlTheme changes.
+templateEnv = None
+templateEnvLock = threading.Lock()
+templateEnvTheme = None
+
+
+def getTemplateEnv(master, handler):
+    global templateEnv, templateEnvTheme
+
+    theme = master.settings.get("webControlTheme", "Modern")
+    with templateEnvLock:
+        if templateEnv and templateEnvTheme == theme:
+            return templateEnv
+
+        # Note that we specify two paths in order to the template loader.
+        # The first is the user specified template. The second is the default.
+        # Jinja2 will try for the specified template first, however if any files
+        # are not found, it will fall back to the default theme.
+        themePath = pathlib.Path(__file__).resolve().parent.as_posix() + "/themes/"
+        templateLoader = jinja2.FileSystemLoader(
+            searchpath=[themePath + theme + "/", themePath + "Default/"]
+        )
+
+        # Compiled templates can optionally be cached on disk, so that they
+        # don't need to be compiled again after a restart.
+        bytecodeCache = None
+        cachePath = (
+            master.config.get("control", {})
+            .get("HTTP", {})
+            .get("templateCachePath", None)
+        )
+        if cachePath:
+            try:
+                os.makedirs(cachePath, exist_ok=True)
+                bytecodeCache = jinja2.FileSystemBytecodeCache(cachePath)
+            except OSError as e:
+                logger.error("Unable to use template cache path: " + str(e))
+
+        env = jinja2.Environment(
+            loader=templateLoader, autoescape=True, bytecode_cache=bytecodeCache
+        )
+
+        # Make certain functions available to jinja2
+        # Where we have helper functions that we've used in the fast to
+        # render HTML, we can keep using those even inside jinja2.
+        # Only values which are the same for every request belong here. Helpers
+        # which are bound to a request are passed in HTTPControlHandler.templateVars()
+        env.globals.update(ampsList=handler.ampsList)
+        env.globals.update(
+            apiChallenge=master.getModuleByName("TeslaAPI").getApiChallenge
+        )
+        env.globals.update(checkForUpdates=master.checkForUpdates)
+        env.globals.update(hoursDurationList=handler.hoursDurationList)
+        env.globals.update(timeList=handler.timeList)
+        env.globals.update(
+            vehicles=master.getModuleByName("TeslaAPI").getCarApiVehicles
+        )
+
+        templateEnv = env
+        templateEnvTheme = theme
+        return templateEnv
+
+
+def getSlaveTWCStatus(master):
+    # Returns the status of each slave TWC, and the totals of all of them, as
+    # returned by /api/getSlaveTWCs
+    data = {}
+    totals = {
+        "lastAmpsOffered": 0,
+        "lifetimekWh": 0,
+        "maxAmps": 0,
+        "reportedAmpsActual": 0,
+    }
+    for slaveTWC in master.getSlaveTWCs():
+        TWCID = "%02X%02X" % (slaveTWC.TWCID[0], slaveTWC.TWCID[1])
+        data[TWCID] = {
+            "bus": slaveTWC.bus.index if slaveTWC.bus else 0,
+            "currentVIN": slaveTWC.currentVIN,
+            "lastAmpsOffered": round(slaveTWC.lastAmpsOffered, 2),
+            "lastHeartbeat": round(time.time() - slaveTWC.timeLastRx, 2),
+            "carsCharging": slaveTWC.isCharging,
+            "lastVIN": slaveTWC.lastVIN,
+            "lifetimekWh": slaveTWC.lifetimekWh,
+            "maxAmps": float(slaveTWC.maxAmps),
+            "reportedAmpsActual": float(slaveTWC.reportedAmpsActual),
+            "chargerLoadInW": round(slaveTWC.getCurrentChargerLoad()),
+            "state": slaveTWC.reportedState,
+            "version": slaveTWC.protocolVersion,
+            "voltsPhaseA": slaveTWC.voltsPhaseA,
+            "voltsPhaseB": slaveTWC.voltsPhaseB,
+            "voltsPhaseC": slaveTWC.voltsPhaseC,
+            "TWCID": "%s" % TWCID,
+        }
+
+        if slaveTWC.lastChargingStart > 0:
+            data[TWCID]["chargeTime"] = str(
+                timedelta(seconds=(time.time() - slaveTWC.lastChargingStart))
+            ).split(".")[0]
+        else:
+            data[TWCID]["chargeTime"] = "--:--:--"
+
+        # Adding some vehicle data
+        vehicle = slaveTWC.getLastVehicle()
+        if vehicle != None:
+            data[TWCID]["lastBatterySOC"] = vehicle.batteryLevel
+            data[TWCID]["lastChargeLimit"] = vehicle.chargeLimit
+            data[TWCID]["lastAtHome"] = vehicle.atHome
+            data[TWCID]["lastTimeToFullCharge"] = vehicle.timeToFullCharge
+
+        totals["lastAmpsOffered"] += slaveTWC.lastAmpsOffered
+        totals["lifetimekWh"] += slaveTWC.lifetimekWh
+        totals["maxAmps"] += slaveTWC.maxAmps
+        totals["reportedAmpsActual"] += slaveTWC.reportedAmpsActual
+
+    data["total"] = {
+        "lastAmpsOffered": round(totals["lastAmpsOffered"], 2),
+        "lifetimekWh": totals["lifetimekWh"],
+        "maxAmps": totals["maxAmps"],
+        "reportedAmpsActual": round(totals["reportedAmpsActual"], 2),
+        "TWCID": "total",
+    }
+    return data
+
+
+def diffStatus(old, new):
+    # Returns the values in new which differ from those in old. Nested dicts
+    # are compared key by key, so that only their changed keys are included.
+    # Keys which have been removed are returned with a value of None.
+    if old is None:
+        return new
+    changes = {}
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(old.get(key, None), dict):
+            nested = diffStatus(old[key], value)
+            if nested:
+                changes[key] = nested
+        elif key not in old or old[key] != value:
+            changes[key] = value
+    for key in old:
+        if key not in new:
+            changes[key] = None
+    return changes
+
+
+def mergeStatus(status, changes):
+    # Applies changes returned by diffStatus() to status. Nested dicts are
+    # copied before they are updated, as they may be shared with a snapshot.
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(status.get(key, None), dict):
+            status[key] = mergeStatus(dict(status[key]), value)
+        else:
+            status[key] = value
+    return status
+
+
+class StatusStreamClient:
+    # Changes waiting to be sent to one client of /api/streamStatus. Changes
+    # pushed while the client is still sending earlier ones are merged, so a
+    # slow client receives the latest values rather than a growing backlog.
+
+    def __init__(self):
+        self.changes = {}
+        self.ready = threading.Condition()
+
+    def get(self, timeout):
+        with self.ready:
+            if not self.changes:
+                self.ready.wait(timeout)
+            changes = self.changes
+            self.changes = {}
+        return changes
+
+    def push(self, changes):
+        with self.ready:
+            mergeStatus(self.changes, changes)
+            self.ready.notify()
+
+
+class StatusStream:
+    # Pushes the live status shown by the web interface to clients of
+    # /api/streamStatus. A single thread builds the status when the master
+    # reports a change, compares it to the last one and sends each client
+    # only the values which changed, so the work done doesn't grow with the
+    # number of dashboards open. The thread only runs while clients are
+    # connected.
+
+    # Changes which arrive within minInterval seconds of each other are sent
+    # together
+    minInterval = 1
+
+    # Some values, such as the time since the last heartbeat, change without
+    # the master being notified, so we also refresh every refreshInterval
+    # seconds
+    refreshInterval = 10
+
+    def __init__(self, master):
+        self.master = master
+        self.clients = []
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.thread = None
+
+    def getSnapshot(self):
+        return {
+            "status": self.master.getStatus(),
+            "slaveTWCs": getSlaveTWCStatus(self.master),
+            "activePolicyAction": self.master.getModuleByName(
+                "Policy"
+            ).getActivePolicyAction(),
+        }
+
+    def run(self, version):
+        while True:
+            version = self.master.waitStatusChanged(version, self.refreshInterval)
+            with self.lock:
+                if not self.clients:
+                    self.snapshot = None
+                    self.thread = None
+                    return
+
+            try:
+                snapshot = self.getSnapshot()
+            except Exception as e:
+                logger.error("Unable to build status for stream: " + str(e))
+                time.sleep(self.minInterval)
+                continue
+
+            with self.lock:
+                changes = diffStatus(self.snapshot, snapshot)
+                self.snapshot = snapshot
+                if changes:
+                    for client in self.clients:
+                        client.push(changes)
+
+            time.sleep(self.minInterval)
+
+    def subscribe(self):
+        # Returns a new client, which starts with the full status
+        client = StatusStreamClient()
+        with self.lock:
+            if not self.thread:
+                version = self.master.getStatusVersion()
+                self.snapshot = self.getSnapshot()
+                self.thread = threading.Thread(
+                    target=self.run, args=(version,), daemon=True
+                )
+                self.thread.start()
+            client.push(self.snapshot)
+            self.clients.append(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.remove(client)
 
 
 class HTTPControl:
@@ -51,29 +408,49 @@ class HTTPControl:
         HTTPHandler = CreateHTTPHandlerClass(master)
         httpd = None
         try:
-            httpd = ThreadingSimpleServer(("", self.httpPort), HTTPHandler)
+            httpd = PooledHTTPServer(
+                ("", self.httpPort),
+                HTTPHandler,
+                workers=self.configHTTP.get("workers", 4),
+                queueSize=self.configHTTP.get("queueSize", 16),
+                maxStreams=self.configHTTP.get("maxStreams", 8),
+            )
         except OSError as e:
             logger.error("Unable to start HTTP Server: " + str(e))
 
         if httpd:
             logger.info("Serving at port: " + str(self.httpPort))
-            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            if self.master.asyncRuntime:
+                self.master.asyncRuntime.serve(httpd)
+            else:
+                threading.Thread(target=httpd.serve_forever, daemon=True).start()
         else:
             self.master.releaseModule("lib.TWCManager.Control", self.__class__.__name__)
 
 
 def CreateHTTPHandlerClass(master):
+    statusStream = StatusStream(master)
+    keepAliveTimeout = (
+        master.config.get("control", {}).get("HTTP", {}).get("keepAliveTimeout", 5)
+    )
+
     class HTTPControlHandler(BaseHTTPRequestHandler):
         ampsList = []
+        buffering = False
         fields = {}
+        headerNames = set()
         host = None
         hoursDurationList = []
         master = None
         path = ""
         post_data = ""
+        # Keep connections open between requests. A connection which is idle
+        # for keepAliveTimeout seconds is closed, to free its worker.
+        protocol_version = "HTTP/1.1"
+        responseCode = None
         templateEnv = None
-        templateLoader = None
         timeList = []
+        timeout = keepAliveTimeout
         url = None
 
         def __init__(self, *args, **kwargs):
@@ -111,45 +488,9 @@ def CreateHTTPHandlerClass(master):
                             [strHour + ":" + strMins, strHour + ":" + strMins]
                         )
 
-            # Define jinja2 template environment
-            # Note that we specify two paths in order to the template loader.
-            # The first is the user specified template. The second is the default.
-            # Jinja2 will try for the specified template first, however if any files
-            # are not found, it will fall back to the default theme.
-            self.templateLoader = jinja2.FileSystemLoader(
-                searchpath=[
-                    pathlib.Path(__file__).resolve().parent.as_posix()
-                    + "/themes/"
-                    + master.settings.get("webControlTheme", "Modern")
-                    + "/",
-                    pathlib.Path(__file__).resolve().parent.as_posix()
-                    + "/themes/Default/",
-                ]
-            )
-            self.templateEnv = jinja2.Environment(
-                loader=self.templateLoader, autoescape=True
-            )
-
-            # Make certain functions available to jinja2
-            # Where we have helper functions that we've used in the fast to
-            # render HTML, we can keep using those even inside jinja2
-            self.templateEnv.globals.update(addButton=self.addButton)
-            self.templateEnv.globals.update(ampsList=self.ampsList)
-            self.templateEnv.globals.update(
-                apiChallenge=master.getModuleByName("TeslaAPI").getApiChallenge
-            )
-            self.templateEnv.globals.update(chargeScheduleDay=self.chargeScheduleDay)
-            self.templateEnv.globals.update(checkBox=self.checkBox)
-            self.templateEnv.globals.update(checkForUpdates=master.checkForUpdates)
-            self.templateEnv.globals.update(doChargeSchedule=self.do_chargeSchedule)
-            self.templateEnv.globals.update(host=self.host)
-            self.templateEnv.globals.update(hoursDurationList=self.hoursDurationList)
-            self.templateEnv.globals.update(navbarItem=self.navbar_item)
-            self.templateEnv.globals.update(optionList=self.optionList)
-            self.templateEnv.globals.update(timeList=self.timeList)
-            self.templateEnv.globals.update(
-                vehicles=master.getModuleByName("TeslaAPI").getCarApiVehicles
-            )
+            # The jinja2 template environment is shared by all requests, so that
+            # templates are only loaded and compiled once. See getTemplateEnv()
+            self.templateEnv = getTemplateEnv(master, self)
 
             # Set master object
             self.master = master
@@ -157,6 +498,84 @@ def CreateHTTPHandlerClass(master):
             # Call parent constructor last, this is where the request is served
             BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
 
+        def end_headers(self):
+            # While the response is buffered, the headers are sent along with
+            # the body by sendBufferedResponse()
+            if not self.buffering:
+                BaseHTTPRequestHandler.end_headers(self)
+
+        def handle_one_request(self):
+            # Each response is written to a buffer and sent once it is
+            # complete, so that we can tell the client its Content-Length,
+            # which it needs to find the end of the response on a connection
+            # which is kept open
+            self.buffering = True
+            self.connectionWfile = self.wfile
+            self.headerNames = set()
+            self.responseCode = None
+            self.wfile = io.BytesIO()
+            try:
+                BaseHTTPRequestHandler.handle_one_request(self)
+            except Exception:
+                # Don't send a partial response
+                self.buffering = False
+                self.close_connection = True
+                self.wfile = self.connectionWfile
+                raise
+            self.sendBufferedResponse()
+
+            if self.server.isBusy():
+                self.close_connection = True
+
+        def send_header(self, keyword, value):
+            self.headerNames.add(keyword.lower())
+            BaseHTTPRequestHandler.send_header(self, keyword, value)
+
+        def send_response(self, code, message=None):
+            self.responseCode = code
+            BaseHTTPRequestHandler.send_response(self, code, message)
+
+        def sendBufferedResponse(self):
+            # Send the buffered response, adding its Content-Length and ending
+            # the headers if the handler didn't
+            if not self.buffering:
+                return
+            self.buffering = False
+            body = self.wfile.getvalue()
+            self.wfile = self.connectionWfile
+
+            if self.responseCode is None:
+                # Nothing was sent for this request, so the client won't be
+                # expecting anything more on this connection
+                self.close_connection = True
+                return
+
+            if "content-length" not in self.headerNames and self.responseCode not in (
+                204,
+                304,
+            ):
+                self.send_header("Content-Length", str(len(body)))
+            BaseHTTPRequestHandler.end_headers(self)
+            if body:
+                self.wfile.write(body)
+            self.wfile.flush()
+
+        def templateVars(self):
+            # Helper functions which belong to this request are passed to the
+            # templates along with the request's attributes, as the template
+            # environment is shared between requests.
+            tvars = {
+                "addButton": self.addButton,
+                "chargeScheduleDay": self.chargeScheduleDay,
+                "checkBox": self.checkBox,
+                "doChargeSchedule": self.do_chargeSchedule,
+                "host": self.host,
+                "navbarItem": self.navbar_item,
+                "optionList": self.optionList,
+            }
+            tvars.update(vars(self))
+            return tvars
+
         def checkBox(self, name, value):
             cb = "<input type=checkbox name='" + name + "'"
             if value:
@@ -259,6 +678,31 @@ def CreateHTTPHandlerClass(master):
 
                 self.wfile.write(str(master.lastTWCResponseMsg).encode("utf-8"))
 
+            elif self.url.path == "/api/getHeartbeatStats":
+                # How many heartbeats were sent to each slave TWC, how many
+                # missed their deadline and how late they were sent
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+
+                json_data = json.dumps(master.getHeartbeatStats())
+                self.wfile.write(json_data.encode("utf-8"))
+
+            elif self.url.path == "/api/getLoggingStats":
+                # Queue depth and write latency of the Logging modules which
+                # write their records from a separate thread
+                data = {}
+                for module in master.getModulesByType("Logging"):
+                    if hasattr(module["ref"], "getQueueStats"):
+                        data[module["name"]] = module["ref"].getQueueStats()
+
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+
+                json_data = json.dumps(data)
+                self.wfile.write(json_data.encode("utf-8"))
+
             elif self.url.path == "/api/getPolicy":
                 self.send_response(200)
                 self.send_header("Content-type", "application/json")
@@ -267,63 +711,56 @@ def CreateHTTPHandlerClass(master):
                 json_data = json.dumps(master.getModuleByName("Policy").charge_policy)
                 self.wfile.write(json_data.encode("utf-8"))
 
-            elif self.url.path == "/api/getSlaveTWCs":
+            elif self.url.path == "/api/getSettingsStats":
+                # How many requests to save the settings file were combined
+                # with another request or skipped as nothing had changed
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+
+                json_data = json.dumps(master.settingsSaveStats)
+                self.wfile.write(json_data.encode("utf-8"))
+
+            elif self.url.path == "/api/getTaskStats":
+                # Queue depth of each background task pool, and how long each
+                # kind of task waited to start and took to run
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+
+                json_data = json.dumps(master.getBackgroundTaskStats())
+                self.wfile.write(json_data.encode("utf-8"))
+
+            elif self.url.path == "/api/getVehicleCommandStats":
+                # How long the commands sent to vehicles over BLE and over
+                # the Tesla API took
                 data = {}
-                totals = {
-                    "lastAmpsOffered": 0,
-                    "lifetimekWh": 0,
-                    "maxAmps": 0,
-                    "reportedAmpsActual": 0,
-                }
-                for slaveTWC in master.getSlaveTWCs():
-                    TWCID = "%02X%02X" % (slaveTWC.TWCID[0], slaveTWC.TWCID[1])
-                    data[TWCID] = {
-                        "currentVIN": slaveTWC.currentVIN,
-                        "lastAmpsOffered": round(slaveTWC.lastAmpsOffered, 2),
-                        "lastHeartbeat": round(time.time() - slaveTWC.timeLastRx, 2),
-                        "carsCharging": slaveTWC.isCharging,
-                        "lastVIN": slaveTWC.lastVIN,
-                        "lifetimekWh": slaveTWC.lifetimekWh,
-                        "maxAmps": float(slaveTWC.maxAmps),
-                        "reportedAmpsActual": float(slaveTWC.reportedAmpsActual),
-                        "chargerLoadInW": round(slaveTWC.getCurrentChargerLoad()),
-                        "state": slaveTWC.reportedState,
-                        "version": slaveTWC.protocolVersion,
-                        "voltsPhaseA": slaveTWC.voltsPhaseA,
-                        "voltsPhaseB": slaveTWC.voltsPhaseB,
-                        "voltsPhaseC": slaveTWC.voltsPhaseC,
-                        "TWCID": "%s" % TWCID,
-                    }
+                for name in ("TeslaAPI", "TeslaBLE"):
+                    module = master.getModuleByName(name)
+                    if module:
+                        data[name] = module.getCommandStats()
 
-                    if slaveTWC.lastChargingStart > 0:
-                        data[TWCID]["chargeTime"] = str(
-                            timedelta(
-                                seconds=(time.time() - slaveTWC.lastChargingStart)
-                            )
-                        ).split(".")[0]
-                    else:
-                        data[TWCID]["chargeTime"] = "--:--:--"
-
-                    # Adding some vehicle data
-                    vehicle = slaveTWC.getLastVehicle()
-                    if vehicle != None:
-                        data[TWCID]["lastBatterySOC"] = vehicle.batteryLevel
-                        data[TWCID]["lastChargeLimit"] = vehicle.chargeLimit
-                        data[TWCID]["lastAtHome"] = vehicle.atHome
-                        data[TWCID]["lastTimeToFullCharge"] = vehicle.timeToFullCharge
-
-                    totals["lastAmpsOffered"] += slaveTWC.lastAmpsOffered
-                    totals["lifetimekWh"] += slaveTWC.lifetimekWh
-                    totals["maxAmps"] += slaveTWC.maxAmps
-                    totals["reportedAmpsActual"] += slaveTWC.reportedAmpsActual
-
-                data["total"] = {
-                    "lastAmpsOffered": round(totals["lastAmpsOffered"], 2),
-                    "lifetimekWh": totals["lifetimekWh"],
-                    "maxAmps": totals["maxAmps"],
-                    "reportedAmpsActual": round(totals["reportedAmpsActual"], 2),
-                    "TWCID": "total",
-                }
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+
+                json_data = json.dumps(data)
+                self.wfile.write(json_data.encode("utf-8"))
+
+            elif self.url.path == "/api/getSlaveTWCs":
+                data = getSlaveTWCStatus(master)
+
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+
+                json_data = json.dumps(data)
+                self.wfile.write(json_data.encode("utf-8"))
+
+            elif self.url.path == "/api/getSolarDay":
+                # Times of sunrise, solar noon and sunset at home today, and
+                # the elevation of the sun through the day
+                data = master.getSolarDay(curve=True)
 
                 self.send_response(200)
                 self.send_header("Content-type", "application/json")
@@ -344,6 +781,9 @@ def CreateHTTPHandlerClass(master):
                 except BrokenPipeError:
                     self.debugLogAPI("Connection Error: Broken Pipe")
 
+            elif self.url.path == "/api/streamStatus":
+                self.do_streamStatus()
+
             elif self.url.path == "/api/getActivePolicyAction":
                 data = master.getModuleByName("Policy").getActivePolicyAction()
                 self.send_response(200)
@@ -357,39 +797,26 @@ def CreateHTTPHandlerClass(master):
                     self.debugLogAPI("Connection Error: Broken Pipe")
 
             elif self.url.path == "/api/getHistory":
-                output = []
-                now = datetime.now().replace(second=0, microsecond=0).astimezone()
-                startTime = now - timedelta(days=2) + timedelta(minutes=5)
-                endTime = now.replace(minute=math.floor(now.minute / 5) * 5)
-                startTime = startTime.replace(
-                    minute=math.floor(startTime.minute / 5) * 5
-                )
-
-                source = (
-                    master.settings["history"] if "history" in master.settings else []
-                )
-                data = {
-                    k: v for k, v in source if datetime.fromisoformat(k) >= startTime
-                }
+                # The charger power for each 5 minute period of the last two
+                # days, the last of which is the period in progress
+                interval = master.history.interval
+                endTime = int(time.time() // interval) * interval
+                startTime = endTime - (48 * 12 - 1) * interval
+                values = master.history.getRange(startTime, endTime)
 
                 avgCurrent = 0
                 for slave in master.getSlaveTWCs():
                     avgCurrent += slave.historyAvgAmps
-                data[endTime.isoformat(timespec="seconds")] = master.convertAmpsToWatts(
-                    avgCurrent
-                )
+                values[-1] = master.convertAmpsToWatts(avgCurrent)
 
                 output = [
                     {
-                        "timestamp": timestamp,
-                        "charger_power": data[timestamp] if timestamp in data else 0,
+                        "timestamp": datetime.fromtimestamp(startTime + (i * interval))
+                        .astimezone()
+                        .isoformat(timespec="seconds"),
+                        "charger_power": value,
                     }
-                    for timestamp in [
-                        (startTime + timedelta(minutes=5 * i)).isoformat(
-                            timespec="seconds"
-                        )
-                        for i in range(48 * 12)
-                    ]
+                    for i, value in enumerate(values)
                 ]
 
                 self.send_response(200)
@@ -425,10 +852,12 @@ def CreateHTTPHandlerClass(master):
                     self.send_response(400)
                     self.end_headers()
                     self.wfile.write("".encode("utf-8"))
+                    return
                 except json.decoder.JSONDecodeError:
                     self.send_response(400)
                     self.end_headers()
                     self.wfile.write("".encode("utf-8"))
+                    return
                 name = str(data.get("offsetName", None))
                 value = float(data.get("offsetValue", 0))
                 unit = str(data.get("offsetUnit", ""))
@@ -440,11 +869,12 @@ def CreateHTTPHandlerClass(master):
                     and len(name) < 32
                     and not self.checkForUnsafeCharactters(name)
                 ):
-                    if not master.settings.get("consumptionOffset", None):
-                        master.settings["consumptionOffset"] = {}
-                    master.settings["consumptionOffset"][name] = {}
-                    master.settings["consumptionOffset"][name]["value"] = value
-                    master.settings["consumptionOffset"][name]["unit"] = unit
+                    with master.settingsLock:
+                        if not master.settings.get("consumptionOffset", None):
+                            master.settings["consumptionOffset"] = {}
+                        master.settings["consumptionOffset"][name] = {}
+                        master.settings["consumptionOffset"][name]["value"] = value
+                        master.settings["consumptionOffset"][name]["unit"] = unit
                     master.queue_background_task({"cmd": "saveSettings"})
 
                     self.send_response(204)
@@ -464,10 +894,12 @@ def CreateHTTPHandlerClass(master):
                     self.send_response(400)
                     self.end_headers()
                     self.wfile.write("".encode("utf-8"))
+                    return
                 except json.decoder.JSONDecodeError:
                     self.send_response(400)
                     self.end_headers()
                     self.wfile.write("".encode("utf-8"))
+                    return
                 rate = int(data.get("chargeNowRate", 0))
                 durn = int(data.get("chargeNowDuration", 0))
 
@@ -509,9 +941,12 @@ def CreateHTTPHandlerClass(master):
                 data = json.loads(self.post_data.decode("UTF-8"))
                 name = str(data.get("offsetName", None))
 
-                if master.settings.get("consumptionOffset", None):
-                    del master.settings["consumptionOffset"][name]
+                with master.settingsLock:
+                    offsets = master.settings.get("consumptionOffset", None)
+                    if offsets:
+                        del offsets[name]
 
+                if offsets:
                     self.send_response(204)
                     self.end_headers()
                     self.wfile.write("".encode("utf-8"))
@@ -535,10 +970,10 @@ def CreateHTTPHandlerClass(master):
                 # Clear last TWC response, so we can grab the next response
                 master.lastTWCResponseMsg = bytearray()
 
-                # Send packet to network
-                master.getModuleByName("RS485").send(
-                    master.getModuleByName("TWCProtocol").createMessage(packet)
-                )
+                # Send packet to network, unless it was blocked
+                msg = master.getModuleByName("TWCProtocol").createMessage(packet)
+                if msg:
+                    master.sendMessage(msg)
 
                 self.send_response(204)
                 self.end_headers()
@@ -642,6 +1077,47 @@ def CreateHTTPHandlerClass(master):
 
             self.debugLogAPI("Ending API POST")
 
+        def do_streamStatus(self):
+            # Sends the full status followed by changes to it as server-sent
+            # events, until the client disconnects. A comment is sent if
+            # nothing has changed for a while, which lets us notice clients
+            # which have gone away.
+            #
+            # The stream doesn't end, so it has no Content-Length, and the
+            # connection is closed when the client disconnects. It is handed
+            # over to a thread of its own, so that it doesn't hold a worker.
+            if self.server.streams >= self.server.maxStreams:
+                self.send_error(503, "Too many status streams")
+                return
+
+            # Stop buffering, so that the headers are sent as they are
+            self.sendBufferedResponse()
+            self.send_response(200)
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+
+            client = statusStream.subscribe()
+            if not self.server.detachRequest(
+                self.request, lambda: self.streamStatus(client)
+            ):
+                statusStream.unsubscribe(client)
+
+        def streamStatus(self, client):
+            try:
+                while True:
+                    changes = client.get(30)
+                    if changes:
+                        event = "data: " + json.dumps(changes) + "\n\n"
+                    else:
+                        event = ": keepalive\n\n"
+                    self.request.sendall(event.encode("utf-8"))
+            except OSError:
+                self.debugLogAPI("Status stream client disconnected")
+            finally:
+                statusStream.unsubscribe(client)
+
         def do_get_policy(self):
             page = """
       <table>
@@ -774,7 +1250,7 @@ def CreateHTTPHandlerClass(master):
                 ).getActivePolicyAction()
 
                 # Send the html message
-                page = self.template.render(vars(self))
+                page = self.template.render(self.templateVars())
 
                 self.wfile.write(page.encode("utf-8"))
                 return
@@ -812,7 +1288,7 @@ def CreateHTTPHandlerClass(master):
 
                 # Load debug template and render
                 self.template = self.templateEnv.get_template(route["tmpl"])
-                page = self.template.render(self.__dict__)
+                page = self.template.render(self.templateVars())
 
                 self.wfile.write(page.encode("utf-8"))
                 return
@@ -824,7 +1300,7 @@ def CreateHTTPHandlerClass(master):
 
                 # Load policy template and render
                 self.template = self.templateEnv.get_template("policy.html.j2")
-                page = self.template.render(self.__dict__)
+                page = self.template.render(self.templateVars())
 
                 page += self.do_get_policy()
                 self.wfile.write(page.encode("utf-8"))
@@ -838,7 +1314,7 @@ def CreateHTTPHandlerClass(master):
                 self.end_headers()
 
                 self.template = self.templateEnv.get_template("upgrade.html.j2")
-                page = self.template.render(self.__dict__)
+                page = self.template.render(self.templateVars())
 
                 try:
                     page += subprocess.check_output(
@@ -894,7 +1370,7 @@ def CreateHTTPHandlerClass(master):
                 self.end_headers()
                 # Load debug template and render
                 self.template = self.templateEnv.get_template("graphs.html.j2")
-                page = self.template.render(self.__dict__)
+                page = self.template.render(self.templateVars())
                 self.wfile.write(page.encode("utf-8"))
                 return
 
@@ -1173,86 +1649,90 @@ def CreateHTTPHandlerClass(master):
             # Check that schedule dict exists within settings.
             # If not, this would indicate that this is the first time
             # we have saved the new schedule settings
-            if master.settings.get("Schedule", None) == None:
-                master.settings["Schedule"] = {}
-
-            # Slight issue with checkboxes, you have to default them all to
-            # false, otherwise if one is unticked it is just not sent via form data
-            days = [
-                "Sunday",
-                "Monday",
-                "Tuesday",
-                "Wednesday",
-                "Thursday",
-                "Friday",
-                "Saturday",
-            ]
-            for day in days:
-                if master.settings["Schedule"].get(day, None) == None:
-                    master.settings["Schedule"][day] = {}
-                master.settings["Schedule"][day]["enabled"] = ""
-                master.settings["Schedule"][day]["flex"] = ""
-
-            # Detect schedule keys. Rather than saving them in a flat
-            # structure, we'll store them multi-dimensionally
-            fieldsout = self.fields.copy()
-            ct = re.compile(
-                r"(?P<trigger>enabled|end|flex|start)(?P<day>.*?)ChargeTime"
-            )
-            for key in self.fields:
-                match = ct.match(key)
-                if match:
-                    # Detected a multi-dimensional (per-day) key
-                    # Rewrite it into the settings array and delete it
-                    # from the input
-
-                    if master.settings["Schedule"].get(match.group(2), None) == None:
-                        # Create dictionary key for this day
-                        master.settings["Schedule"][match.group(2)] = {}
-
-                    # Set per-day settings
-                    master.settings["Schedule"][match.group(2)][match.group(1)] = (
-                        self.getFieldValue(key)
-                    )
+            with master.settingsLock:
+                if master.settings.get("Schedule", None) == None:
+                    master.settings["Schedule"] = {}
+
+                # Slight issue with checkboxes, you have to default them all to
+                # false, otherwise if one is unticked it is just not sent via form data
+                days = [
+                    "Sunday",
+                    "Monday",
+                    "Tuesday",
+                    "Wednesday",
+                    "Thursday",
+                    "Friday",
+                    "Saturday",
+                ]
+                for day in days:
+                    if master.settings["Schedule"].get(day, None) == None:
+                        master.settings["Schedule"][day] = {}
+                    master.settings["Schedule"][day]["enabled"] = ""
+                    master.settings["Schedule"][day]["flex"] = ""
+
+                # Detect schedule keys. Rather than saving them in a flat
+                # structure, we'll store them multi-dimensionally
+                fieldsout = self.fields.copy()
+                ct = re.compile(
+                    r"(?P<trigger>enabled|end|flex|start)(?P<day>.*?)ChargeTime"
+                )
+                for key in self.fields:
+                    match = ct.match(key)
+                    if match:
+                        # Detected a multi-dimensional (per-day) key
+                        # Rewrite it into the settings array and delete it
+                        # from the input
+
+                        if (
+                            master.settings["Schedule"].get(match.group(2), None)
+                            == None
+                        ):
+                            # Create dictionary key for this day
+                            master.settings["Schedule"][match.group(2)] = {}
+
+                        # Set per-day settings
+                        master.settings["Schedule"][match.group(2)][match.group(1)] = (
+                            self.getFieldValue(key)
+                        )
 
-                else:
-                    if master.settings["Schedule"].get("Settings", None) == None:
-                        master.settings["Schedule"]["Settings"] = {}
-                    master.settings["Schedule"]["Settings"][key] = self.getFieldValue(
-                        key
-                    )
+                    else:
+                        if master.settings["Schedule"].get("Settings", None) == None:
+                            master.settings["Schedule"]["Settings"] = {}
+                        master.settings["Schedule"]["Settings"][key] = (
+                            self.getFieldValue(key)
+                        )
 
-            # During Phase 1 (backwards compatibility) for the new scheduling
-            # UI, after writing the settings in the inteded new format, we then
-            # write back to the existing settings nodes so that it is backwards
-            # compatible.
+                # During Phase 1 (backwards compatibility) for the new scheduling
+                # UI, after writing the settings in the inteded new format, we then
+                # write back to the existing settings nodes so that it is backwards
+                # compatible.
 
-            # Green Energy Tracking
-            master.settings["hourResumeTrackGreenEnergy"] = int(
-                master.settings["Schedule"]["Settings"]["resumeGreenEnergy"][:2]
-            )
+                # Green Energy Tracking
+                master.settings["hourResumeTrackGreenEnergy"] = int(
+                    master.settings["Schedule"]["Settings"]["resumeGreenEnergy"][:2]
+                )
 
-            # Scheduled amps
-            master.settings["scheduledAmpsStartHour"] = int(
-                master.settings["Schedule"]["Common"]["start"][:2]
-            )
-            master.settings["scheduledAmpsEndHour"] = int(
-                master.settings["Schedule"]["Common"]["end"][:2]
-            )
-            master.settings["scheduledAmpsMax"] = float(
-                master.settings["Schedule"]["Settings"]["scheduledAmpsMax"]
-            )
+                # Scheduled amps
+                master.settings["scheduledAmpsStartHour"] = int(
+                    master.settings["Schedule"]["Common"]["start"][:2]
+                )
+                master.settings["scheduledAmpsEndHour"] = int(
+                    master.settings["Schedule"]["Common"]["end"][:2]
+                )
+                master.settings["scheduledAmpsMax"] = float(
+                    master.settings["Schedule"]["Settings"]["scheduledAmpsMax"]
+                )
 
-            # Scheduled Days bitmap backward compatibility
-            master.settings["scheduledAmpsDaysBitmap"] = (
-                (1 if master.settings["Schedule"]["Monday"]["enabled"] else 0)
-                + (2 if master.settings["Schedule"]["Tuesday"]["enabled"] else 0)
-                + (4 if master.settings["Schedule"]["Wednesday"]["enabled"] else 0)
-                + (8 if master.settings["Schedule"]["Thursday"]["enabled"] else 0)
-                + (16 if master.settings["Schedule"]["Friday"]["enabled"] else 0)
-                + (32 if master.settings["Schedule"]["Saturday"]["enabled"] else 0)
-                + (64 if master.settings["Schedule"]["Sunday"]["enabled"] else 0)
-            )
+                # Scheduled Days bitmap backward compatibility
+                master.settings["scheduledAmpsDaysBitmap"] = (
+                    (1 if master.settings["Schedule"]["Monday"]["enabled"] else 0)
+                    + (2 if master.settings["Schedule"]["Tuesday"]["enabled"] else 0)
+                    + (4 if master.settings["Schedule"]["Wednesday"]["enabled"] else 0)
+                    + (8 if master.settings["Schedule"]["Thursday"]["enabled"] else 0)
+                    + (16 if master.settings["Schedule"]["Friday"]["enabled"] else 0)
+                    + (32 if master.settings["Schedule"]["Saturday"]["enabled"] else 0)
+                    + (64 if master.settings["Schedule"]["Sunday"]["enabled"] else 0)
+                )
 
             # Save Settings
             master.queue_background_task({"cmd": "saveSettings"})
@@ -1267,44 +1747,45 @@ def CreateHTTPHandlerClass(master):
             # This function will write the settings submitted from the settings
             # page to the settings dict, before triggering a write of the settings
             # to file
-            for key in self.fields:
-                # If the key relates to the car API tokens, we need to pass these
-                # to the appropriate module, rather than directly updating the
-                # configuration file (as it would just be overwritten)
-                if (
-                    key == "carApiBearerToken" or key == "carApiRefreshToken"
-                ) and self.getFieldValue(key) != "":
-                    carapi = master.getModuleByName("TeslaAPI")
-                    if key == "carApiBearerToken":
-                        carapi.setCarApiBearerToken(self.getFieldValue(key))
-                    elif key == "carApiRefreshToken":
-                        carapi.setCarApiRefreshToken(self.getFieldValue(key))
+            with master.settingsLock:
+                for key in self.fields:
+                    # If the key relates to the car API tokens, we need to pass these
+                    # to the appropriate module, rather than directly updating the
+                    # configuration file (as it would just be overwritten)
+                    if (
+                        key == "carApiBearerToken" or key == "carApiRefreshToken"
+                    ) and self.getFieldValue(key) != "":
+                        carapi = master.getModuleByName("TeslaAPI")
+                        if key == "carApiBearerToken":
+                            carapi.setCarApiBearerToken(self.getFieldValue(key))
+                        elif key == "carApiRefreshToken":
+                            carapi.setCarApiRefreshToken(self.getFieldValue(key))
 
-                else:
-                    # Write setting to dictionary
-                    master.settings[key] = self.getFieldValue(key)
-
-            # If Non-Scheduled power action is either Do not Charge or
-            # Track Green Energy, set Non-Scheduled power rate to 0
-            if int(master.settings.get("nonScheduledAction", 1)) > 1:
-                master.settings["nonScheduledAmpsMax"] = 0
-
-            # If triggered from the Debug page (not settings page), we need to
-            # set certain settings to false if they were not seen in the
-            # request data - This is because Check Boxes don't have a value
-            # if they aren't set
-            if page == "debug_toggle":
-                if "enableDebugCommands" not in self.fields:
-                    master.settings["enableDebugCommands"] = 0
-
-            if page == "debug":
-                checkboxes = [
-                    "spikeAmpsProactively",
-                    "spikeAmpsReactively",
-                ]
-                for checkbox in checkboxes:
-                    if checkbox not in self.fields:
-                        master.settings[checkbox] = 0
+                    else:
+                        # Write setting to dictionary
+                        master.settings[key] = self.getFieldValue(key)
+
+                # If Non-Scheduled power action is either Do not Charge or
+                # Track Green Energy, set Non-Scheduled power rate to 0
+                if int(master.settings.get("nonScheduledAction", 1)) > 1:
+                    master.settings["nonScheduledAmpsMax"] = 0
+
+                # If triggered from the Debug page (not settings page), we need to
+                # set certain settings to false if they were not seen in the
+                # request data - This is because Check Boxes don't have a value
+                # if they aren't set
+                if page == "debug_toggle":
+                    if "enableDebugCommands" not in self.fields:
+                        master.settings["enableDebugCommands"] = 0
+
+                if page == "debug":
+                    checkboxes = [
+                        "spikeAmpsProactively",
+                        "spikeAmpsReactively",
+                    ]
+                    for checkbox in checkboxes:
+                        if checkbox not in self.fields:
+                            master.settings[checkbox] = 0
 
             # Save Settings
             master.queue_background_task({"cmd": "saveSettings"})
@@ -1320,10 +1801,11 @@ def CreateHTTPHandlerClass(master):
             # Check that Graphs dict exists within settings.
             # If not, this would indicate that this is the first time
             # we have saved it
-            if master.settings.get("Graphs", None) == None:
-                master.settings["Graphs"] = {}
-            master.settings["Graphs"]["Initial"] = initial
-            master.settings["Graphs"]["End"] = end
+            with master.settingsLock:
+                if master.settings.get("Graphs", None) == None:
+                    master.settings["Graphs"] = {}
+                master.settings["Graphs"]["Initial"] = initial
+                master.settings["Graphs"]["End"] = end
 
             return
 
@@ -75,7 +75,7 @@ class MQTTControl:
                     return False
 
                 self.connectionState = 1
-                self.__client.loop_start()
+                self.master.startMQTTLoop(self.__client)
 
             else:
                 logger.log(logging.INFO4, "Module enabled but no brokerIP specified.")
@@ -263,7 +263,7 @@ class WebIPCControl:
                             )
                         else:
                             self.master.lastTWCResponseMsg = bytearray()
-                            self.master.getModuleByName("RS485").send(twcMsg)
+                            self.master.sendMessage(twcMsg)
                 elif webMsg == b"getLastTWCMsgResponse":
                     if (
                         self.master.lastTWCResponseMsg != None
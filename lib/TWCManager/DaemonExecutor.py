@@ -0,0 +1,55 @@
+from concurrent.futures import Executor, Future
+import queue
+import threading
+
+
+class DaemonExecutor(Executor):
+    # Runs the calls passed to it by run_in_executor() in a pool of up to
+    # maxWorkers threads, which are only started when there is more work
+    # waiting than idle threads to do it.
+    #
+    # Unlike ThreadPoolExecutor, the threads are daemon threads, so that a
+    # call which never finishes (such as a client streaming the status from
+    # the web interface, or a request to an API which doesn't answer) can't
+    # stop us exiting.
+
+    def __init__(self, maxWorkers, name):
+        self.idle = 0
+        self.lock = threading.Lock()
+        self.maxWorkers = max(int(maxWorkers), 1)
+        self.name = name
+        self.pending = 0
+        self.queue = queue.SimpleQueue()
+        self.workers = 0
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            future, fn, args, kwargs = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+                self.pending -= 1
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            self.queue.put((future, fn, args, kwargs))
+            self.pending += 1
+            if self.pending > self.idle and self.workers < self.maxWorkers:
+                self.workers += 1
+                threading.Thread(
+                    target=self.run,
+                    name="%s-%d" % (self.name, self.workers),
+                    daemon=True,
+                ).start()
+        return future
@@ -0,0 +1,160 @@
+# Common base class for the EMS modules which fetch their values from a
+# device or service on the network.
+#
+# Modules subclass EMS, call EMS.__init__() from their own __init__(), and
+# implement fetch(), which fetches the current values and stores them in
+# consumedW and generatedW (or whichever attributes the module uses). If the
+# fetch fails, fetch() raises an exception, returns False or sets
+# fetchFailed, and leaves the stored values as they were. getConsumption()
+# and getGeneration() call update() before returning the stored values.
+#
+# update() starts a new fetch once the values are more than cacheTime seconds
+# old. Apart from the very first fetch, this happens on the module's refresh
+# thread and update() returns straight away, so the values from the last
+# fetch are returned while the new ones are fetched. getCacheAge() returns
+# how old they are. Each failed fetch doubles the time until the next
+# attempt, up to backoffMax seconds, so an unreachable device doesn't hold up
+# every poll. Once the values are more than maxStaleFactor times cacheTime
+# seconds old, isStale() returns True, and EMSPoller stops using them.
+#
+# HTTP requests should be made with the requests.Session returned by
+# getSession(), which keeps the connection to the device open between
+# fetches.
+#
+# This module is shared by the EMS modules, and is not loaded as a module of
+# its own.
+
+import logging
+import requests
+import threading
+import time
+
+logger = logging.getLogger(__name__.rsplit(".")[-1])
+
+
+class EMS:
+    backoffMax = 300
+    cacheLock = None
+    cacheTime = 10
+    consumedW = 0
+    fetchFailed = False
+    fetchFailures = 0
+    generatedW = 0
+    lastFetch = 0
+    maxStaleFactor = 6
+    nextFetch = 0
+    refreshRequested = None
+    refreshThread = None
+    refreshing = False
+    session = None
+    timeout = 2
+
+    def __init__(self, master):
+        self.master = master
+        self.cacheLock = threading.Lock()
+        self.refreshRequested = threading.Event()
+
+    def fetch(self):
+        # Implemented by each module. A module which doesn't implement it has
+        # nothing to fetch, so every fetch fails.
+        return False
+
+    def getCacheAge(self):
+        # Returns the number of seconds since the values were last fetched,
+        # or None if they never have been
+        if not self.lastFetch:
+            return None
+        return time.time() - self.lastFetch
+
+    def getSession(self):
+        if self.session is None:
+            self.session = requests.Session()
+        return self.session
+
+    def isStale(self):
+        # Returns True if the values were last fetched so long ago that they
+        # say nothing about the power being used or generated now
+        age = self.getCacheAge()
+        return age is not None and age > self.cacheTime * self.maxStaleFactor
+
+    def refresh(self):
+        self.fetchFailed = False
+        try:
+            if self.fetch() is False:
+                self.fetchFailed = True
+        except Exception as e:
+            logger.log(
+                logging.INFO4,
+                "Error fetching values for %s: %s",
+                self.__class__.__name__,
+                e,
+            )
+            self.fetchFailed = True
+
+        now = time.time()
+        with self.cacheLock:
+            if self.fetchFailed:
+                # Wait longer after each failure before trying again
+                self.fetchFailures += 1
+                backoff = min(
+                    self.cacheTime * (2 ** min(self.fetchFailures, 16)),
+                    self.backoffMax,
+                )
+                self.nextFetch = now + max(backoff, self.cacheTime)
+                if self.fetchFailures == 1:
+                    logger.log(
+                        logging.INFO4,
+                        "Fetching values for %s failed, retrying in %ds",
+                        self.__class__.__name__,
+                        self.nextFetch - now,
+                    )
+            else:
+                self.fetchFailures = 0
+                self.lastFetch = now
+                self.nextFetch = now + self.cacheTime
+            self.refreshing = False
+
+    def runRefresh(self):
+        # The module's refresh thread, which fetches new values each time
+        # update() asks for them
+        while True:
+            self.refreshRequested.wait()
+            self.refreshRequested.clear()
+            self.refresh()
+
+    def setCacheTime(self, cacheTime):
+        self.cacheTime = cacheTime
+
+    def setTimeout(self, timeout):
+        self.timeout = timeout
+
+    def update(self):
+        # Fetch new values if the current ones are older than cacheTime.
+        # Returns True if a fetch was started.
+        with self.cacheLock:
+            now = time.time()
+            if (
+                self.refreshing
+                or now < self.nextFetch
+                or now - self.lastFetch <= self.cacheTime
+            ):
+                return False
+            self.refreshing = True
+
+            # Until we have fetched values once, there is nothing to return
+            # while we wait, so fetch them now
+            wait = not self.lastFetch and not self.fetchFailures
+
+            if not wait and not self.refreshThread:
+                self.refreshThread = threading.Thread(
+                    target=self.runRefresh,
+                    name="EMS-" + self.__class__.__name__,
+                    daemon=True,
+                )
+                self.refreshThread.start()
+
+        if wait:
+            self.refresh()
+        else:
+            self.refreshRequested.set()
+        return True
@@ -1,11 +1,11 @@
 # Efergy
-import time
+from TWCManager.EMS.EMS import EMS
 import logging
 
 logger = logging.getLogger("\U000026A1 Efergy")
 
 
-class Efergy:
+class Efergy(EMS):
     import requests
 
     cacheTime = 10
@@ -14,19 +14,17 @@ class Efergy:
     configEfergy = None
     consumedW = 0
     debugLevel = 0
-    fetchFailed = False
     token = 0
     generatedW = 0
     importW = 0
     exportW = 0
-    lastFetch = 0
     master = None
     status = False
     timeout = 10
     voltage = 0
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         try:
             self.configConfig = master.config["config"]
@@ -74,7 +72,7 @@ class Efergy:
         self.fetchFailed = False
 
         try:
-            r = self.requests.get(url, timeout=self.timeout)
+            r = self.getSession().get(url, timeout=self.timeout)
         except self.requests.exceptions.ConnectionError as e:
             logger.log(
                 logging.INFO4, "Error connecting to Efergy to fetch sensor value"
@@ -95,27 +93,16 @@ class Efergy:
 
         return self.getValue(url)
 
-    def update(self):
-        if (int(time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from Efergy.
-
-            meterData = self.getMeterData()
-
-            if meterData:
-                try:
-                    self.consumedW = list(meterData[0]["data"][0].values())[0]
-                except (KeyError, TypeError) as e:
-                    logger.log(
-                        logging.INFO4,
-                        "Exception during parsing Meter Data (Consumption)",
-                    )
-                    logger.debug(str(e))
-
-            # Update last fetch time
-            if self.fetchFailed is not True:
-                self.lastFetch = int(time.time())
-
-            return True
-        else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+    def fetch(self):
+        # Fetch values from Efergy.
+        meterData = self.getMeterData()
+
+        if meterData:
+            try:
+                self.consumedW = list(meterData[0]["data"][0].values())[0]
+            except (KeyError, TypeError) as e:
+                logger.log(
+                    logging.INFO4,
+                    "Exception during parsing Meter Data (Consumption)",
+                )
+                logger.debug(str(e))
@@ -1,14 +1,14 @@
+from TWCManager.EMS.EMS import EMS
 import logging
 
 logger = logging.getLogger("\U000026A1 EmonCMS")
 
 
-class EmonCMS:
+class EmonCMS(EMS):
     # OpenEnergyMonitor (EmonCMS) Module
     # Fetches Consumption and Generation details from Open Energy Monitor
 
     import requests
-    import time
 
     apiKey = None
     cacheTime = 10
@@ -19,7 +19,6 @@ class EmonCMS:
     generatedW = 0
     consumptionFeed = None
     generationFeed = None
-    lastFetch = 0
     master = None
     status = False
     serverIP = None
@@ -30,7 +29,7 @@ class EmonCMS:
     entities = None
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         try:
             self.configConfig = master.config["config"]
@@ -101,7 +100,9 @@ class EmonCMS:
 
         try:
             logger.debug("Fetching EmonCMS feeds " + ",".join(feeds))
-            httpResponse = self.requests.get(url, headers=headers, timeout=self.timeout)
+            httpResponse = self.getSession().get(
+                url, headers=headers, timeout=self.timeout
+            )
         except self.requests.exceptions.ConnectionError as e:
             logger.log(
                 logging.INFO4,
@@ -138,38 +139,24 @@ class EmonCMS:
         else:
             return None
 
-    def setCacheTime(self, cacheTime):
-        self.cacheTime = cacheTime
-
-    def setTimeout(self, timeout):
-        self.timeout = timeout
+    def fetch(self):
+        # Fetch values from EmonCMS
+        feeds = []
 
-    def update(self):
-        # Update function - determine if an update is required
+        if self.consumptionFeed:
+            feeds.append(self.consumptionFeed)
 
-        if (int(self.time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from EmonCMS
-            feeds = []
-
-            if self.consumptionFeed:
-                feeds.append(self.consumptionFeed)
+        if self.consumptionFeed:
+            feeds.append(self.generationFeed)
 
+        vals = self.getFeeds(feeds)
+        if vals:
             if self.consumptionFeed:
-                feeds.append(self.generationFeed)
+                self.consumedW = float(vals.pop())
+                logger.debug("getConsumption returns " + str(self.consumedW))
 
-            vals = self.getFeeds(feeds)
-            if vals:
-                if self.consumptionFeed:
-                    self.consumedW = float(vals.pop())
-                    logger.debug("getConsumption returns " + str(self.consumedW))
-
-                if self.generationFeed:
-                    self.generatedW = float(vals.pop())
-                    logger.debug("getGeneration returns " + str(self.generatedW))
-
-                self.lastFetch = int(self.time.time())
-
-            return True
+            if self.generationFeed:
+                self.generatedW = float(vals.pop())
+                logger.debug("getGeneration returns " + str(self.generatedW))
         else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+            self.fetchFailed = True
@@ -1,11 +1,11 @@
 # Enphase Monitoring Portal Integration
+from TWCManager.EMS.EMS import EMS
 import logging
-import time
 
 logger = logging.getLogger("\U000026C5 Enphase")
 
 
-class Enphase:
+class Enphase(EMS):
     import requests
 
     apiKey = None
@@ -16,11 +16,9 @@ class Enphase:
     configConfig = None
     configEnphase = None
     consumedW = 0
-    fetchFailed = False
     generatedW = 0
     importW = 0
     exportW = 0
-    lastFetch = 0
     master = None
     status = False
     systemID = None
@@ -29,7 +27,7 @@ class Enphase:
     voltage = 0
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         try:
             self.configConfig = master.config["config"]
@@ -98,7 +96,7 @@ class Enphase:
         self.fetchFailed = False
 
         try:
-            r = self.requests.get(url, timeout=self.timeout)
+            r = self.getSession().get(url, timeout=self.timeout)
         except self.requests.exceptions.ConnectionError as e:
             logger.log(
                 logging.INFO4,
@@ -121,37 +119,26 @@ class Enphase:
         else:
             return r.json()
 
-    def update(self):
-        if (int(time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from Portal.
-
-            portalData = self.getPortalData()
-            if portalData:
-                try:
-                    # Determine if this is Local or Cloud API
-                    if self.apiKey and self.userID and self.systemID:
-                        self.generatedW = int(portalData["current_power"])
-                    elif self.serverIP and self.serverPort:
-                        self.generatedW = int(portalData["production"][1]["wNow"])
-                        self.consumedW = int(portalData["consumption"][0]["wNow"])
-                        self.voltage = int(portalData["consumption"][0]["rmsVoltage"])
-                except (KeyError, TypeError) as e:
-                    logger.log(
-                        logging.INFO4,
-                        "Exception during parsing Enphase data (current_power)",
-                    )
-                    logger.debug(e)
-            else:
+    def fetch(self):
+        # Fetch values from Portal.
+        portalData = self.getPortalData()
+        if portalData:
+            try:
+                # Determine if this is Local or Cloud API
+                if self.apiKey and self.userID and self.systemID:
+                    self.generatedW = int(portalData["current_power"])
+                elif self.serverIP and self.serverPort:
+                    self.generatedW = int(portalData["production"][1]["wNow"])
+                    self.consumedW = int(portalData["consumption"][0]["wNow"])
+                    self.voltage = int(portalData["consumption"][0]["rmsVoltage"])
+            except (KeyError, TypeError) as e:
                 logger.log(
-                    logging.INFO4, "Enphase API result does not contain json content."
+                    logging.INFO4,
+                    "Exception during parsing Enphase data (current_power)",
                 )
-                self.fetchFailed = True
-
-            # Update last fetch time
-            if self.fetchFailed is not True:
-                self.lastFetch = int(time.time())
-
-            return True
+                logger.debug(e)
         else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+            logger.log(
+                logging.INFO4, "Enphase API result does not contain json content."
+            )
+            self.fetchFailed = True
@@ -1,22 +1,20 @@
 # Fronius Datamanager Solar.API Integration (Inverter Web Interface)
+from TWCManager.EMS.EMS import EMS
 import logging
 import requests
-import time
 
 logger = logging.getLogger("\U000026C5 Fronius")
 
 
-class Fronius:
+class Fronius(EMS):
     cacheTime = 10
     config = None
     configConfig = None
     configFronius = None
     consumedW = 0
-    fetchFailed = False
     generatedW = 0
     importW = 0
     exportW = 0
-    lastFetch = 0
     master = None
     serverIP = []
     serverPort = 80
@@ -25,7 +23,7 @@ class Fronius:
     voltage = 0
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         try:
             self.configConfig = master.config["config"]
@@ -83,10 +81,8 @@ class Fronius:
 
     def getInverterValue(self, url):
         # Fetch the specified URL from the Fronius Inverter and return the data
-        self.fetchFailed = False
-
         try:
-            r = requests.get(url, timeout=self.timeout)
+            r = self.getSession().get(url, timeout=self.timeout)
         except requests.exceptions.ConnectionError as e:
             logger.log(
                 logging.INFO4,
@@ -106,56 +102,49 @@ class Fronius:
 
         return self.getInverterValue(url)
 
-    def update(self):
-        if (int(time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from Fronius inverter.
-
-            con = 0
-            gen = 0
-            for inverter in self.serverIP:
-                inverterData = self.getInverterData(inverter)
-                if inverterData:
-                    try:
-                        if "UAC" in inverterData["Body"]["Data"]:
-                            self.voltage = inverterData["Body"]["Data"]["UAC"]["Value"]
-                    except (KeyError, TypeError) as e:
-                        logger.log(
-                            logging.INFO4,
-                            "Exception during parsing Inverter Data (UAC)",
-                        )
-                        logger.debug(e)
-
-                meterData = self.getMeterData(inverter)
-                if meterData:
-                    try:
-                        if "P_PV" in meterData["Body"]["Data"]["Site"]:
-                            gen += float(meterData["Body"]["Data"]["Site"]["P_PV"])
-                    except (KeyError, TypeError) as e:
-                        logger.log(
-                            logging.INFO4,
-                            "Exception during parsing Meter Data (Generation)",
-                        )
-                        logger.debug(e)
-
-                    try:
-                        if "P_Load" in meterData["Body"]["Data"]["Site"]:
-                            con += float(meterData["Body"]["Data"]["Site"]["P_Load"])
-                    except (KeyError, TypeError) as e:
-                        logger.log(
-                            logging.INFO4,
-                            "Exception during parsing Meter Data (Consumption)",
-                        )
-                        logger.debug(e)
-
-            # Update values
-            self.consumedW = con
-            self.generatedW = gen
-
-            # Update last fetch time
-            if self.fetchFailed is not True:
-                self.lastFetch = int(time.time())
-
-            return True
-        else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+    def fetch(self):
+        # Fetch values from Fronius inverter.
+        con = 0
+        gen = 0
+        for inverter in self.serverIP:
+            inverterData = self.getInverterData(inverter)
+            if inverterData:
+                try:
+                    if "UAC" in inverterData["Body"]["Data"]:
+                        self.voltage = inverterData["Body"]["Data"]["UAC"]["Value"]
+                except (KeyError, TypeError) as e:
+                    logger.log(
+                        logging.INFO4,
+                        "Exception during parsing Inverter Data (UAC)",
+                    )
+                    logger.debug(e)
+
+            meterData = self.getMeterData(inverter)
+            if not meterData:
+                # Keep the values from the last fetch, rather than replacing
+                # them with totals which are missing this inverter
+                return False
+            else:
+                try:
+                    if "P_PV" in meterData["Body"]["Data"]["Site"]:
+                        gen += float(meterData["Body"]["Data"]["Site"]["P_PV"])
+                except (KeyError, TypeError) as e:
+                    logger.log(
+                        logging.INFO4,
+                        "Exception during parsing Meter Data (Generation)",
+                    )
+                    logger.debug(e)
+
+                try:
+                    if "P_Load" in meterData["Body"]["Data"]["Site"]:
+                        con += float(meterData["Body"]["Data"]["Site"]["P_Load"])
+                except (KeyError, TypeError) as e:
+                    logger.log(
+                        logging.INFO4,
+                        "Exception during parsing Meter Data (Consumption)",
+                    )
+                    logger.debug(e)
+
+        # Update values
+        self.consumedW = con
+        self.generatedW = gen
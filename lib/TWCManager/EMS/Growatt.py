@@ -1,3 +1,4 @@
+from TWCManager.EMS.EMS import EMS
 import logging
 import growattServer
 import datetime
@@ -6,25 +7,19 @@ import datetime
 logger = logging.getLogger("\U000026C5 Growatt")
 
 
-class Growatt:
+class Growatt(EMS):
     # Growatt EMS Module
     # Fetches Consumption and Generation details from Growatt API
 
-    import requests
-    import time
-
     cacheTime = 10
     config = None
     configConfig = None
     configGrowatt = None
     batterySOC = 0
     consumedW = 0
-    fetchFailed = False
     generatedW = 0
-    lastFetch = 0
     master = None
     password = None
-    session = None
     status = False
     timeout = 2
     username = None
@@ -36,7 +31,7 @@ class Growatt:
     now = None
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         self.configConfig = master.config.get("config", {})
         self.configGrowatt = master.config["sources"].get("Growatt", {})
@@ -127,25 +122,7 @@ class Growatt:
         else:
             logger.log(logging.INFO4, "No response from Growatt API")
 
-    def setCacheTime(self, cacheTime):
-        self.cacheTime = cacheTime
-
-    def setTimeout(self, timeout):
-        self.timeout = timeout
-
-    def update(self):
-        # Update function - determine if an update is required
+    def fetch(self):
+        # Fetch values from Growatt.
         self.now = datetime.datetime.now().time()
-
-        if (int(self.time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from Growatt.
-            self.getGenerationValues()
-
-            # Update last fetch time
-            if self.fetchFailed is not True:
-                self.lastFetch = int(self.time.time())
-
-            return True
-        else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+        self.getGenerationValues()
@@ -1,14 +1,14 @@
+from TWCManager.EMS.EMS import EMS
 import logging
 
 logger = logging.getLogger("\U000026A1 HASS")
 
 
-class HASS:
+class HASS(EMS):
     # HomeAssistant EMS Module
     # Fetches Consumption and Generation details from HomeAssistant
 
     import requests
-    import time
 
     apiKey = None
     cacheTime = 10
@@ -16,11 +16,9 @@ class HASS:
     configConfig = None
     configHASS = None
     consumedW = 0
-    fetchFailed = False
     generatedW = 0
     hassEntityConsumption = None
     hassEntityGeneration = None
-    lastFetch = 0
     master = None
     status = False
     serverIP = None
@@ -29,7 +27,7 @@ class HASS:
     timeout = 2
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         try:
             self.configConfig = master.config["config"]
@@ -88,7 +86,9 @@ class HASS:
 
         try:
             logger.debug("Fetching HomeAssistant EMS sensor value " + str(entity))
-            httpResponse = self.requests.get(url, headers=headers, timeout=self.timeout)
+            httpResponse = self.getSession().get(
+                url, headers=headers, timeout=self.timeout
+            )
         except self.requests.exceptions.ConnectionError as e:
             logger.log(
                 logging.INFO4,
@@ -117,43 +117,24 @@ class HASS:
         else:
             return None
 
-    def setCacheTime(self, cacheTime):
-        self.cacheTime = cacheTime
-
-    def setTimeout(self, timeout):
-        self.timeout = timeout
-
-    def update(self):
-        # Update function - determine if an update is required
-
-        if (int(self.time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from HomeAssistant sensor.
-
-            if self.hassEntityConsumption:
-                apivalue = self.getAPIValue(self.hassEntityConsumption)
-                if self.fetchFailed is not True:
-                    logger.debug("getConsumption returns " + str(apivalue))
-                    self.consumedW = float(apivalue)
-                else:
-                    logger.debug("getConsumption fetch failed, using cached values")
-            else:
-                logger.debug("Consumption Entity Not Supplied. Not Querying")
-
-            if self.hassEntityGeneration:
-                apivalue = self.getAPIValue(self.hassEntityGeneration)
-                if self.fetchFailed is not True:
-                    logger.debug("getGeneration returns " + str(apivalue))
-                    self.generatedW = float(apivalue)
-                else:
-                    logger.debug("getGeneration fetch failed, using cached values")
+    def fetch(self):
+        # Fetch values from HomeAssistant sensor.
+        if self.hassEntityConsumption:
+            apivalue = self.getAPIValue(self.hassEntityConsumption)
+            if self.fetchFailed is not True:
+                logger.debug("getConsumption returns " + str(apivalue))
+                self.consumedW = float(apivalue)
             else:
-                logger.debug("Generation Entity Not Supplied. Not Querying")
+                logger.debug("getConsumption fetch failed, using cached values")
+        else:
+            logger.debug("Consumption Entity Not Supplied. Not Querying")
 
-            # Update last fetch time
+        if self.hassEntityGeneration:
+            apivalue = self.getAPIValue(self.hassEntityGeneration)
             if self.fetchFailed is not True:
-                self.lastFetch = int(self.time.time())
-
-            return True
+                logger.debug("getGeneration returns " + str(apivalue))
+                self.generatedW = float(apivalue)
+            else:
+                logger.debug("getGeneration fetch failed, using cached values")
         else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+            logger.debug("Generation Entity Not Supplied. Not Querying")
@@ -1,11 +1,11 @@
+from TWCManager.EMS.EMS import EMS
 import logging
 import requests
-import time
 
 logger = logging.getLogger("\U000026A1 OpenHab")
 
 
-class OpenHab:
+class OpenHab(EMS):
     # OpenHab EMS Module
     # Fetches Consumption and Generation details from OpenHab
 
@@ -15,11 +15,9 @@ class OpenHab:
     configConfig = None
     configOpenHab = None
     consumedW = 0
-    fetchFailed = False
     generatedW = 0
     consumptionItem = None
     generationItem = None
-    lastFetch = 0
     master = None
     status = False
     serverIP = None
@@ -27,7 +25,7 @@ class OpenHab:
     timeout = 2
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         try:
             self.configConfig = master.config["config"]
@@ -87,7 +85,7 @@ class OpenHab:
 
         try:
             logger.debug("Fetching OpenHab EMS item value " + str(item))
-            httpResponse = requests.get(url, timeout=self.timeout)
+            httpResponse = self.getSession().get(url, timeout=self.timeout)
         except requests.exceptions.ConnectionError as e:
             logger.log(
                 logging.INFO4, "Error connecting to OpenHab to fetch item values"
@@ -119,47 +117,24 @@ class OpenHab:
             self.fetchFailed = True
             return False
 
-    def setCacheTime(self, cacheTime):
-        self.cacheTime = cacheTime
-
-    def setTimeout(self, timeout):
-        self.timeout = timeout
-
-    def update(self):
-        # Update function - determine if an update is required
-
-        if (int(time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from OpenHab item.
-
-            if self.consumptionItem:
-                apivalue = self.getAPIValue(self.consumptionItem)
-                if self.fetchFailed is not True:
-                    logger.debug("OpenHab getConsumption returns " + str(apivalue))
-                    self.consumedW = apivalue
-                else:
-                    logger.debug(
-                        "OpenHab getConsumption fetch failed, using cached values"
-                    )
-            else:
-                logger.debug("OpenHab Consumption Entity Not Supplied. Not Querying")
-
-            if self.generationItem:
-                apivalue = self.getAPIValue(self.generationItem)
-                if self.fetchFailed is not True:
-                    logger.debug("OpenHab getGeneration returns " + str(apivalue))
-                    self.generatedW = apivalue
-                else:
-                    logger.debug(
-                        "OpenHab getGeneration fetch failed, using cached values"
-                    )
+    def fetch(self):
+        # Fetch values from OpenHab item.
+        if self.consumptionItem:
+            apivalue = self.getAPIValue(self.consumptionItem)
+            if self.fetchFailed is not True:
+                logger.debug("OpenHab getConsumption returns " + str(apivalue))
+                self.consumedW = apivalue
             else:
-                logger.debug("OpenHab Generation Entity Not Supplied. Not Querying")
+                logger.debug("OpenHab getConsumption fetch failed, using cached values")
+        else:
+            logger.debug("OpenHab Consumption Entity Not Supplied. Not Querying")
 
-            # Update last fetch time
+        if self.generationItem:
+            apivalue = self.getAPIValue(self.generationItem)
             if self.fetchFailed is not True:
-                self.lastFetch = int(time.time())
-
-            return True
+                logger.debug("OpenHab getGeneration returns " + str(apivalue))
+                self.generatedW = apivalue
+            else:
+                logger.debug("OpenHab getGeneration fetch failed, using cached values")
         else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+            logger.debug("OpenHab Generation Entity Not Supplied. Not Querying")
@@ -1,4 +1,5 @@
 # OpenWeatherMap,py module for TWCManager by GMerg
+from TWCManager.EMS.EMS import EMS
 import logging
 import requests
 import time
@@ -6,15 +7,13 @@ import time
 logger = logging.getLogger("\U000026C5 OpenWthr")
 
 
-class OpenWeatherMap:
+class OpenWeatherMap(EMS):
     cacheTime = 60
     config = None
     configConfig = None
     configOpenWeatherMap = None
-    fetchFailed = False
     generatedW = 0
     consumedW = 0
-    lastFetch = 0
     master = None
     APIKey = None
     Latitude = 0
@@ -25,7 +24,7 @@ class OpenWeatherMap:
     LastJson = None
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         try:
             self.configConfig = master.config["config"]
@@ -82,7 +81,7 @@ class OpenWeatherMap:
         self.fetchFailed = False
 
         try:
-            r = requests.get(url, timeout=self.timeout)
+            r = self.getSession().get(url, timeout=self.timeout)
         except requests.exceptions.ConnectionError as e:
             logger.log(
                 logging.INFO4,
@@ -120,17 +119,21 @@ class OpenWeatherMap:
 
         return bestjson
 
+    def fetch(self):
+        # Fetch the forecast from OpenWeatherMap
+        tmp = self.getOpenWeatherMapData()
+        if tmp:
+            self.LastJson = tmp
+        else:
+            self.fetchFailed = True
+
     def update(self):
         month = int(time.strftime("%m"))
         dt = int(time.time())
-        if (int(time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from OpenWeatherMap inverter.
-            tmp = self.getOpenWeatherMapData()
-            if tmp:
-                self.LastJson = tmp
-                # Update last fetch time
-                if self.fetchFailed is not True:
-                    self.lastFetch = int(time.time())
+
+        # Fetch a new forecast if necessary, then estimate the generation
+        # from the latest one
+        EMS.update(self)
 
         if self.LastJson:
             try:
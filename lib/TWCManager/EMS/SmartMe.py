@@ -1,33 +1,30 @@
+from TWCManager.EMS.EMS import EMS
 import logging
 
 logger = logging.getLogger("\U000026A1 SmartMe")
 
 
-class SmartMe:
+class SmartMe(EMS):
     # SmartMe EMS Module
     # Fetches Consumption and Generation details from SmartMe API
 
     import requests
-    import time
 
     cacheTime = 10
     config = None
     configConfig = None
     configSmartMe = None
     consumedW = 0
-    fetchFailed = False
     generatedW = 0
-    lastFetch = 0
     master = None
     password = None
     serialNumber = None
-    session = None
     status = False
     timeout = 2
     username = None
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         self.configConfig = master.config.get("config", {})
         self.configSmartMe = master.config["sources"].get("SmartMe", {})
@@ -79,9 +76,9 @@ class SmartMe:
 
         try:
             logger.debug("Fetching SmartMe EMS sensor values")
-            self.session = self.requests.Session()
-            self.session.auth = (self.username, self.password)
-            httpResponse = self.session.get(url, headers=headers, timeout=self.timeout)
+            session = self.getSession()
+            session.auth = (self.username, self.password)
+            httpResponse = session.get(url, headers=headers, timeout=self.timeout)
         except self.requests.exceptions.ConnectionError as e:
             logger.log(
                 logging.INFO4, "Error connecting to SmartMe to fetching sensor values"
@@ -116,24 +113,6 @@ class SmartMe:
         else:
             logger.log(logging.INFO4, "No JSON response from SmartMe API")
 
-    def setCacheTime(self, cacheTime):
-        self.cacheTime = cacheTime
-
-    def setTimeout(self, timeout):
-        self.timeout = timeout
-
-    def update(self):
-        # Update function - determine if an update is required
-
-        if (int(self.time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from SmartMe.
-            self.getGenerationValues()
-
-            # Update last fetch time
-            if self.fetchFailed is not True:
-                self.lastFetch = int(self.time.time())
-
-            return True
-        else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+    def fetch(self):
+        # Fetch values from SmartMe.
+        self.getGenerationValues()
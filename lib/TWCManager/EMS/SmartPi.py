@@ -1,11 +1,11 @@
+from TWCManager.EMS.EMS import EMS
 import logging
 import requests
-import time
 
 logger = logging.getLogger("\U000026A1 SmartPi")
 
 
-class SmartPi:
+class SmartPi(EMS):
     # SmartPi EMS Module
     # Fetches Consumption and Generation details from SmartPi API
 
@@ -14,9 +14,7 @@ class SmartPi:
     configConfig = None
     configSmartPi = None
     consumedW = 0
-    fetchFailed = False
     generatedW = 0
-    lastFetch = 0
     master = None
     serverIP = None
     serverPort = 80
@@ -25,7 +23,7 @@ class SmartPi:
     timeout = 2
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         self.configConfig = master.config.get("config", {})
         self.configSmartPi = master.config["sources"].get("SmartPi", {})
@@ -75,7 +73,9 @@ class SmartPi:
 
         try:
             logger.debug("Fetching SmartPi EMS sensor values")
-            httpResponse = requests.get(url, headers=headers, timeout=self.timeout)
+            httpResponse = self.getSession().get(
+                url, headers=headers, timeout=self.timeout
+            )
         except requests.exceptions.ConnectionError as e:
             logger.log(
                 logging.INFO4, "Error connecting to SmartPi to fetch sensor values"
@@ -131,24 +131,6 @@ class SmartPi:
         else:
             logger.log(logging.INFO4, "No JSON response from SmartPi API")
 
-    def setCacheTime(self, cacheTime):
-        self.cacheTime = cacheTime
-
-    def setTimeout(self, timeout):
-        self.timeout = timeout
-
-    def update(self):
-        # Update function - determine if an update is required
-
-        if (int(time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from SmartPi.
-            self.getGenerationValues()
-
-            # Update last fetch time
-            if self.fetchFailed is not True:
-                self.lastFetch = int(time.time())
-
-            return True
-        else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+    def fetch(self):
+        # Fetch values from SmartPi.
+        self.getGenerationValues()
@@ -1,4 +1,5 @@
 # SolarEdge Monitoring Portal Integration
+from TWCManager.EMS.EMS import EMS
 import logging
 import time
 import solaredge_modbus
@@ -6,7 +7,7 @@ import solaredge_modbus
 logger = logging.getLogger("\U000026C5 SolarEdg")
 
 
-class SolarEdge:
+class SolarEdge(EMS):
     import requests
 
     apiKey = None
@@ -19,11 +20,9 @@ class SolarEdge:
     consumedW = 0
     debugFile = "/tmp/twcmanager_solaredge_debug.txt"
     debugMode = 0
-    fetchFailed = False
     generatedW = 0
     importW = 0
     exportW = 0
-    lastFetch = 0
     master = None
     pollConsumption = 0
     pollCount = 0
@@ -38,7 +37,7 @@ class SolarEdge:
     useModbusTCP = False
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         try:
             self.configConfig = master.config["config"]
@@ -133,7 +132,7 @@ class SolarEdge:
             file.close()
 
         try:
-            r = self.requests.get(url, timeout=self.timeout)
+            r = self.getSession().get(url, timeout=self.timeout)
         except self.requests.exceptions.ConnectionError as e:
             logger.log(
                 logging.INFO4,
@@ -267,9 +266,9 @@ class SolarEdge:
         meteredExport = 0
         exportIsMetered = False
 
-        # if we fail to update, we may be called again immediately
-        # this will make pymodbus.c choke, so give it a second to relax
-        if self.fetchFailed:
+        # if we failed to update last time, we may be called again straight
+        # away. This will make pymodbus.c choke, so give it a second to relax
+        if self.fetchFailures:
             time.sleep(1)
 
         inverter = solaredge_modbus.Inverter(
@@ -355,25 +354,14 @@ class SolarEdge:
         self.fetchFailed = False
         inverter.disconnect()
 
-    def update(self):
-        if (int(time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from Portal.
-
-            if self.useModbusTCP:
-                self.updateModbusTCP()
-            else:
-                self.updateCloudAPI()
-
-            # Update last fetch time
-            if self.fetchFailed is not True:
-                self.lastFetch = int(time.time())
-            else:
-                if self.debugMode:
-                    with open(self.debugFile, "a+") as file:
-                        file.write("fetchFailed is True\n")
-                    file.close()
-
-            return True
+    def fetch(self):
+        # Fetch values from Portal.
+        if self.useModbusTCP:
+            self.updateModbusTCP()
         else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+            self.updateCloudAPI()
+
+        if self.fetchFailed and self.debugMode:
+            with open(self.debugFile, "a+") as file:
+                file.write("fetchFailed is True\n")
+            file.close()
@@ -1,10 +1,10 @@
+from TWCManager.EMS.EMS import EMS
 import logging
-import time
 
 logger = logging.getLogger("\U000026C5 SolarLog")
 
 
-class SolarLog:
+class SolarLog(EMS):
     # SolarLog EMS Module
     # Fetches Consumption and Generation details from SolarLog
 
@@ -16,9 +16,7 @@ class SolarLog:
     configSolarLog = None
     consumedW = 0
     excludeConsumedW = 0
-    fetchFailed = False
     generatedW = 0
-    lastFetch = 0
     master = None
     status = False
     serverIP = None
@@ -27,7 +25,7 @@ class SolarLog:
     smartEnergyInvertersActive = []
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         self.configConfig = master.config.get("config", {})
         self.configSolarLog = master.config["sources"].get("SolarLog", {})
@@ -75,7 +73,7 @@ class SolarLog:
 
         try:
             logger.debug("Fetching SolarLog EMS sensor values")
-            httpResponse = self.requests.post(
+            httpResponse = self.getSession().post(
                 url, data=payload, headers=headers, timeout=self.timeout
             )
         except self.requests.exceptions.ConnectionError as e:
@@ -152,7 +150,7 @@ class SolarLog:
 
         try:
             logger.debug("Fetching SolarLog EMS inverter values")
-            httpResponse = self.requests.post(
+            httpResponse = self.getSession().post(
                 url, data=payload, headers=headers, timeout=self.timeout
             )
         except self.requests.exceptions.ConnectionError as e:
@@ -182,27 +180,9 @@ class SolarLog:
                 tmpValue = tmpValue + float(jsonResponse["782"][str(inverterIndex)])
             self.excludeConsumedW = tmpValue
 
-    def setCacheTime(self, cacheTime):
-        self.cacheTime = cacheTime
+    def fetch(self):
+        # Fetch values from SolarLog.
+        self.getConsumptionAndGenerationValues()
 
-    def setTimeout(self, timeout):
-        self.timeout = timeout
-
-    def update(self):
-        # Update function - determine if an update is required
-
-        if (int(time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from SolarLog.
-            self.getConsumptionAndGenerationValues()
-
-            if self.fetchFailed is not True:
-                self.getInverterValues()
-
-            # Update last fetch time
-            if self.fetchFailed is not True:
-                self.lastFetch = int(time.time())
-
-            return True
-        else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+        if self.fetchFailed is not True:
+            self.getInverterValues()
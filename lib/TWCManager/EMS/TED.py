@@ -1,14 +1,14 @@
 # The Energy Detective (TED)
+from TWCManager.EMS.EMS import EMS
 import logging
 import re
 import requests
-import time
 
 
 logger = logging.getLogger("\U000026C5 TED")
 
 
-class TED:
+class TED(EMS):
     # I check solar panel generation using an API exposed by The
     # Energy Detective (TED). It's a piece of hardware available
     # at http://www.theenergydetective.com
@@ -18,11 +18,9 @@ class TED:
     configConfig = None
     configTED = None
     consumedW = 0
-    fetchFailed = False
     generatedW = 0
     importW = 0
     exportW = 0
-    lastFetch = 0
     master = None
     serverIP = None
     serverPort = 80
@@ -31,7 +29,7 @@ class TED:
     voltage = 0
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         try:
             self.configConfig = self.config["config"]
@@ -77,7 +75,7 @@ class TED:
         self.fetchFailed = False
 
         try:
-            r = requests.get(url, timeout=self.timeout)
+            r = self.getSession().get(url, timeout=self.timeout)
         except requests.exceptions.ConnectionError as e:
             logger.log(logging.INFO4, "Error connecting to TED to fetch solar data")
             logger.debug(str(e))
@@ -87,29 +85,18 @@ class TED:
         r.raise_for_status()
         return r
 
-    def update(self):
-        if (int(time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from HomeAssistant sensor.
+    def fetch(self):
+        # Fetch values from HomeAssistant sensor.
+        url = "http://" + self.serverIP + ":" + self.serverPort
+        url = url + "/history/export.csv?T=1&D=0&M=1&C=1"
 
-            url = "http://" + self.serverIP + ":" + self.serverPort
-            url = url + "/history/export.csv?T=1&D=0&M=1&C=1"
-
-            value = self.getTEDValue(url)
-            m = None
-            if value:
-                m = re.search(b"^Solar,[^,]+,-?([^, ]+),", value, re.MULTILINE)
-            else:
-                logger.log(logging.INFO5, "Failed to find value in response from TED")
-                self.fetchFailed = True
-
-            if m:
-                self.generatedW = int(float(m.group(1)) * 1000)
-
-            # Update last fetch time
-            if self.fetchFailed is not True:
-                self.lastFetch = int(time.time())
-
-            return True
+        value = self.getTEDValue(url)
+        m = None
+        if value:
+            m = re.search(b"^Solar,[^,]+,-?([^, ]+),", value, re.MULTILINE)
         else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+            logger.log(logging.INFO5, "Failed to find value in response from TED")
+            self.fetchFailed = True
+
+        if m:
+            self.generatedW = int(float(m.group(1)) * 1000)
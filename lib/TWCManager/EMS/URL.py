@@ -1,11 +1,11 @@
+from TWCManager.EMS.EMS import EMS
 import logging
 import requests
-import time
 
 logger = logging.getLogger("\U000026A1 URL")
 
 
-class URL:
+class URL(EMS):
     # URL EMS Module
     # Fetches Consumption and Generation details from URL
 
@@ -15,18 +15,16 @@ class URL:
     configConfig = None
     configURL = None
     consumedW = 0
-    fetchFailed = False
     generatedW = 0
     consumptionItem = None
     generationItem = None
-    lastFetch = 0
     master = None
     status = False
     URL = None
     timeout = 2
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         try:
             self.configConfig = master.config["config"]
@@ -77,7 +75,7 @@ class URL:
 
         try:
             logger.debug("Fetching URL EMS item value " + str(item))
-            httpResponse = requests.get(url, timeout=self.timeout)
+            httpResponse = self.getSession().get(url, timeout=self.timeout)
         except requests.exceptions.ConnectionError as e:
             logger.log(logging.INFO4, "Error connecting to URL to fetch item values")
             logger.debug(str(e))
@@ -105,43 +103,24 @@ class URL:
             self.fetchFailed = True
             return False
 
-    def setCacheTime(self, cacheTime):
-        self.cacheTime = cacheTime
-
-    def setTimeout(self, timeout):
-        self.timeout = timeout
-
-    def update(self):
-        # Update function - determine if an update is required
-
-        if (int(time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from URL item.
-
-            if self.consumptionItem:
-                apivalue = self.getAPIValue(self.consumptionItem)
-                if self.fetchFailed is not True:
-                    logger.debug("URL getConsumption returns " + str(apivalue))
-                    self.consumedW = apivalue
-                else:
-                    logger.debug("URL getConsumption fetch failed, using cached values")
-            else:
-                logger.debug("URL Consumption Entity Not Supplied. Not Querying")
-
-            if self.generationItem:
-                apivalue = self.getAPIValue(self.generationItem)
-                if self.fetchFailed is not True:
-                    logger.debug("URL getGeneration returns " + str(apivalue))
-                    self.generatedW = apivalue
-                else:
-                    logger.debug("URL getGeneration fetch failed, using cached values")
+    def fetch(self):
+        # Fetch values from URL item.
+        if self.consumptionItem:
+            apivalue = self.getAPIValue(self.consumptionItem)
+            if self.fetchFailed is not True:
+                logger.debug("URL getConsumption returns " + str(apivalue))
+                self.consumedW = apivalue
             else:
-                logger.debug("URL Generation Entity Not Supplied. Not Querying")
+                logger.debug("URL getConsumption fetch failed, using cached values")
+        else:
+            logger.debug("URL Consumption Entity Not Supplied. Not Querying")
 
-            # Update last fetch time
+        if self.generationItem:
+            apivalue = self.getAPIValue(self.generationItem)
             if self.fetchFailed is not True:
-                self.lastFetch = int(time.time())
-
-            return True
+                logger.debug("URL getGeneration returns " + str(apivalue))
+                self.generatedW = apivalue
+            else:
+                logger.debug("URL getGeneration fetch failed, using cached values")
         else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+            logger.debug("URL Generation Entity Not Supplied. Not Querying")
@@ -1,12 +1,12 @@
+from TWCManager.EMS.EMS import EMS
 import logging
 import requests
-import time
 import re
 
 logger = logging.getLogger("\U000026C5 Volkszlr")
 
 
-class Volkszahler:
+class Volkszahler(EMS):
     # Volkszahler EMS Module
     # Fetches Consumption and Generation details from Volkszahler API
 
@@ -14,8 +14,6 @@ class Volkszahler:
     config = None
     configConfig = None
     configVolkszahler = None
-    fetchFailed = False
-    lastFetch = 0
     master = None
     serverIP = None
     serverPort = 80
@@ -27,7 +25,7 @@ class Volkszahler:
     TotalGridW = 0
 
     def __init__(self, master):
-        self.master = master
+        super().__init__(master)
         self.config = master.config
         self.configConfig = master.config.get("config", {})
         self.configVolkszahler = master.config["sources"].get("Volkszahler", {})
@@ -88,7 +86,9 @@ class Volkszahler:
 
         try:
             logger.debug("Fetching Volkszahler EMS sensor values")
-            httpResponse = requests.get(url, headers=headers, timeout=self.timeout)
+            httpResponse = self.getSession().get(
+                url, headers=headers, timeout=self.timeout
+            )
         except requests.exceptions.ConnectionError as e:
             logger.log(
                 logging.INFO4, "Error connecting to Volkszahler to getPhotovoltaikW"
@@ -143,7 +143,9 @@ class Volkszahler:
 
         try:
             logger.debug("Fetching Volkszahler EMS sensor values")
-            httpResponse = requests.get(url, headers=headers, timeout=self.timeout)
+            httpResponse = self.getSession().get(
+                url, headers=headers, timeout=self.timeout
+            )
         except requests.exceptions.ConnectionError as e:
             logger.log(
                 logging.INFO4, "Error connecting to Volkszahler to getTotalGridW"
@@ -181,24 +183,7 @@ class Volkszahler:
                     "Did not find expected value inside of Volkszahler API response.",
                 )
 
-    def setCacheTime(self, cacheTime):
-        self.cacheTime = cacheTime
-
-    def setTimeout(self, timeout):
-        self.timeout = timeout
-
-    def update(self):
-        # Update function - determine if an update is required
-
-        if (int(time.time()) - self.lastFetch) > self.cacheTime:
-            # Cache has expired. Fetch values from Volkszahler.
-            self.getPhotovoltaikW()
-            self.getTotalGridW()
-            # Update last fetch time
-            if self.fetchFailed is not True:
-                self.lastFetch = int(time.time())
-
-            return True
-        else:
-            # Cache time has not elapsed since last fetch, serve from cache.
-            return False
+    def fetch(self):
+        # Fetch values from Volkszahler.
+        self.getPhotovoltaikW()
+        self.getTotalGridW()
@@ -0,0 +1,140 @@
+import logging
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger("\u26FD EMSPoller")
+
+
+class EMSPoller:
+    # Reads the consumption and generation values from every EMS module.
+    #
+    # Each module's values are read by a pool of worker threads, so that the
+    # modules are read at the same time rather than one after the other, and
+    # poll() waits at most pollDeadline seconds for all of them. A module
+    # which hasn't answered by then keeps its last good values, and is marked
+    # as stale. Its read carries on in the background, and its values are
+    # used by the next poll() once it finishes. A module isn't read again
+    # while a read is still in progress. A module whose cached values are
+    # too old to use (see EMS.isStale()) reads as zero, and is marked as
+    # stale.
+    #
+    # Once the deadline has passed, the values of all of the modules are
+    # passed to the master together, so that the consumption and generation
+    # figures it works with are always from the same poll.
+
+    def __init__(self, master):
+        self.master = master
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.pollDeadline = master.config["config"].get("emsPollDeadline", 5)
+        self.requests = queue.Queue()
+        self.samples = {}
+        self.workers = []
+        self.workersMax = master.config["config"].get("emsPollWorkers", 8)
+
+    def getSamples(self):
+        # Returns the last values read from each module, when they were read,
+        # how old the module's cached values were, and whether they are stale
+        with self.lock:
+            return {name: dict(sample) for name, sample in self.samples.items()}
+
+    def poll(self):
+        modules = self.master.getModulesByType("EMS")
+        self.startWorkers(len(modules))
+        deadline = time.monotonic() + self.pollDeadline
+
+        # Queue a read of each module which doesn't already have one in
+        # progress
+        requests = {}
+        with self.lock:
+            for module in modules:
+                if module["name"] not in self.inflight:
+                    request = {
+                        "done": threading.Event(),
+                        "error": None,
+                        "module": module,
+                        "values": None,
+                    }
+                    self.inflight[module["name"]] = request
+                    self.requests.put(request)
+                requests[module["name"]] = self.inflight[module["name"]]
+
+        for request in requests.values():
+            request["done"].wait(max(deadline - time.monotonic(), 0))
+
+        with self.lock:
+            for name, request in requests.items():
+                if request["done"].is_set():
+                    del self.inflight[name]
+
+                if request["done"].is_set() and not request["error"]:
+                    self.samples[name] = dict(
+                        request["values"],
+                        time=request["time"],
+                        stale=request["values"].get("stale", False),
+                    )
+                elif name in self.samples:
+                    if not self.samples[name]["stale"]:
+                        logger.info(
+                            "No new values from %s within %ss, using its last values",
+                            name,
+                            self.pollDeadline,
+                        )
+                    self.samples[name]["stale"] = True
+
+            # Forget modules which have been unloaded
+            for name in list(self.samples):
+                if name not in requests:
+                    del self.samples[name]
+
+            samples = {name: dict(sample) for name, sample in self.samples.items()}
+
+        self.master.setEMSSamples(samples)
+
+    def read(self, request):
+        module = request["module"]
+        values = {"consumption": module["ref"].getConsumption()}
+        if hasattr(module["ref"], "getConsumptionAmps"):
+            values["consumptionAmps"] = module["ref"].getConsumptionAmps()
+        values["generation"] = module["ref"].getGeneration()
+
+        # Modules which return cached values report how old they are
+        if hasattr(module["ref"], "getCacheAge"):
+            values["age"] = module["ref"].getCacheAge()
+
+        # Values which are too old to say anything about the power available
+        # now are not used, so that green energy charging backs off rather
+        # than carrying on with them
+        if hasattr(module["ref"], "isStale") and module["ref"].isStale():
+            for key in ("consumption", "consumptionAmps", "generation"):
+                if key in values:
+                    values[key] = 0
+            values["stale"] = True
+        return values
+
+    def runWorker(self):
+        while True:
+            request = self.requests.get()
+            try:
+                request["values"] = self.read(request)
+            except Exception as e:
+                request["error"] = e
+                logger.info(
+                    "Error reading values from %s: %s", request["module"]["name"], e
+                )
+            request["time"] = time.time()
+            request["done"].set()
+
+    def startWorkers(self, count):
+        # Start enough workers to read every module at the same time
+        with self.lock:
+            while len(self.workers) < min(count, self.workersMax):
+                worker = threading.Thread(
+                    target=self.runWorker,
+                    name="EMSPoll-%d" % len(self.workers),
+                    daemon=True,
+                )
+                worker.start()
+                self.workers.append(worker)
@@ -0,0 +1,105 @@
+import time
+
+
+class HeartbeatScheduler:
+    # Works out when a TWCBus should send its next message, using the
+    # monotonic clock so that the timing isn't upset when the system clock is
+    # changed.
+    #
+    # Each slave TWC is due a heartbeat every interval seconds from when it
+    # was first seen. Deadlines are kept for each slave, rather than sending
+    # one heartbeat per second in turn, so that each slave hears from us as
+    # often however many slaves share the bus, and a late heartbeat doesn't
+    # push back the ones after it.
+    #
+    # No message is sent until the bus is quiet: responseTime seconds after
+    # our last message, which gives a slave time to answer it, and quietTime
+    # seconds after we last received a message.
+    #
+    # For each slave, we count the heartbeats sent and how late they were
+    # sent. A heartbeat sent more than tolerance seconds after it was due
+    # counts as a missed deadline.
+
+    interval = 1.0
+    quietTime = 0.025
+    responseTime = 0.1
+    tolerance = 0.25
+
+    def __init__(self):
+        self.deadlines = {}
+        self.stats = {}
+        self.timeLastRx = float("-inf")
+        self.timeLastTx = float("-inf")
+
+    def forget(self, twcid):
+        self.deadlines.pop(twcid, None)
+        self.stats.pop(twcid, None)
+
+    def getNextDue(self, twcids, now):
+        # Returns the slave in twcids which is due its heartbeat first, and
+        # when it is due, or (None, None) if there are none. Slaves we haven't
+        # seen before are due straight away, and slaves which are no longer
+        # in twcids are forgotten.
+        for twcid in list(self.deadlines):
+            if twcid not in twcids:
+                self.forget(twcid)
+        for twcid in twcids:
+            if twcid not in self.deadlines:
+                self.deadlines[twcid] = now
+        if not self.deadlines:
+            return None, None
+        twcid = min(self.deadlines, key=self.deadlines.get)
+        return twcid, self.deadlines[twcid]
+
+    def getSendTime(self, due):
+        # Returns the earliest time a message which is due at due can be sent
+        return max(
+            due,
+            self.timeLastTx + self.responseTime,
+            self.timeLastRx + self.quietTime,
+        )
+
+    def getStats(self):
+        # Returns for each slave the number of heartbeats sent, how many of
+        # them missed their deadline, and the average, longest and last time
+        # they were sent after they were due, in seconds
+        return {
+            twcid: {
+                "count": stats["count"],
+                "missed": stats["missed"],
+                "jitterAvg": round(stats["total"] / stats["count"], 4),
+                "jitterMax": round(stats["max"], 4),
+                "jitterLast": round(stats["last"], 4),
+            }
+            for twcid, stats in self.stats.items()
+            if stats["count"]
+        }
+
+    def markRx(self, now=None):
+        self.timeLastRx = time.monotonic() if now is None else now
+
+    def markTx(self, now=None):
+        self.timeLastTx = time.monotonic() if now is None else now
+
+    def sent(self, twcid, now):
+        # Record that the heartbeat for twcid was sent at now, and work out
+        # when the next one is due
+        due = self.deadlines.get(twcid, now)
+        late = max(now - due, 0)
+        stats = self.stats.setdefault(
+            twcid, {"count": 0, "last": 0, "max": 0, "missed": 0, "total": 0}
+        )
+        stats["count"] += 1
+        stats["last"] = late
+        stats["max"] = max(stats["max"], late)
+        stats["total"] += late
+        if late > self.tolerance:
+            stats["missed"] += 1
+
+        # Keep to the slave's own cadence, unless we have fallen a whole
+        # interval behind, in which case start again from now rather than
+        # sending the heartbeats we missed one after another
+        due += self.interval
+        if due <= now:
+            due = now + self.interval
+        self.deadlines[twcid] = due
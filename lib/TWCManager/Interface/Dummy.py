@@ -1,5 +1,6 @@
 import logging
 import time
+from TWCManager.Protocol.SLIP import FrameReader, checksum, encode_frame
 
 logger = logging.getLogger(__name__.rsplit(".")[-1])
 
@@ -9,29 +10,42 @@ class Dummy:
     master = None
     msgBuffer = bytes()
     proto = None
+    readTimeout = 0.025
+    reader = None
+    slaveTimeout = 26
     twcID = bytearray(b"\x12\x34")
     timeLastTx = 0
 
-    def __init__(self, master):
+    def __init__(self, master, busConfig=None):
         self.master = master
         classname = self.__class__.__name__
-
-        # Unload if this module is disabled or misconfigured
-        if "interface" in master.config and classname in master.config["interface"]:
-            self.enabled = master.config["interface"][classname].get("enabled", True)
-        if not self.enabled:
-            self.master.releaseModule("lib.TWCManager.Interface", classname)
-            return None
+        configInterface = master.config.get("interface", {}).get(classname, {})
+
+        if busConfig is None:
+            # Unload if this module is disabled or misconfigured
+            if "interface" in master.config and classname in master.config["interface"]:
+                self.enabled = configInterface.get("enabled", True)
+            if not self.enabled:
+                self.master.releaseModule("lib.TWCManager.Interface", classname)
+                return None
+        else:
+            configInterface = dict(configInterface, **busConfig)
 
         # Configure the module
-        if "interface" in master.config:
-            if master.config["interface"][classname].get("twcID", False):
-                self.twcID = bytearray(
-                    str(master.config["interface"][classname].get("twcID")).encode()
-                )
+        if configInterface.get("twcID", False):
+            self.twcID = bytearray(str(configInterface.get("twcID")).encode())
+        self.slaveTimeout = configInterface.get("slaveTimeout", self.slaveTimeout)
 
         # Instantiate protocol module for sending/recieving TWC protocol
         self.proto = self.master.getModuleByName("TWCProtocol")
+        self.reader = FrameReader(master)
+
+        # Each entry in buses simulates a TWC on another load sharing network,
+        # with its own twcID
+        self.instances = [self]
+        if busConfig is None:
+            for busConfig in configInterface.get("buses", []):
+                self.instances.append(Dummy(master, busConfig))
 
     def close(self):
         # NOOP - No need to close anything
@@ -42,13 +56,20 @@ class Dummy:
         # This is used by read functions to determine if information is waiting
         return len(self.msgBuffer)
 
+    def getFileno(self):
+        # There is no real interface to wait on, so the asyncio runtime calls
+        # getFrames() in an executor instead
+        return None
+
     def send(self, msg):
         # This is the external send interface - it is called by TWCManager which expects that it is
         # talking to a live TWC. The key here is that we treat it as our reciept interface and parse
         # the message as if we are a TWC
 
-        packet = self.proto.parseMessage(msg)
-        if packet["Command"] == "MasterLinkready2":
+        # The message we are given doesn't have its checksum yet, so add it to
+        # parse the message exactly as a TWC would see it on the wire
+        packet = self.proto.parseMessage(bytes(msg) + bytes((checksum(msg),)))
+        if packet and packet.command == "MasterLinkready2":
             self.sendInternal(
                 self.proto.createMessage(
                     {
@@ -59,13 +80,13 @@ class Dummy:
                     }
                 )
             )
-        elif packet["Command"] == "MasterHeartbeat":
+        elif packet and packet.command == "MasterHeartbeat":
             self.sendInternal(
                 self.proto.createMessage(
                     {
                         "Command": "SlaveHeartbeat",
                         "SenderID": self.twcID,
-                        "RecieverID": packet["SenderID"],
+                        "RecieverID": packet.senderID,
                     }
                 )
             )
@@ -83,40 +104,22 @@ class Dummy:
         self.msgBuffer = self.msgBuffer[len:]
         return localMsgBuffer
 
+    def getFrames(self):
+        # Return the buffered messages as complete frames. We don't have a
+        # real interface to wait on, so when there is nothing buffered we
+        # sleep for readTimeout as a serial read would.
+        if not self.msgBuffer:
+            time.sleep(self.readTimeout)
+        localMsgBuffer = self.msgBuffer
+        self.msgBuffer = bytes()
+        return self.reader.feed(localMsgBuffer, time.time())
+
     def sendInternal(self, msg):
         # The sendInternal function takes a message that we would like to send
         # from the dummy module to the TWCManager, adds the required checksum,
         # updates the internal message buffer with the sent message and then
         # allows this to be polled & read by TWCManager on the next loop iteration
-
-        msg = bytearray(msg)
-        checksum = 0
-        for i in range(1, len(msg)):
-            checksum += msg[i]
-
-        msg.append(checksum & 0xFF)
-
-        # Escaping special chars:
-        # The protocol uses C0 to mark the start and end of the message.  If a C0
-        # must appear within the message, it is 'escaped' by replacing it with
-        # DB and DC bytes.
-        # A DB byte in the message is escaped by replacing it with DB DD.
-        #
-        # User FuzzyLogic found that this method of escaping and marking the start
-        # and end of messages is based on the SLIP protocol discussed here:
-        #   https://en.wikipedia.org/wiki/Serial_Line_Internet_Protocol
-
-        i = 0
-        while i < len(msg):
-            if msg[i] == 0xC0:
-                msg[i : i + 1] = b"\xdb\xdc"
-                i = i + 1
-            elif msg[i] == 0xDB:
-                msg[i : i + 1] = b"\xdb\xdd"
-                i = i + 1
-            i = i + 1
-
-        msg = bytearray(b"\xc0" + msg + b"\xc0\xfe")
+        msg = encode_frame(msg) + b"\xfe"
         logger.log(logging.INFO9, "TxInt@: " + self.master.hex_str(msg))
 
         self.msgBuffer = msg
@@ -1,5 +1,6 @@
 import logging
 import time
+from TWCManager.Protocol.SLIP import FrameReader, encode_frame
 
 logger = logging.getLogger("\U0001F50C RS485")
 
@@ -11,51 +12,73 @@ class RS485:
     enabled = True
     master = None
     port = None
+    readTimeout = 0.025
+    reader = None
     ser = None
+    slaveTimeout = 26
     timeLastTx = 0
 
-    def __init__(self, master):
+    def __init__(self, master, busConfig=None):
+        # busConfig holds the settings of another RS485 adapter, connected to
+        # its own TWC load sharing network, which are used in place of the
+        # settings of the first one
         self.master = master
         classname = self.__class__.__name__
-
-        # Unload if this module is disabled or misconfigured
-        if "interface" in master.config and classname in master.config["interface"]:
-            self.enabled = master.config["interface"][classname].get("enabled", True)
-        if not self.enabled:
-            self.master.releaseModule("lib.TWCManager.Interface", classname)
-            return None
-
-        # There are two places that the baud rate for the RS485 adapter may be stored.
-        # The first is the legacy configuration path, and the second is the new
-        # dedicated interface configuration. We check either/both for this value
-        bauda = master.config["config"].get("baud", 0)
-        baudb = None
-        if "interface" in master.config:
-            baudb = master.config["interface"]["RS485"].get("baud", 0)
-        if baudb:
-            self.baud = baudb
-        elif bauda:
-            self.baud = bauda
-
-        # Similarly, there are two places to check for a port defined.
-        porta = master.config["config"].get("rs485adapter", "")
-        portb = None
-        if "interface" in master.config:
-            portb = master.config["interface"]["RS485"].get("port", "")
-        if portb:
-            self.port = portb
-        elif porta:
-            self.port = porta
-
+        configInterface = master.config.get("interface", {}).get(classname, {})
+
+        if busConfig is None:
+            # Unload if this module is disabled or misconfigured
+            if "interface" in master.config and classname in master.config["interface"]:
+                self.enabled = configInterface.get("enabled", True)
+            if not self.enabled:
+                self.master.releaseModule("lib.TWCManager.Interface", classname)
+                return None
+
+            # There are two places that the baud rate and port for the RS485
+            # adapter may be stored. The first is the legacy configuration
+            # path, and the second is the new dedicated interface
+            # configuration. We check either/both for these values
+            self.baud = master.config["config"].get("baud", 0) or self.baud
+            self.port = master.config["config"].get("rs485adapter", "") or self.port
+        else:
+            configInterface = dict(configInterface, **busConfig)
+
+        if configInterface.get("baud", 0):
+            self.baud = configInterface["baud"]
+        if configInterface.get("port", ""):
+            self.port = configInterface["port"]
+
+        # The read timeout determines how long getFrames() will block waiting
+        # for the first byte of a message when the buffer is empty. This
+        # replaces the fixed 25ms sleep in the main loop, so that an incoming
+        # message is picked up as soon as it arrives rather than on the next
+        # loop iteration.
+        self.readTimeout = float(configInterface.get("readTimeout", self.readTimeout))
+
+        # Seconds without hearing from a slave TWC before we forget it
+        self.slaveTimeout = configInterface.get("slaveTimeout", self.slaveTimeout)
+
+        self.reader = FrameReader(master)
         self.connect()
 
+        # Each entry in buses is another RS485 adapter. Every instance is
+        # driven as a bus of its own.
+        self.instances = [self]
+        if busConfig is None:
+            for busConfig in configInterface.get("buses", []):
+                self.instances.append(RS485(master, busConfig))
+
     def connect(self):
         # Reset any Slave TWC last RX heartbeat counters in case serial reconnection has occurred
         for slaveTWC in self.master.getSlaveTWCs():
-            slaveTWC.timeLastRx = time.time()
+            if slaveTWC.bus is None or slaveTWC.bus.interface is self:
+                slaveTWC.timeLastRx = time.time()
+                slaveTWC.timeLastRxMonotonic = time.monotonic()
 
         # Connect to serial port
-        self.ser = self.serial.serial_for_url(self.port, self.baud, timeout=0)
+        self.ser = self.serial.serial_for_url(
+            self.port, self.baud, timeout=self.readTimeout
+        )
 
     def close(self):
         # Close the serial interface
@@ -66,11 +89,19 @@ class RS485:
         # This is used by read functions to determine if information is waiting
         return self.ser.inWaiting()
 
+    def getFileno(self):
+        # Returns the file descriptor of the serial port, which the asyncio
+        # runtime waits on for data to arrive, or None if it doesn't have one
+        try:
+            return self.ser.fileno()
+        except (AttributeError, OSError, ValueError):
+            return None
+
     def read(self, len):
         # Read the specified amount of data from the serial interface
         try:
             return self.ser.read(len)
-        except serial.serialutil.SerialException as e:
+        except self.serial.serialutil.SerialException as e:
             logger.log(
                 logging.ERROR,
                 "Error reading from serial interface: {}. Will attempt re-connect.".format(
@@ -79,39 +110,24 @@ class RS485:
             )
             self.connect()
 
+    def getFrames(self):
+        # Drain everything waiting in the receive buffer with a single read,
+        # and return a list of the complete messages found in it. Any partial
+        # message is kept by the frame reader until the rest of it arrives
+        # on a later call.
+        #
+        # If nothing is waiting, we block for up to readTimeout for the first
+        # byte to arrive and then collect anything else received with it.
+        data = self.read(self.getBufferLen() or 1)
+        if data and self.getBufferLen():
+            data += self.read(self.getBufferLen()) or b""
+        return self.reader.feed(data, time.time())
+
     def send(self, msg):
         # Send msg on the RS485 network. We'll escape bytes with a special meaning,
         # add a CRC byte to the message end, and add a C0 byte to the start and end
         # to mark where it begins and ends.
-
-        msg = bytearray(msg)
-        checksum = 0
-        for i in range(1, len(msg)):
-            checksum += msg[i]
-
-        msg.append(checksum & 0xFF)
-
-        # Escaping special chars:
-        # The protocol uses C0 to mark the start and end of the message.  If a C0
-        # must appear within the message, it is 'escaped' by replacing it with
-        # DB and DC bytes.
-        # A DB byte in the message is escaped by replacing it with DB DD.
-        #
-        # User FuzzyLogic found that this method of escaping and marking the start
-        # and end of messages is based on the SLIP protocol discussed here:
-        #   https://en.wikipedia.org/wiki/Serial_Line_Internet_Protocol
-
-        i = 0
-        while i < len(msg):
-            if msg[i] == 0xC0:
-                msg[i : i + 1] = b"\xdb\xdc"
-                i = i + 1
-            elif msg[i] == 0xDB:
-                msg[i : i + 1] = b"\xdb\xdd"
-                i = i + 1
-            i = i + 1
-
-        msg = bytearray(b"\xc0" + msg + b"\xc0")
+        msg = encode_frame(msg)
         logger.log(logging.INFO9, "Tx@: " + self.master.hex_str(msg))
 
         self.ser.write(msg)
@@ -1,5 +1,6 @@
 import logging
 import socket
+from TWCManager.Protocol.SLIP import FrameReader, encode_frame
 
 
 logger = logging.getLogger(__name__.rsplit(".")[-1])
@@ -12,12 +13,19 @@ class TCP:
     configTCP = None
     enabled = False
     master = None
+    nextConnect = 0
     port = 6000
+    readTimeout = 0.025
+    reader = None
+    reconnectDelay = 1
+    reconnectDelayMax = 60
     server = None
+    slaveTimeout = 26
     sock = None
     timeLastTx = 0
+    writeTimeout = 1
 
-    def __init__(self, master):
+    def __init__(self, master, busConfig=None):
         self.master = master
         self.config = master.config
         if "interface" in master.config:
@@ -25,71 +33,170 @@ class TCP:
         else:
             self.configTCP = {}
 
-        self.enabled = self.configTCP.get("enabled", False)
-        # Unload if this module is disabled or misconfigured
-        if not self.enabled:
-            self.master.releaseModule("lib.TWCManager.Interface", "TCP")
-            return None
-
-        # Create TCP socket
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if busConfig is None:
+            self.enabled = self.configTCP.get("enabled", False)
+            # Unload if this module is disabled or misconfigured
+            if not self.enabled:
+                self.master.releaseModule("lib.TWCManager.Interface", "TCP")
+                return None
+        else:
+            # busConfig holds the settings of another gateway, connected to
+            # its own TWC load sharing network
+            self.configTCP = dict(self.configTCP, **busConfig)
+
+        self.readTimeout = float(self.configTCP.get("readTimeout", self.readTimeout))
+        self.writeTimeout = float(self.configTCP.get("writeTimeout", self.writeTimeout))
+        self.reconnectDelayMax = float(
+            self.configTCP.get("reconnectDelayMax", self.reconnectDelayMax)
+        )
+        self.slaveTimeout = self.configTCP.get("slaveTimeout", self.slaveTimeout)
+        self.server = self.configTCP.get("server", self.server)
+        self.port = int(self.configTCP.get("port", self.port))
+        self.reader = FrameReader(master)
 
         # If we are configured to listen, open the listening socket
         if self.configTCP.get("listen", False):
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.bind(("localhost", self.port))
             self.sock.listen(1)
         else:
             # Connect to server
-            self.sock.connect((self.server, self.port))
+            self.connect()
+
+        # Each entry in buses is another gateway. Every instance is driven as
+        # a bus of its own.
+        self.instances = [self]
+        if busConfig is None:
+            for busConfig in self.configTCP.get("buses", []):
+                self.instances.append(TCP(master, busConfig))
 
     def close(self):
         # Close the TCP socket interface
+        if self.sock:
+            self.sock.close()
+
+    def connect(self):
+        # Connect to the server. If we can't, we try again after
+        # reconnectDelay seconds, which doubles after each failure up to
+        # reconnectDelayMax seconds.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.writeTimeout)
+        try:
+            sock.connect((self.server, self.port))
+        except OSError as e:
+            sock.close()
+            logger.log(
+                logging.INFO4,
+                "Unable to connect to %s:%d, retrying in %ds: %s",
+                self.server,
+                self.port,
+                self.reconnectDelay,
+                e,
+            )
+            self.nextConnect = self.time.monotonic() + self.reconnectDelay
+            self.reconnectDelay = min(self.reconnectDelay * 2, self.reconnectDelayMax)
+            return False
+
+        sock.settimeout(self.readTimeout)
+        self.sock = sock
+        self.reconnectDelay = 1
+        logger.log(logging.INFO4, "Connected to %s:%d", self.server, self.port)
+        return True
+
+    def disconnect(self, reason):
+        # Drop a connection which the server has closed, or which has stopped
+        # working, and connect again once reconnectDelay has passed. Part of
+        # a message may have been lost with it, so we start again with the
+        # next whole message.
+        logger.log(
+            logging.INFO4,
+            "Connection to %s:%d lost (%s), reconnecting in %ds",
+            self.server,
+            self.port,
+            reason,
+            self.reconnectDelay,
+        )
         self.sock.close()
+        self.sock = None
+        self.reader = FrameReader(self.master)
+        self.nextConnect = self.time.monotonic() + self.reconnectDelay
+        self.reconnectDelay = min(self.reconnectDelay * 2, self.reconnectDelayMax)
 
     def getBufferLen(self):
         # This function returns the size of the recieve buffer.
         # This is used by read functions to determine if information is waiting
         return 0
 
+    def getFileno(self):
+        # Returns the file descriptor of the socket, which the asyncio runtime
+        # waits on for data to arrive, or None if there is nothing to read
+        if self.configTCP.get("listen", False) or not self.sock:
+            return None
+        return self.sock.fileno()
+
     def read(self, len):
         # Read the specified amount of data from the TCP interface
         return self.sock.recv(len)
 
+    def getFrames(self):
+        # Return a list of the complete messages received since the last call.
+        # If nothing has been received, we wait for up to readTimeout for
+        # data to arrive.
+        if self.configTCP.get("listen", False):
+            # Accepting connections from a listening socket isn't supported
+            # yet, so there is nothing to read.
+            self.time.sleep(self.readTimeout)
+            return []
+
+        if not self.sock:
+            # Wait for the time to connect again to come round, for up to
+            # readTimeout
+            wait = self.nextConnect - self.time.monotonic()
+            if wait > 0:
+                self.time.sleep(min(wait, self.readTimeout))
+                return []
+            if not self.connect():
+                return []
+
+        try:
+            data = self.sock.recv(4096)
+        except socket.timeout:
+            data = b""
+        except OSError as e:
+            self.disconnect(e)
+            return []
+        else:
+            if not data:
+                # recv() only returns nothing once the server has closed the
+                # connection
+                self.disconnect("closed by server")
+                return []
+        return self.reader.feed(data, self.time.time())
+
     def send(self, msg):
         # Send msg on the RS485 network. We'll escape bytes with a special meaning,
         # add a CRC byte to the message end, and add a C0 byte to the start and end
         # to mark where it begins and ends.
-
-        msg = bytearray(msg)
-        checksum = 0
-        for i in range(1, len(msg)):
-            checksum += msg[i]
-
-        msg.append(checksum & 0xFF)
-
-        # Escaping special chars:
-        # The protocol uses C0 to mark the start and end of the message.  If a C0
-        # must appear within the message, it is 'escaped' by replacing it with
-        # DB and DC bytes.
-        # A DB byte in the message is escaped by replacing it with DB DD.
-        #
-        # User FuzzyLogic found that this method of escaping and marking the start
-        # and end of messages is based on the SLIP protocol discussed here:
-        #   https://en.wikipedia.org/wiki/Serial_Line_Internet_Protocol
-
-        i = 0
-        while i < len(msg):
-            if msg[i] == 0xC0:
-                msg[i : i + 1] = b"\xdb\xdc"
-                i = i + 1
-            elif msg[i] == 0xDB:
-                msg[i : i + 1] = b"\xdb\xdd"
-                i = i + 1
-            i = i + 1
-
-        msg = bytearray(b"\xc0" + msg + b"\xc0")
+        msg = encode_frame(msg)
         logger.log(logging.INFO9, "Tx@: " + self.master.hex_str(msg))
 
-        self.sock.send(msg)
+        if self.configTCP.get("listen", False) or not self.sock:
+            # Accepting connections isn't supported yet, so in listen mode we
+            # are never connected
+            logger.log(logging.INFO8, "Not connected, message not sent")
+            return
+
+        # Sending waits for up to writeTimeout for room in the socket's
+        # buffer, rather than readTimeout, which is too short for a
+        # connection which is busy, but still working
+        try:
+            self.sock.settimeout(self.writeTimeout)
+            self.sock.sendall(msg)
+        except OSError as e:
+            self.disconnect(e)
+            return
+        finally:
+            if self.sock:
+                self.sock.settimeout(self.readTimeout)
 
         self.timeLastTx = self.time.time()
@@ -2,15 +2,19 @@
 
 import logging
 
+from TWCManager.Logging.LogQueue import LogWriter
+
 
 class CSVLogging:
     capabilities = {"queryGreenEnergy": False}
     config = None
     configConfig = None
     configLogging = None
+    handlers = None
     openSessions = {}
     quoteColumns = True
     status = False
+    writer = None
 
     def __init__(self, master):
         self.master = master
@@ -51,7 +55,6 @@ class CSVLogging:
             datefmt="%Y-%m-%d %H:%M:%S",
         )
         green_energy_handler.setFormatter(green_energy_formatter)
-        logging.getLogger("").addHandler(green_energy_handler)
 
         slave_status_handler = logging.FileHandler(
             self.configLogging["path"] + "/slavestatus.csv"
@@ -75,7 +78,6 @@ class CSVLogging:
             style="{",
         )
         slave_status_handler.setFormatter(slave_status_formatter)
-        logging.getLogger("").addHandler(slave_status_handler)
 
         charge_sessions_handler = logging.FileHandler(
             self.configLogging["path"] + "/chargesessions.csv"
@@ -100,7 +102,30 @@ class CSVLogging:
             style="{",
         )
         charge_sessions_handler.setFormatter(charge_sessions_formatter)
-        logging.getLogger("").addHandler(charge_sessions_handler)
+
+        # Records are written to the CSV files in batches by a separate
+        # thread, which passes them to each of the handlers above
+        self.handlers = [
+            green_energy_handler,
+            slave_status_handler,
+            charge_sessions_handler,
+        ]
+        self.writer = LogWriter(
+            "CSVLogging",
+            self.writeRecords,
+            flushInterval=self.configLogging.get("flushInterval", 1),
+        )
+        self.writer.handler.addFilter(self.csv_filter)
+        logging.getLogger("").addHandler(self.writer.handler)
+
+    def csv_filter(self, record):
+        # Only queue the records which one of the CSV files is interested in.
+        # Each file's own filter is checked when the record is written.
+        return getattr(record, "logtype", "") in (
+            "charge_sessions",
+            "green_energy",
+            "slave_status",
+        )
 
     def delimit(self):
         # Return the configured delimiter
@@ -119,11 +144,15 @@ class CSVLogging:
             "GreenEnergy", 0
         ):
             return False
+        return True
 
     def getCapabilities(self, capability):
         # Allows query of module capabilities when deciding which Logging module to use
         return self.capabilities.get(capability, False)
 
+    def getQueueStats(self):
+        return self.writer.getStats()
+
     def slave_status_filter(self, record):
         log_type = getattr(record, "logtype", "")
         if log_type != "slave_status" or self.configLogging["mute"].get(
@@ -132,6 +161,16 @@ class CSVLogging:
             return False
         return True
 
+    def writeRecords(self, records):
+        # Called by the writer thread with a batch of records. Each file is
+        # flushed once per batch, rather than after every record.
+        for record in records:
+            for handler in self.handlers:
+                if handler.filter(record):
+                    handler.stream.write(handler.format(record) + handler.terminator)
+        for handler in self.handlers:
+            handler.flush()
+
     def charge_sessions_filter(self, record):
         log_type = getattr(record, "logtype", "")
         # Check if this status is muted or it is not the correct log type
@@ -0,0 +1,138 @@
+# Queued logging for the Logging modules which record statistics to a
+# database or file.
+#
+# Records are placed on a queue by the thread which logs them, which is often
+# the main loop talking to the TWCs, and are written by a separate thread.
+# That thread groups the records which arrive within flushInterval seconds of
+# each other and writes them together, so that each backend can write a batch
+# of records in a single transaction, and a slow SD card or unreachable
+# database server doesn't hold up the thread which logged the record.
+#
+# This module is shared by the Logging modules, and is not loaded as a module
+# of its own.
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__.rsplit(".")[-1])
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # Places records on the LogWriter's queue. If the queue is full the record
+    # is discarded and counted, rather than blocking the thread logging it.
+
+    def __init__(self, writer):
+        logging.handlers.QueueHandler.__init__(self, writer.queue)
+        self.writer = writer
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.writer.recordDropped()
+
+
+class LogWriter:
+    # Takes records from the queue and passes them to write() in batches.
+    # A batch starts with the first record to arrive after the last one was
+    # written, and is written flushInterval seconds later along with every
+    # record which has arrived in the meantime, or as soon as it holds
+    # maxBatch records.
+
+    maxBatch = 500
+
+    def __init__(self, name, write, flushInterval=1, queueMax=1000):
+        self.name = name
+        self.write = write
+        self.flushInterval = flushInterval
+        self.queue = queue.Queue(queueMax)
+        self.handler = LogQueueHandler(self)
+
+        self.statsLock = threading.Lock()
+        self.dropped = 0
+        self.flushes = 0
+        self.flushLatency = 0
+        self.flushLatencyMax = 0
+        self.records = 0
+
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+        # Write any records which are still queued when we exit
+        atexit.register(self.stop)
+
+    def getStats(self):
+        # Returns the number of records waiting to be written, how long the
+        # last and the slowest write took in seconds, and counts of batches
+        # and records written and records dropped as the queue was full
+        with self.statsLock:
+            return {
+                "queueDepth": self.queue.qsize(),
+                "flushLatency": round(self.flushLatency, 4),
+                "flushLatencyMax": round(self.flushLatencyMax, 4),
+                "flushes": self.flushes,
+                "records": self.records,
+                "dropped": self.dropped,
+            }
+
+    def recordDropped(self):
+        with self.statsLock:
+            self.dropped += 1
+            dropped = self.dropped
+
+        # Report the first dropped record, and every thousandth after that
+        if dropped % 1000 == 1:
+            logger.info(
+                "%s log queue is full, %d records have been dropped",
+                self.name,
+                dropped,
+            )
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            record = self.queue.get()
+            if record is None:
+                return
+
+            batch = [record]
+            deadline = time.monotonic() + self.flushInterval
+            while len(batch) < self.maxBatch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+
+            start = time.monotonic()
+            try:
+                self.write(batch)
+            except Exception as e:
+                logger.error(
+                    "Error writing %d records to %s: %s", len(batch), self.name, e
+                )
+            latency = time.monotonic() - start
+
+            with self.statsLock:
+                self.flushes += 1
+                self.records += len(batch)
+                self.flushLatency = latency
+                self.flushLatencyMax = max(self.flushLatencyMax, latency)
+
+    def stop(self, timeout=5):
+        # Ask the writer thread to write what is queued and finish
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
@@ -1,20 +1,52 @@
 # MySQLLogging module. Provides output to a MySQL Server for regular statistics
 # recording.
 import logging
+import threading
+from datetime import datetime
+
+from TWCManager.Logging.LogQueue import LogWriter
 
 
 logger = logging.getLogger(__name__.rsplit(".")[-1])
 
 
-class MySQLHandler(logging.Handler):
+class MySQLHandler:
+    # Writes the records queued by LogWriter to the MySQL database. Each batch
+    # of records is written in a single transaction. The connection is shared
+    # with MySQLLogging's queries, so it is only used while holding dbLock.
     slaveSession = {}
 
-    def __init__(self, db):
-        logging.Handler.__init__(self)
+    def __init__(self, db, dbLock):
         self.db = db
+        self.dbLock = dbLock
+
+    def writeRecords(self, records):
+        with self.dbLock:
+            # Ensure database connection is alive, or reconnect if not
+            try:
+                self.db.ping(reconnect=True)
+            except pymysql.err.OperationalError as e:
+                logger.info("Error connecting to MySQL database. %s", str(e))
+                return
 
-    def emit(self, record):
-        self.format(record)
+            cur = self.db.cursor()
+            for record in records:
+                try:
+                    self.writeRecord(cur, record)
+                except Exception as e:
+                    logger.error("Error updating MySQL database: %s", e)
+
+            try:
+                self.db.commit()
+            except pymysql.err.MySQLError as e:
+                logger.error("Error updating MySQL database: %s", e)
+                self.db.rollback()
+            cur.close()
+
+    def writeRecord(self, cur, record):
+        # The time each record was logged is passed to the database, as the
+        # batch containing it may be written some time later.
+        logTime = datetime.fromtimestamp(record.created)
         log_type = getattr(record, "logtype", "")
         if log_type == "charge_sessions":
             charge_state = getattr(record, "chargestate", "")
@@ -28,37 +60,19 @@ class MySQLHandler(logging.Handler):
 
                 query = """
                     INSERT INTO charge_sessions (chargeid, startTime, startkWh, slaveTWC)
-                    VALUES (%s,now(),%s,%s)
+                    VALUES (%s,%s,%s,%s)
                 """
-
-                # Ensure database connection is alive, or reconnect if not
-                try:
-                    self.db.ping(reconnect=True)
-                except pymysql.err.OperationalError as e:
-                    logger.info("Error connecting to MySQL database. %s", str(e))
-                    return
-
-                cur = self.db.cursor()
-                rows = 0
-                try:
-                    rows = cur.execute(
-                        query,
-                        (
-                            getattr(record, "startTime", 0),
-                            getattr(record, "startkWh", 0),
-                            twcid,
-                        ),
-                    )
-                except Exception as e:
-                    logger.error("Error updating MySQL database: %s", e)
-                if rows:
-                    # Query was successful. Commit
-                    self.db.commit()
-                else:
-                    # Issue, log message and rollback
+                rows = cur.execute(
+                    query,
+                    (
+                        getattr(record, "startTime", 0),
+                        logTime,
+                        getattr(record, "startkWh", 0),
+                        twcid,
+                    ),
+                )
+                if not rows:
                     logger.info("Error updating MySQL database. Rows = %d", rows)
-                    self.db.rollback()
-                cur.close()
             elif charge_state == "update":
                 # Called when additional information needs to be updated for a
                 # charge session
@@ -72,29 +86,9 @@ class MySQLHandler(logging.Handler):
                         UPDATE charge_sessions SET vehicleVIN = %s
                         WHERE chargeid = %s AND slaveTWC = %s
                     """
-
-                    # Ensure database connection is alive, or reconnect if not
-                    try:
-                        self.db.ping(reconnect=True)
-                    except pymysql.err.OperationalError as e:
-                        logger.info("Error connecting to MySQL database. %s", str(e))
-                        return
-
-                    cur = self.db.cursor()
-                    rows = 0
-                    try:
-                        rows = cur.execute(
-                            query, (getattr(record, "vehicleVIN", ""), chgid, twcid)
-                        )
-                    except Exception as e:
-                        logger.error("Error updating MySQL database: %s", e)
-                    if rows:
-                        # Query was successful. Commit
-                        self.db.commit()
-                    else:
-                        # Issue, log message and rollback
-                        self.db.rollback()
-                    cur.close()
+                    cur.execute(
+                        query, (getattr(record, "vehicleVIN", ""), chgid, twcid)
+                    )
             elif charge_state == "stop":
                 # Called when a Charge Session Ends.
                 twcid = "%02X%02X" % (
@@ -103,73 +97,57 @@ class MySQLHandler(logging.Handler):
                 )
                 chgid = self.slaveSession.get(twcid, 0)
                 query = """
-                    UPDATE charge_sessions SET endTime = now(), endkWh = %s
+                    UPDATE charge_sessions SET endTime = %s, endkWh = %s
                     WHERE chargeid = %s AND slaveTWC = %s
                 """
-
-                # Ensure database connection is alive, or reconnect if not
-                try:
-                    self.db.ping(reconnect=True)
-                except pymysql.err.OperationalError as e:
-                    logger.info("Error connecting to MySQL database. %s", str(e))
-                    return
-
-                cur = self.db.cursor()
-                rows = 0
-                try:
-                    rows = cur.execute(
-                        query,
-                        (
-                            getattr(record, "endkWh", 0),
-                            chgid,
-                            twcid,
-                        ),
-                    )
-                except Exception as e:
-                    logger.error("Error updating MySQL database: %s", e)
-                if rows:
-                    # Query was successful. Commit
-                    self.db.commit()
-                else:
-                    # Issue, log message and rollback
+                rows = cur.execute(
+                    query,
+                    (
+                        logTime,
+                        getattr(record, "endkWh", 0),
+                        chgid,
+                        twcid,
+                    ),
+                )
+                if not rows:
                     logger.error("Error updating MySQL database. Rows = %d", rows)
-                    self.db.rollback()
-                cur.close()
                 self.slaveSession[twcid] = 0
         elif log_type == "green_energy":
-            # Ensure database connection is alive, or reconnect if not
-            try:
-                self.db.ping(reconnect=True)
-            except pymysql.err.OperationalError as e:
-                logger.info("Error connecting to MySQL database. %s", str(e))
-                return
-
             query = """
                 INSERT INTO green_energy (time, genW, conW, chgW)
-                VALUES (now(), %s, %s, %s)
+                VALUES (%s, %s, %s, %s)
             """
-
-            cur = self.db.cursor()
-            rows = 0
-            try:
-                rows = cur.execute(
-                    query,
-                    (
-                        getattr(record, "genWatts", 0),
-                        getattr(record, "conWatts", 0),
-                        getattr(record, "chgWatts", 0),
-                    ),
-                )
-            except Exception as e:
-                logger.error("Error updating MySQL database: %s", e)
-            if rows:
-                # Query was successful. Commit
-                self.db.commit()
-            else:
-                # Issue, log message and rollback
+            rows = cur.execute(
+                query,
+                (
+                    logTime,
+                    getattr(record, "genWatts", 0),
+                    getattr(record, "conWatts", 0),
+                    getattr(record, "chgWatts", 0),
+                ),
+            )
+            if not rows:
+                logger.info("Error updating MySQL database. Rows = %d" % rows)
+        elif log_type == "slave_status":
+            query = """
+                INSERT INTO slave_status (slaveTWC, time, kWh, voltsPhaseA,
+                voltsPhaseB, voltsPhaseC)
+                VALUES (%s, %s, %s, %s, %s, %s);
+            """
+            rows = cur.execute(
+                query,
+                (
+                    "%02X%02X"
+                    % (getattr(record, "TWCID")[0], getattr(record, "TWCID")[1]),
+                    logTime,
+                    getattr(record, "kWh", 0),
+                    getattr(record, "voltsPerPhase")[0],
+                    getattr(record, "voltsPerPhase")[1],
+                    getattr(record, "voltsPerPhase")[2],
+                ),
+            )
+            if not rows:
                 logger.info("Error updating MySQL database. Rows = %d" % rows)
-                self.db.rollback()
-            cur.close()
 
 
 class MySQLLogging:
@@ -178,7 +156,9 @@ class MySQLLogging:
     configConfig = None
     configLogging = None
     db = None
+    dbLock = None
     status = False
+    writer = None
 
     def __init__(self, master):
         self.master = master
@@ -218,14 +198,27 @@ class MySQLLogging:
             logger.info("Error connecting to MySQL database")
             logger.info(str(e))
         else:
-            mysql_handler = MySQLHandler(db=self.db)
-            mysql_handler.addFilter(self.mysql_filter)
-            logging.getLogger("").addHandler(mysql_handler)
+            # Records are written to the database in batches by a separate
+            # thread
+            self.dbLock = threading.Lock()
+            mysql_handler = MySQLHandler(db=self.db, dbLock=self.dbLock)
+            self.writer = LogWriter(
+                "MySQLLogging",
+                mysql_handler.writeRecords,
+                flushInterval=self.configLogging.get("flushInterval", 1),
+            )
+            self.writer.handler.addFilter(self.mysql_filter)
+            logging.getLogger("").addHandler(self.writer.handler)
 
     def getCapabilities(self, capability):
         # Allows query of module capabilities when deciding which Logging module to use
         return self.capabilities.get(capability, False)
 
+    def getQueueStats(self):
+        if not self.writer:
+            return None
+        return self.writer.getStats()
+
     def mysql_filter(self, record):
         log_type = getattr(record, "logtype", "")
         # Check if this status is muted or it is not the correct log type
@@ -250,6 +243,11 @@ class MySQLLogging:
         if self.configLogging["mute"].get("GreenEnergy", 0):
             return None
 
+        # The connection is shared with the writer thread
+        with self.dbLock:
+            return self.queryGreenEnergyLocked(data)
+
+    def queryGreenEnergyLocked(self, data):
         # Ensure database connection is alive, or reconnect if not
         try:
             self.db.ping(reconnect=True)
@@ -278,46 +276,3 @@ class MySQLLogging:
                 logger.error("Error query MySQL database. Rows = %d", rows)
             cur.close()
         return list(result)
-
-    def slaveStatus(self, data):
-        # Check if this status is muted
-        if self.configLogging["mute"].get("SlaveStatus", 0):
-            return None
-
-        # Ensure database connection is alive, or reconnect if not
-        try:
-            self.db.ping(reconnect=True)
-        except pymysql.err.OperationalError as e:
-            logger.info("Error connecting to MySQL database. %s", str(e))
-            return
-
-        # Otherwise, add to database
-        cursor = self.db.cursor()
-        query = """
-            INSERT INTO slave_status (slaveTWC, time, kWh, voltsPhaseA,
-            voltsPhaseB, voltsPhaseC)
-            VALUES (%s, now(), %s, %s, %s, %s);
-        """
-        rows = 0
-        try:
-            rows = cursor.execute(
-                query,
-                (
-                    "%02X%02X" % (data["TWCID"][0], data["TWCID"][1]),
-                    data["kWh"],
-                    data["voltsPerPhase"][0],
-                    data["voltsPerPhase"][1],
-                    data["voltsPerPhase"][2],
-                ),
-            )
-        except Exception as e:
-            logger.info("Error updating MySQL database")
-            logger.info(str(e))
-        if rows:
-            # Query was successful. Commit
-            self.db.commit()
-        else:
-            # Issue, log message and rollback
-            logger.info("Error updating MySQL database. Rows = %d" % rows)
-            self.db.rollback()
-        cursor.close()
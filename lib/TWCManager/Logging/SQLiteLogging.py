@@ -1,12 +1,18 @@
 # SQLiteLogging module. Provides output to SQLite Database for regular stats
 import logging
 
+from TWCManager.Logging.LogQueue import LogWriter
+
 logger = logging.getLogger(__name__.rsplit(".")[-1])
 
 
-class SQLiteHandler(logging.Handler):
+class SQLiteHandler:
+    # Writes the records queued by LogWriter to the SQLite database. Each
+    # batch of records is written in a single transaction, using a connection
+    # which is kept open by the writer thread.
+
     def __init__(self, db):
-        logging.Handler.__init__(self)
+        self.conn = None
         self.db = db
         # Initialize the database schema for a database that does not
         # yet exist
@@ -54,11 +60,36 @@ class SQLiteHandler(logging.Handler):
             conn.execute(query_green_energy)
             conn.execute(query_slave_status)
             conn.commit()
+            conn.close()
         else:
             logger.error("SQLite connection is null")
 
-    def emit(self, record):
-        self.format(record)
+    def writeRecords(self, records):
+        # Called by the writer thread with a batch of records. SQLite
+        # connections can only be used by the thread which opened them, so
+        # the connection is opened here rather than in __init__.
+        if not self.conn:
+            try:
+                self.conn = sqlite3.connect(self.db, uri=True)
+            except sqlite3.OperationalError as e:
+                logger.info("Error opening SQLite database: %s", e)
+                return
+
+        for record in records:
+            try:
+                self.writeRecord(record)
+            except sqlite3.Error as e:
+                logger.info("Error updating SQLite database: %s", e)
+
+        try:
+            self.conn.commit()
+        except sqlite3.Error as e:
+            # Reopen the database for the next batch
+            logger.info("Error updating SQLite database: %s", e)
+            self.conn.close()
+            self.conn = None
+
+    def writeRecord(self, record):
         log_type = getattr(record, "logtype", "")
         if log_type == "charge_sessions":
             charge_state = getattr(record, "chargestate", "")
@@ -70,8 +101,7 @@ class SQLiteHandler(logging.Handler):
                 )
 
                 query = "INSERT INTO charge_sessions (startTime, startkWh, slaveTWC) values (?,?,?)"
-                conn = sqlite3.connect(self.db, uri=True)
-                conn.execute(
+                self.conn.execute(
                     query,
                     (
                         getattr(record, "startTime", 0),
@@ -79,7 +109,6 @@ class SQLiteHandler(logging.Handler):
                         twcid,
                     ),
                 )
-                conn.commit()
             elif charge_state == "update":
                 # Called when additional information needs to be updated for a
                 # charge session
@@ -93,9 +122,7 @@ class SQLiteHandler(logging.Handler):
                     query = (
                         "UPDATE charge_sessions SET vehicleVIN = ? WHERE slaveTWC = ?"
                     )
-                    conn = sqlite3.connect(self.db, uri=True)
-                    conn.execute(query, (getattr(record, "vehicleVIN", "")))
-                    conn.commit()
+                    self.conn.execute(query, (getattr(record, "vehicleVIN", ""), twcid))
             elif charge_state == "stop":
                 # Called when a Charge Session Ends.
                 twcid = "%02X%02X" % (
@@ -103,8 +130,7 @@ class SQLiteHandler(logging.Handler):
                     getattr(record, "TWCID")[1],
                 )
                 query = "UPDATE charge_sessions SET endTime = ?, endkWh = ? WHERE slaveTWC = ?"
-                conn = sqlite3.connect(self.db, uri=True)
-                conn.execute(
+                self.conn.execute(
                     query,
                     (
                         getattr(record, "endTime", 0),
@@ -112,34 +138,40 @@ class SQLiteHandler(logging.Handler):
                         twcid,
                     ),
                 )
-                conn.commit()
         elif log_type == "green_energy":
+            # The time is taken from the record, as the batch containing it
+            # may be written some time after it was logged.
             query = """
                 INSERT INTO green_energy (time, genW, conW, chgW)
-                VALUES (datetime('now'), ?, ?, ?)
+                VALUES (datetime(?, 'unixepoch'), ?, ?, ?)
             """
-
-            rows = 0
-            try:
-                conn = sqlite3.connect(self.db, uri=True)
-                rows = conn.execute(
-                    query,
-                    (
-                        getattr(record, "genWatts", 0),
-                        getattr(record, "conWatts", 0),
-                        getattr(record, "chgWatts", 0),
-                    ),
-                )
-            except Exception as e:
-                logger.info("Error updating SQLite database: %s", e)
-            else:
-                if rows:
-                    # Query was successful. Commit
-                    conn.commit()
-                else:
-                    # Issue, log message and rollback
-                    logger.info("Error updating SQLite database. Rows = %d" % rows)
-                    conn.rollback()
+            self.conn.execute(
+                query,
+                (
+                    int(record.created),
+                    getattr(record, "genWatts", 0),
+                    getattr(record, "conWatts", 0),
+                    getattr(record, "chgWatts", 0),
+                ),
+            )
+        elif log_type == "slave_status":
+            query = """
+                INSERT INTO slave_status (slaveTWC, time, kWh, voltsPhaseA,
+                voltsPhaseB, voltsPhaseC)
+                VALUES (?, datetime(?, 'unixepoch'), ?, ?, ?, ?)
+            """
+            self.conn.execute(
+                query,
+                (
+                    "%02X%02X"
+                    % (getattr(record, "TWCID")[0], getattr(record, "TWCID")[1]),
+                    int(record.created),
+                    getattr(record, "kWh", 0),
+                    getattr(record, "voltsPerPhase")[0],
+                    getattr(record, "voltsPerPhase")[1],
+                    getattr(record, "voltsPerPhase")[2],
+                ),
+            )
 
 
 class SQLiteLogging:
@@ -149,6 +181,7 @@ class SQLiteLogging:
     configLogging = None
     db = None
     status = False
+    writer = None
 
     def __init__(self, master):
         self.master = master
@@ -177,13 +210,23 @@ class SQLiteLogging:
 
         self.db = self.configLogging["path"]
         sqlite_handler = SQLiteHandler(db=self.db)
-        sqlite_handler.addFilter(self.sqlite_filter)
-        logging.getLogger("").addHandler(sqlite_handler)
+
+        # Records are written to the database in batches by a separate thread
+        self.writer = LogWriter(
+            "SQLiteLogging",
+            sqlite_handler.writeRecords,
+            flushInterval=self.configLogging.get("flushInterval", 1),
+        )
+        self.writer.handler.addFilter(self.sqlite_filter)
+        logging.getLogger("").addHandler(self.writer.handler)
 
     def getCapabilities(self, capability):
         # Allows query of module capabilities when deciding which Logging module to use
         return self.capabilities.get(capability, False)
 
+    def getQueueStats(self):
+        return self.writer.getStats()
+
     def sqlite_filter(self, record):
         log_type = getattr(record, "logtype", "")
         # Check if this status is muted or it is not the correct log type
@@ -1,4 +1,6 @@
 import logging
+import operator
+import threading
 import time
 
 
@@ -37,13 +39,12 @@ class Policy:
         },
         # If we are within Track Green Energy schedule, charging will be
         # performed based on the amount of solar energy being produced.
-        # Don't bother to check solar generation before 6am or after
-        # 8pm. Sunrise in most U.S. areas varies from a little before
-        # 6am in Jun to almost 7:30am in Nov before the clocks get set
-        # back an hour. Sunset can be ~4:30pm to just after 8pm.
+        # Don't bother to check solar generation before sunrise or after
+        # sunset, which are worked out each day for the home location
+        # (or taken to be 6am and 8pm until home is known).
         {
             "name": "Track Green Energy",
-            "match": ["tm_hour", "tm_hour", "settings.hourResumeTrackGreenEnergy"],
+            "match": ["hourOfDay", "hourOfDay", "settings.hourResumeTrackGreenEnergy"],
             "condition": ["gte", "lt", "lte"],
             "value": ["settings.sunrise", "settings.sunset", "tm_hour"],
             "background_task": "checkGreenEnergy",
@@ -75,14 +76,46 @@ class Policy:
         },
     ]
     charge_policy = default_policy[:]
+    compiled_policy = []
+    compiled_values = {}
     lastPolicyCheck = 0
+    lastPolicyInputs = None
     limitOverride = False
     master = None
+    # Least number of seconds between evaluations of the policy when its
+    # inputs change, so that inputs which change on every heartbeat (such as
+    # EMS values) don't have it evaluated over and over
+    minPolicyCheckInterval = 5
+    nextPolicyCheck = 0
     policyCheckInterval = 30
+    policyCheckTimer = None
+    policyDependencies = None
+
+    # Comparisons available to policy conditions
+    operators = {
+        "gt": operator.gt,
+        "gte": operator.ge,
+        "lt": operator.lt,
+        "lte": operator.le,
+        "eq": operator.eq,
+        "ne": operator.ne,
+    }
+
+    # Functions which policy values can call, and the time component which
+    # their result depends on, so that policies using them are re-evaluated
+    # when it changes
+    timeDependentFunctions = {"checkScheduledCharging()": "tm_min"}
+
+    # Functions whose result depends on the amps the policy itself last set,
+    # so they change every time the policy is enforced. They are never
+    # treated as inputs, as evaluating the policy because they changed would
+    # feed its own output back in.
+    selfReferentialFunctions = ("getMaxAmpsToDivideGreenEnergy()",)
 
     def __init__(self, master):
         self.master = master
         self.config = self.master.config
+        self.lock = threading.RLock()
 
         # Override Charge Policy if specified
         config_policy = self.config.get("policy")
@@ -128,12 +161,16 @@ class Policy:
             if policy_engine:
                 if policy_engine.get("policyCheckInterval"):
                     self.policyCheckInterval = policy_engine.get("policyCheckInterval")
+                self.minPolicyCheckInterval = policy_engine.get(
+                    "minPolicyCheckInterval", self.minPolicyCheckInterval
+                )
+
+        self.compilePolicies()
 
     def applyPolicyImmediately(self):
-        self.lastPolicyCheck = 0
-        self.setChargingPerPolicy()
+        self.setChargingPerPolicy(force=True)
 
-    def setChargingPerPolicy(self):
+    def setChargingPerPolicy(self, force=False):
         # This function is called for the purpose of evaluating the charging
         # policy and matching the first rule which matches our scenario.
 
@@ -141,15 +178,46 @@ class Policy:
         # share based on the policy, we call setMaxAmpsToDivideAmongSlaves to
         # distribute the designated power amongst slaves.
 
-        # First, determine if it has been less than 30 seconds since the last
-        # policy check. If so, skip for now
-        if (self.lastPolicyCheck + self.policyCheckInterval) > time.time():
-            return
-        else:
-            # Update last policy check time
-            self.lastPolicyCheck = time.time()
+        # This is called on every slave heartbeat, but the policy is only
+        # evaluated when one of the settings, config values, module values
+        # or functions its conditions read has changed (at most once every
+        # minPolicyCheckInterval seconds), when a time it depends on (such
+        # as the start of the next hour, or chargeNowTimeEnd) has arrived, or
+        # policyCheckInterval seconds after it was last evaluated, so that the
+        # background task of the active policy keeps running.
+        with self.lock:
+            now = time.time()
+            inputs = self.getPolicyInputs()
+            if not force and inputs == self.lastPolicyInputs:
+                if now < self.nextPolicyCheck:
+                    self.setPolicyCheckTimer(now)
+                    return
+            elif not force and now < self.lastPolicyCheck + self.minPolicyCheckInterval:
+                # The inputs have changed, but the policy was evaluated only
+                # moments ago, so evaluate it again once minPolicyCheckInterval
+                # has passed
+                self.nextPolicyCheck = min(
+                    self.nextPolicyCheck,
+                    self.lastPolicyCheck + self.minPolicyCheckInterval,
+                )
+                self.setPolicyCheckTimer(now)
+                return
+            else:
+                logger.log(logging.INFO8, "Policy inputs have changed.")
 
-        for policy in self.charge_policy:
+            self.lastPolicyCheck = now
+            self.lastPolicyInputs = inputs
+            self.evaluatePolicy()
+
+            # Evaluate the policy again once policyCheckInterval has passed,
+            # or sooner if a time it depends on arrives first
+            self.nextPolicyCheck = min(
+                self.getNextPolicyBoundary(now), now + self.policyCheckInterval
+            )
+            self.setPolicyCheckTimer(now)
+
+    def evaluatePolicy(self):
+        for policy, compiled in self.compiled_policy:
             # Check if the policy is within its latching period
             latched = False
             if "__latchTime" in policy:
@@ -158,9 +226,7 @@ class Policy:
                 else:
                     del policy["__latchTime"]
 
-            matched = self.checkConditions(
-                policy["match"], policy["condition"], policy["value"]
-            )
+            matched = compiled["conditions"]()
 
             if latched or matched:
                 # Yes, we will now enforce policy
@@ -181,7 +247,257 @@ class Policy:
         # No policy has matched; keep the current policy
         self.enforcePolicy(self.getPolicyByName(self.active_policy))
 
+    def checkPolicyTimer(self):
+        # Called by the checkPolicy background task, when the policy is next
+        # due to be evaluated. A newer timer may have been merged into the
+        # task, so the timer is cleared whichever time it was queued for, and
+        # set again for the next check if needed.
+        with self.lock:
+            self.policyCheckTimer = None
+            self.setChargingPerPolicy()
+
+    def getPolicyInputs(self):
+        # Returns the current value of every setting, config value, module
+        # value and function which the policies read
+        return tuple(getValue() for getValue in self.policyDependencies["inputs"])
+
+    def getHourOfDay(self, lt):
+        # Returns the time in hours after midnight, eg. 6.5 at 6:30
+        return lt.tm_hour + lt.tm_min / 60
+
+    def getNextPolicyBoundary(self, now):
+        # Returns the next time at which the result of the policy may change
+        # without any of its inputs changing
+        boundaries = []
+        lt = time.localtime(now)
+        start = now - (now % 1)
+        for component in self.policyDependencies["time"]:
+            if component == "tm_sec":
+                boundaries.append(start + 1)
+            elif component == "tm_min":
+                boundaries.append(start - lt.tm_sec + 60)
+            elif component in ("tm_hour", "tm_isdst"):
+                boundaries.append(start - lt.tm_sec - (lt.tm_min * 60) + 3600)
+            else:
+                # The date changes at midnight
+                boundaries.append(
+                    time.mktime(
+                        (lt.tm_year, lt.tm_mon, lt.tm_mday + 1, 0, 0, 0, 0, 0, -1)
+                    )
+                )
+
+        # Times compared with "now", such as chargeNowTimeEnd
+        for getTime in self.policyDependencies["boundaries"]:
+            try:
+                boundary = float(getTime())
+            except (TypeError, ValueError):
+                continue
+            if boundary > now:
+                boundaries.append(boundary)
+
+        # The end of a policy's latch period
+        for policy in self.charge_policy:
+            if policy.get("__latchTime", 0) > now:
+                boundaries.append(policy["__latchTime"])
+
+        return min(boundaries, default=float("inf"))
+
+    def setPolicyCheckTimer(self, now):
+        # Queue a checkPolicy task for the time at which the policy is next
+        # due to be evaluated, unless one is already queued for then or sooner
+        if self.policyCheckTimer is not None and (
+            self.policyCheckTimer <= self.nextPolicyCheck
+        ):
+            return
+        self.policyCheckTimer = self.nextPolicyCheck
+        self.master.queue_background_task(
+            {"cmd": "checkPolicy", "due": self.nextPolicyCheck},
+            max(self.nextPolicyCheck - now, 0),
+        )
+
+    def compilePolicies(self):
+        # Resolve the match, condition and value of each policy, and the
+        # values it charges with, into functions once, so that evaluating
+        # the policy doesn't need to interpret them each time. While doing
+        # so, collect the inputs and times which the conditions depend on.
+        # The values the policy charges with aren't inputs: they are read
+        # each time the policy is enforced, and charge_amps usually depends
+        # on the amps the policy last set.
+        self.compiled_policy = []
+        self.compiled_values = {}
+        dependencies = {"boundaries": [], "inputs": {}, "time": set()}
+        for policy in self.charge_policy:
+            compiled = {
+                "conditions": self.compileConditions(
+                    policy["match"],
+                    policy["condition"],
+                    policy["value"],
+                    dependencies=dependencies,
+                ),
+                "allowed_flex": self.compileValue(policy.get("allowed_flex", 0)),
+                "charge_amps": self.compileValue(policy.get("charge_amps", 0)),
+                "charge_limit": self.compileValue(policy.get("charge_limit", -1)),
+            }
+            self.compiled_policy.append((policy, compiled))
+            self.compiled_values[id(policy)] = compiled
+
+        self.policyDependencies = {
+            "boundaries": tuple(dependencies["boundaries"]),
+            "inputs": tuple(dependencies["inputs"].values()),
+            "time": frozenset(dependencies["time"]),
+        }
+        self.lastPolicyInputs = None
+
+    def getCompiledPolicy(self, policy):
+        compiled = self.compiled_values.get(id(policy), None)
+        if compiled is None:
+            # The policy wasn't in charge_policy when it was compiled
+            self.compilePolicies()
+            compiled = self.compiled_values.get(id(policy), None)
+        return compiled
+
+    def compileCondition(self, match, condition, value, exitOn, dependencies=None):
+        # Returns a function which evaluates a single policy condition
+        if all([isinstance(a, list) for a in (match, condition, value)]):
+            return self.compileConditions(
+                match, condition, value, not exitOn, dependencies
+            )
+
+        if condition == "false":
+            # Condition: false is a method to ensure a policy entry
+            # is never matched, possibly for testing purposes
+            return lambda: False
+        elif condition == "none":
+            # No condition exists.
+            return lambda: True
+        elif condition not in self.operators:
+            logger.error("Unknown policy condition %s", condition)
+
+            def unknownCondition():
+                raise ValueError("Unknown condition " + str(condition))
+
+            return unknownCondition
+
+        compare = self.operators[condition]
+        getMatch = self.compileValue(match, dependencies)
+        getValue = self.compileValue(value, dependencies)
+
+        # A time compared with "now" is when the condition may change
+        if dependencies is not None:
+            if match == "now":
+                dependencies["boundaries"].append(getValue)
+            elif value == "now":
+                dependencies["boundaries"].append(getMatch)
+
+        def checkCondition():
+            matchValue = getMatch()
+            value = getValue()
+            logger.log(
+                logging.INFO8,
+                "Evaluating Policy match (%s [%s]), condition (%s), value (%s)",
+                match,
+                matchValue,
+                condition,
+                value,
+                extra={"colored": "red"},
+            )
+            return compare(matchValue, value)
+
+        return checkCondition
+
+    # exitOn = False returns True if all conditions are True, else False ==> AND
+    # exitOn = True returns True if any condition is True, else False ==> OR
+    def compileConditions(
+        self, matches, conditions, values, exitOn=False, dependencies=None
+    ):
+        checks = tuple(
+            self.compileCondition(match, condition, value, exitOn, dependencies)
+            for match, condition, value in zip(matches, conditions, values)
+        )
+
+        def checkConditions():
+            for check in checks:
+                if check() == exitOn:
+                    return exitOn
+            return not exitOn
+
+        return checkConditions
+
+    def compileValue(self, value, dependencies=None):
+        # Returns a function which returns the current value of a policy
+        # value. Policy values can be macros which refer to things such as
+        # EMS module values or settings. This allows us to control charging
+        # via policy.
+        #
+        # If dependencies is given, macros which read an input are added to
+        # its inputs, and macros which read the time to its time components.
+
+        # Anything other than a string can only be a literal value
+        if not isinstance(value, str):
+            return lambda: value
+
+        # If value is "now", substitute with current timestamp
+        if value == "now":
+            return time.time
+
+        # If value is "hourOfDay", substitute with the current time in hours
+        # after midnight, to the minute
+        if value == "hourOfDay":
+            if dependencies is not None:
+                dependencies["time"].add("tm_min")
+            return lambda: self.getHourOfDay(time.localtime())
+
+        # If value is "tm_*", substitute with time component
+        if value.startswith("tm_") and hasattr(time.localtime(), value):
+            if dependencies is not None:
+                dependencies["time"].add(value)
+            getTimeComponent = operator.attrgetter(value)
+            return lambda: getTimeComponent(time.localtime())
+
+        getValue = None
+
+        # The remaining checks are case-sensitive!
+        #
+        # If value refers to a function, execute the function and capture the
+        # output
+        if value == "getMaxAmpsToDivideGreenEnergy()":
+            getValue = self.master.getMaxAmpsToDivideGreenEnergy
+        elif value == "checkScheduledCharging()":
+            getValue = self.master.checkScheduledCharging
+
+        # If value is tiered, split it up
+        elif value.find(".") != -1:
+            pieces = value.split(".")
+
+            # If value refers to a setting, return the setting
+            if pieces[0] == "settings":
+                getValue = lambda: self.master.settings.get(pieces[1], 0)
+            elif pieces[0] == "config":
+                getValue = lambda: self.config["config"].get(pieces[1], 0)
+            elif pieces[0] == "modules" and len(pieces) > 2:
+                # Modules may be loaded after the policy, so look the module
+                # up when the value is needed
+                def getModuleValue():
+                    if pieces[1] in self.master.modules:
+                        module = self.master.getModuleByName(pieces[1])
+                        return getattr(module, pieces[2], value)
+                    return value
+
+                getValue = getModuleValue
+
+        # None of the macro conditions matched, return the value as is
+        if getValue is None:
+            return lambda: value
+
+        if dependencies is not None and value not in self.selfReferentialFunctions:
+            dependencies["inputs"].setdefault(value, getValue)
+            if value in self.timeDependentFunctions:
+                dependencies["time"].add(self.timeDependentFunctions[value])
+        return getValue
+
     def enforcePolicy(self, policy, updateLatch=False):
+        compiled = self.getCompiledPolicy(policy)
+
         if self.active_policy != str(policy["name"]):
             self.fireWebhook("exit")
 
@@ -193,6 +509,7 @@ class Policy:
             self.active_policy = str(policy["name"])
             self.limitOverride = False
             self.fireWebhook("enter")
+            self.master.notifyStatusChanged()
 
             # Clear stopAskingToStartCharging so we try charging each car at
             # least once
@@ -208,13 +525,12 @@ class Policy:
                 self.master.setMaxAmpsToDivideAmongSlaves(int(policy["value"]))
                 logger.debug("Charge at %.2f" % int(policy["value"]))
             else:
-                self.master.setMaxAmpsToDivideAmongSlaves(
-                    self.policyValue(policy["charge_amps"])
-                )
-                logger.debug("Charge at %.2f" % self.policyValue(policy["charge_amps"]))
+                amps = compiled["charge_amps"]()
+                self.master.setMaxAmpsToDivideAmongSlaves(amps)
+                logger.debug("Charge at %.2f" % amps)
 
         # Set flex, if any
-        self.master.setAllowedFlex(self.policyValue(policy.get("allowed_flex", 0)))
+        self.master.setAllowedFlex(compiled["allowed_flex"]())
 
         # If a background task is defined for this policy, queue it
         bgt = policy.get("background_task", None)
@@ -222,7 +538,7 @@ class Policy:
             self.master.queue_background_task({"cmd": bgt})
 
         # If a charge limit is defined for this policy, apply it
-        limit = limit = self.policyValue(policy.get("charge_limit", -1))
+        limit = compiled["charge_limit"]()
         if self.limitOverride:
             currentCharge = (
                 self.master.getModuleByName("TeslaAPI").minBatteryLevelAtHome - 1
@@ -271,55 +587,14 @@ class Policy:
             return 3
         else:
             policy = self.getPolicyByName(self.active_policy)
-            if int(self.policyValue(policy.get("charge_amps", 0))) > 0:
+            if int(self.getCompiledPolicy(policy)["charge_amps"]()) > 0:
                 return 1
             else:
                 return 2
 
     def policyValue(self, value):
-        # policyValue is a macro to allow charging policy to refer to things
-        # such as EMS module values or settings. This allows us to control
-        # charging via policy.
-        ltNow = time.localtime()
-
-        # Anything other than a string can only be a literal value
-        if not isinstance(value, str):
-            return value
-
-        # If value is "now", substitute with current timestamp
-        if value == "now":
-            return time.time()
-
-        # If value is "tm_*", substitute with time component
-        if value.startswith("tm_") and hasattr(ltNow, value):
-            return getattr(ltNow, value)
-
-        # The remaining checks are case-sensitive!
-        #
-        # If value refers to a function, execute the function and capture the
-        # output
-        if value == "getMaxAmpsToDivideGreenEnergy()":
-            return self.master.getMaxAmpsToDivideGreenEnergy()
-        elif value == "checkScheduledCharging()":
-            return self.master.checkScheduledCharging()
-
-        # If value is tiered, split it up
-        if value.find(".") != -1:
-            pieces = value.split(".")
-
-            # If value refers to a setting, return the setting
-            if pieces[0] == "settings":
-                return self.master.settings.get(pieces[1], 0)
-            elif pieces[0] == "config":
-                return self.config["config"].get(pieces[1], 0)
-            elif pieces[0] == "modules":
-                module = None
-                if pieces[1] in self.master.modules:
-                    module = self.master.getModuleByName(pieces[1])
-                    return getattr(module, pieces[2], value)
-
-        # None of the macro conditions matched, return the value as is
-        return value
+        # Returns the current value of a policy value or macro
+        return self.compileValue(value)()
 
     def policyIsGreen(self):
         current = self.getPolicyByName(self.active_policy)
@@ -331,57 +606,12 @@ class Policy:
         return False
 
     def doesConditionMatch(self, match, condition, value, exitOn):
-        matchValue = self.policyValue(match)
-        value = self.policyValue(value)
-
-        logger.log(
-            logging.INFO8,
-            f"Evaluating Policy match (%s [{matchValue}]), condition (%s), value (%s)",
-            match,
-            condition,
-            value,
-            extra={"colored": "red"},
-        )
-
-        if all([isinstance(a, list) for a in (matchValue, condition, value)]):
-            return self.checkConditions(matchValue, condition, value, not exitOn)
-
-        # Perform comparison
-        if condition == "gt":
-            # Match must be greater than value
-            return True if matchValue > value else False
-        elif condition == "gte":
-            # Match must be greater than or equal to value
-            return True if matchValue >= value else False
-        elif condition == "lt":
-            # Match must be less than value
-            return True if matchValue < value else False
-        elif condition == "lte":
-            # Match must be less than or equal to value
-            return True if matchValue <= value else False
-        elif condition == "eq":
-            # Match must be equal to value
-            return True if matchValue == value else False
-        elif condition == "ne":
-            # Match must not be equal to value
-            return True if matchValue != value else False
-        elif condition == "false":
-            # Condition: false is a method to ensure a policy entry
-            # is never matched, possibly for testing purposes
-            return False
-        elif condition == "none":
-            # No condition exists.
-            return True
-        else:
-            raise ValueError("Unknown condition " + condition)
+        return self.compileCondition(match, condition, value, exitOn)()
 
     # exitOn = False returns True if all conditions are True, else False ==> AND
     # exitOn = True returns True if any condition is True, else False ==> OR
     def checkConditions(self, matches, conditions, values, exitOn=False):
-        for match, condition, value in zip(matches, conditions, values):
-            if self.doesConditionMatch(match, condition, value, exitOn) == exitOn:
-                return exitOn
-        return not exitOn
+        return self.compileConditions(matches, conditions, values, exitOn)()
 
     def overrideLimit(self):
         self.limitOverride = True
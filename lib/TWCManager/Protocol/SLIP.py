@@ -0,0 +1,184 @@
+import logging
+
+logger = logging.getLogger(__name__.rsplit(".")[-1])
+
+# Messages on the TWC RS485 network are framed in the same way as the SLIP
+# protocol discussed here:
+#   https://en.wikipedia.org/wiki/Serial_Line_Internet_Protocol
+# User FuzzyLogic found that this method of escaping and marking the start
+# and end of messages is based on SLIP.
+#
+# The protocol uses C0 to mark the start and end of the message.  If a C0
+# must appear within the message, it is 'escaped' by replacing it with
+# DB and DC bytes.
+# A DB byte in the message is escaped by replacing it with DB DD.
+#
+# The last byte of each message before escaping is a checksum, which is the
+# sum of all bytes of the message except the first, truncated to one byte.
+#
+# This module is shared by the Interface modules which send and receive these
+# messages, and is not loaded as a module of its own.
+
+END = b"\xc0"
+ESC = b"\xdb"
+ESC_END = b"\xdb\xdc"
+ESC_ESC = b"\xdb\xdd"
+
+
+def checksum(msg):
+    # Calculate the checksum for msg, which should not include the checksum
+    # byte itself. For messages this short, summing a slice is quicker than
+    # iterating over a memoryview.
+    return sum(msg[1:]) & 0xFF
+
+
+def encode_frame(msg):
+    # Add the checksum byte to msg, escape bytes with a special meaning and
+    # add a C0 byte to the start and end to mark where it begins and ends.
+    # The DB bytes must be escaped first so that the DB bytes we add when
+    # escaping C0 aren't escaped again.
+    msg = bytes(msg)
+    msg += bytes((checksum(msg),))
+    return END + msg.replace(ESC, ESC_ESC).replace(END, ESC_END) + END
+
+
+def decode_frame(frame):
+    # Given a message received on the RS485 network, remove the leading and
+    # trailing C0 byte and unescape special byte values. The checksum byte is
+    # left at the end of the message to be verified by the caller.
+    msg = bytes(frame[1:-1])
+    if ESC not in msg:
+        return msg
+
+    # Every DB byte in a correctly escaped message is followed by DC or DD.
+    # If that's the case we can replace the escape sequences in bulk, and we
+    # must replace DB DC first so that a DB produced by unescaping DB DD can't
+    # combine with a following DC.
+    if msg.count(ESC) == msg.count(ESC_END) + msg.count(ESC_ESC):
+        return msg.replace(ESC_END, END).replace(ESC_ESC, ESC)
+
+    # Otherwise, unescape byte by byte and report the invalid escape sequence
+    msg = bytearray(msg)
+    i = 0
+    while i < len(msg):
+        if msg[i] == 0xDB:
+            following = msg[i + 1] if i + 1 < len(msg) else 0xC0
+            if following == 0xDC:
+                msg[i : i + 2] = END
+            elif following == 0xDD:
+                msg[i : i + 2] = ESC
+            else:
+                logger.info(
+                    "ERROR: Special character 0xDB in message is "
+                    "followed by invalid character 0x%02X.  "
+                    "Message may be corrupted." % (following)
+                )
+
+                # Replace the character with something even though it's probably
+                # not the right thing.
+                msg[i : i + 2] = ESC
+        i = i + 1
+    return bytes(msg)
+
+
+class FrameReader:
+    # Splits the data received from an interface into complete messages. Data
+    # can be passed to feed() in chunks of any size, and any partial message
+    # is kept until the rest of it arrives.
+    #
+    # Messages are usually 17 bytes or longer and end with \xc0\xfe.
+    # However, when the network lacks termination and bias
+    # resistors, the last byte (\xfe) may be corrupted or even
+    # missing, and you may receive additional garbage bytes between
+    # messages.
+    #
+    # TWCs seem to account for corruption at the end and between
+    # messages by simply ignoring anything after the final \xc0 in a
+    # message, so we use the same tactic. If c0 happens to be within
+    # the corrupt noise between messages, we ignore it by starting a
+    # new message whenever we see a c0 before 15 or more bytes are
+    # received.
+    #
+    # Uncorrupted messages can be over 17 bytes long when special
+    # values are "escaped" as two bytes.
+    #
+    # To prevent most noise between messages, add a 120ohm
+    # "termination" resistor in parallel to the D+ and D- lines.
+    # Also add a 680ohm "bias" resistor between the D+ line and +5V
+    # and a second 680ohm "bias" resistor between the D- line and
+    # ground. See here for more information:
+    #   https://www.ni.com/support/serial/resinfo.htm
+    #   http://www.ti.com/lit/an/slyt514/slyt514.pdf
+    # This explains what happens without "termination" resistors:
+    #   https://e2e.ti.com/blogs_/b/analogwire/archive/2016/07/28/rs-485-basics-when-termination-is-necessary-and-how-to-do-it-properly
+
+    # A partial message which isn't completed within msgTimeout seconds of the
+    # last data being received is discarded.
+    msgTimeout = 2.0
+
+    def __init__(self, master):
+        self.master = master
+        self.buffer = bytearray()
+        self.timeLastRx = 0
+
+    def feed(self, data, now):
+        # Return a list of the complete messages in data, each with its
+        # leading and trailing C0 bytes, ready to be passed to decode_frame()
+        frames = []
+        buf = self.buffer
+        if not data:
+            # No message data waiting. If we have a partial message which has
+            # not been completed within msgTimeout, discard it.
+            if buf and now - self.timeLastRx >= self.msgTimeout:
+                logger.log(logging.INFO9, "Msg timeout " + self.master.hex_str(buf))
+                buf.clear()
+            return frames
+
+        self.timeLastRx = now
+        pos = 0
+        dataLen = len(data)
+        while pos < dataLen:
+            if not buf:
+                # We're between messages, so skip forward to the next C0.
+                # We expect to find non-C0 bytes between messages, so we
+                # don't print any warning at standard debug levels.
+                start = data.find(END, pos)
+                if start == -1:
+                    start = dataLen
+                if start > pos:
+                    logger.log(
+                        logging.DEBUG2,
+                        "Ignoring bytes %s between messages."
+                        % self.master.hex_str(data[pos:start]),
+                    )
+                if start < dataLen:
+                    buf += END
+                pos = start + 1
+                continue
+
+            end = data.find(END, pos)
+            if end == -1:
+                buf += data[pos:]
+                break
+
+            if len(buf) + (end - pos) < 15:
+                # A C0 before 15 or more bytes have been received means we
+                # either started listening in the middle of a message, or
+                # the C0 is noise between messages. In either case, treat it
+                # as the start of a new message.
+                #
+                # It's normal for this to happen every once in awhile but
+                # there may be a problem such as incorrect termination or
+                # bias resistors on the rs485 wiring if you see it frequently.
+                logger.debug(
+                    "Found end of message before full-length message received.  "
+                    "Discard and wait for new message."
+                )
+                buf[:] = END
+            else:
+                buf += data[pos : end + 1]
+                frames.append(bytes(buf))
+                buf.clear()
+            pos = end + 1
+
+        return frames
@@ -1,8 +1,184 @@
 import logging
-import re
+import struct
+from collections import namedtuple
 
 logger = logging.getLogger(__name__.rsplit(".")[-1])
 
+# A decoded TWC message. The fields which are set depend on the message type,
+# and any field which isn't part of a given message type is None.
+#   msgType  - The two byte message type prefix, eg b"\xfd\xe0"
+#   command  - A readable name for the message type
+#   senderID, receiverID - TWCIDs of the sending and receiving TWC
+#   sign     - The sign byte sent in linkready messages
+#   maxAmps  - The maximum amps a slave reports in its linkready message
+#   kWh, voltsPerPhase - Lifetime kWh and per-phase voltage reports
+#   vinPart  - Which 7 character part of the VIN this message carries
+#   data     - The remaining payload of the message, without the checksum
+#   msg      - The complete message
+TWCMessage = namedtuple(
+    "TWCMessage",
+    [
+        "msgType",
+        "command",
+        "senderID",
+        "receiverID",
+        "sign",
+        "maxAmps",
+        "kWh",
+        "voltsPerPhase",
+        "vinPart",
+        "data",
+        "msg",
+    ],
+)
+TWCMessage.__new__.__defaults__ = (None,) * len(TWCMessage._fields)
+
+# The messages below are decoded from fixed offsets. The last byte of each
+# message is the checksum, which has already been verified by the time we see
+# the message, so it is excluded from the data field.
+unpackHeader = struct.Struct(">2s2s2s").unpack_from
+unpackAmps = struct.Struct(">H").unpack_from
+unpackkWh = struct.Struct(">IHHH").unpack_from
+
+
+def decodeAck(command):
+    # FD B1 <Slave TWCID> 00 00 ... acknowledges a Start command, and
+    # FD B2 <Slave TWCID> 00 00 ... acknowledges a Stop command
+    def decode(msg):
+        if len(msg) < 7 or msg[4:6] != b"\x00\x00":
+            return None
+        return TWCMessage(msgType=msg[0:2], command=command, senderID=msg[2:4], msg=msg)
+
+    return decode
+
+
+def decodeHeartbeat(command):
+    # FD E0 <Slave TWCID> <Master TWCID> <heartbeat data> is sent by a slave,
+    # and FB E0 <Master TWCID> <Slave TWCID> <heartbeat data> by a master
+    def decode(msg):
+        if len(msg) < 14:
+            return None
+        msgType, senderID, receiverID = unpackHeader(msg)
+        return TWCMessage(
+            msgType=msgType,
+            command=command,
+            senderID=senderID,
+            receiverID=receiverID,
+            data=msg[6:-1],
+            msg=msg,
+        )
+
+    return decode
+
+
+def decodeMasterLinkready(command):
+    # FC E1 / FB E2 <Master TWCID> <Sign> 00 00 00 00 00 00 00 00 ...
+    # The data field holds everything after the sign byte, which is expected
+    # to be all zero.
+    def decode(msg):
+        if len(msg) < 14 or any(msg[5:13]):
+            return None
+        return TWCMessage(
+            msgType=msg[0:2],
+            command=command,
+            senderID=msg[2:4],
+            sign=msg[4:5],
+            data=msg[5:-1],
+            msg=msg,
+        )
+
+    return decode
+
+
+def decodeSlaveLinkready(msg):
+    # FD E2 <Slave TWCID> <Sign> <Max Amps * 100> 00 00 00 00 00 00 ...
+    if len(msg) < 14 or any(msg[7:13]):
+        return None
+    return TWCMessage(
+        msgType=msg[0:2],
+        command="SlaveLinkready",
+        senderID=msg[2:4],
+        sign=msg[4:5],
+        maxAmps=unpackAmps(msg, 5)[0] / 100,
+        msg=msg,
+    )
+
+
+def decodeSlaveVIN(vinPart):
+    # FD EE / FD EF / FD F1 <Slave TWCID> VV VV VV VV VV VV VV ...
+    # carry the first, second and third parts of the VIN respectively
+    def decode(msg):
+        if len(msg) < 6:
+            return None
+        return TWCMessage(
+            msgType=msg[0:2],
+            command="SlaveVIN",
+            senderID=msg[2:4],
+            vinPart=vinPart,
+            data=msg[4:-1],
+            msg=msg,
+        )
+
+    return decode
+
+
+def decodeSlaveKWh(msg):
+    # FD EB <Slave TWCID> <kWh, 4 bytes> <Volts A> <Volts B> <Volts C> ...
+    if len(msg) < 16:
+        return None
+    kWh, voltsPhaseA, voltsPhaseB, voltsPhaseC = unpackkWh(msg, 4)
+    return TWCMessage(
+        msgType=msg[0:2],
+        command="SlaveKWh",
+        senderID=msg[2:4],
+        kWh=kWh,
+        voltsPerPhase=(voltsPhaseA, voltsPhaseB, voltsPhaseC),
+        data=msg[14:-1],
+        msg=msg,
+    )
+
+
+def decodeVoltageRequest(msg):
+    # FB EB <Master TWCID> <Slave TWCID> 00 00 00 00 00 00 00 00 00 ...
+    if len(msg) < 16 or any(msg[6:-1]):
+        return None
+    msgType, senderID, receiverID = unpackHeader(msg)
+    return TWCMessage(
+        msgType=msgType,
+        command="VoltageRequest",
+        senderID=senderID,
+        receiverID=receiverID,
+        msg=msg,
+    )
+
+
+def decodeIdle(msg):
+    # FC 1D 00 00 00 00 00 00 00 00 00 00 00 ... is sent by a master every
+    # 2 hours
+    if len(msg) < 14 or any(msg[2:-1]):
+        return None
+    return TWCMessage(msgType=msg[0:2], command="MasterIdle", msg=msg)
+
+
+messageDecoders = {
+    b"\xfb\xe0": decodeHeartbeat("MasterHeartbeat"),
+    b"\xfb\xe2": decodeMasterLinkready("MasterLinkready2"),
+    b"\xfb\xeb": decodeVoltageRequest,
+    b"\xfc\x1d": decodeIdle,
+    b"\xfc\xe1": decodeMasterLinkready("MasterLinkready1"),
+    # FC E2 has only been seen from TWCs which have their rotary switch set to
+    # master mode. It shares the structure of linkready1.
+    b"\xfc\xe2": decodeMasterLinkready("MasterLinkready1"),
+    b"\xfd\xb1": decodeAck("StartAck"),
+    b"\xfd\xb2": decodeAck("StopAck"),
+    b"\xfd\xe0": decodeHeartbeat("SlaveHeartbeat"),
+    b"\xfd\xe2": decodeSlaveLinkready,
+    b"\xfd\xeb": decodeSlaveKWh,
+    b"\xfd\xee": decodeSlaveVIN(0),
+    b"\xfd\xef": decodeSlaveVIN(1),
+    b"\xfd\xf1": decodeSlaveVIN(2),
+}
+
 
 class TWCProtocol:
     # To avoid a situation where we would have to re-implement TWCManager logic to parse the
@@ -101,80 +277,13 @@ class TWCProtocol:
             return msg
 
     def parseMessage(self, msg):
-        # Define protocol packet format
-        packet = {"Command": None, "Errors": [], "SenderID": None, "Match": False}
-
-        msgMatch = re.search(
-            b"\xfc\xe1(..)(.)\x00\x00\x00\x00\x00\x00\x00\x00+?.*\Z",
-            msg,
-            re.DOTALL,
-        )
-
-        if msgMatch and packet["Match"] == False:
-            # Handle linkready1 from master.
-            # See notes in send_master_linkready1() for details.
-            packet["Match"] = True
-            packet["Command"] = "MasterLinkready1"
-            packet["SenderID"] = msgMatch.group(1)
-            sign = msgMatch.group(2)
-            # self.master.setMasterTWCID(senderID)
-
-            # This message seems to always contain seven 00 bytes in its
-            # data area. If we ever get this message with non-00 data
-            # we'll print it as an unexpected message.
-            logger.info(
-                "Master TWC %02X%02X Linkready1.  Sign: %s"
-                % (
-                    packet["SenderID"][0],
-                    packet["SenderID"][1],
-                    self.master.hex_str(sign),
-                )
-            )
-
-            # Other than picking a new fakeTWCID if ours conflicts with
-            # master, it doesn't seem that a real slave will make any
-            # sort of direct response when sent a master's linkready1 or
-            # linkready2.
-
-        else:
-            msgMatch = re.search(
-                b"\xfb\xe2(..)(.)\x00\x00\x00\x00\x00\x00\x00\x00+?.*\Z",
-                msg,
-                re.DOTALL,
-            )
-            if msgMatch and packet["Match"] == False:
-                # Handle linkready2 from master.
-                # See notes in send_master_linkready2() for details.
-                packet["Match"] = True
-                packet["Command"] = "MasterLinkready2"
-                packet["SenderID"] = msgMatch.group(1)
-                sign = msgMatch.group(2)
-                # master.setMasterTWCID(senderID)
-
-                # This message seems to always contain seven 00 bytes in its
-                # data area. If we ever get this message with non-00 data
-                # we'll print it as an unexpected message.
-
-                logger.info(
-                    "Master TWC %02X%02X Linkready2.  Sign: %s"
-                    % (
-                        packet["SenderID"][0],
-                        packet["SenderID"][1],
-                        self.master.hex_str(sign),
-                    )
-                )
-
-            else:
-                msgMatch = re.search(
-                    b"\A\xfb\xe0(..)(..)(.......+?).\Z", msg, re.DOTALL
-                )
-            if msgMatch and packet["Match"] == False:
-                # Handle heartbeat message from Master.
-                # NOTE: This is very much a cut down version of handling of this message for now
-                packet["Match"] = True
-                packet["Command"] = "MasterHeartbeat"
-                packet["SenderID"] = msgMatch.group(1)
-                packet["ReceiverID"] = msgMatch.group(2)
-                packet["HeartbeatData"] = msgMatch.group(3)
-
-        return packet
+        # Decode a message into a TWCMessage record. The first two bytes of
+        # every message identify its type, so we look up the decoder for that
+        # type directly rather than trying each known message format in turn.
+        # Messages which are of an unknown type, or which don't have the
+        # structure we expect for their type, return None.
+        msg = bytes(msg)
+        decoder = messageDecoders.get(msg[0:2], None)
+        if decoder is None:
+            return None
+        return decoder(msg)
@@ -0,0 +1,168 @@
+import math
+import threading
+import time
+
+
+class SolarPosition:
+    # Works out the times of sunrise, solar noon and sunset, and the height
+    # of the sun in the sky, for a given location using the NOAA solar
+    # calculations, so that no network service is needed to look them up.
+    #
+    # The times for each day are worked out once and kept, as they are read
+    # far more often than the day changes. Sunrise and sunset are the times
+    # at which the top of the sun crosses the horizon, allowing for the usual
+    # atmospheric refraction. The elevation of the sun is the geometric
+    # elevation of its centre, without refraction.
+
+    # Angle below the horizon of the sun's centre at sunrise and sunset
+    sunriseZenith = 90.833
+
+    def __init__(self):
+        self.days = {}
+        self.lock = threading.Lock()
+
+    def getDay(self, lat, lon, date):
+        # Returns the times of sunrise, solar noon and sunset at lat/lon on
+        # the given (local) date, as timestamps. On days when the sun doesn't
+        # rise or set, sunrise and sunset are None and polar is "day" or
+        # "night".
+        key = (lat, lon, date)
+        with self.lock:
+            if key not in self.days:
+                # Only the last few days are likely to be asked for again
+                if len(self.days) > 7:
+                    self.days.clear()
+                self.days[key] = self.calculateDay(lat, lon, date)
+            return dict(self.days[key])
+
+    def getElevation(self, lat, lon, timestamp):
+        # Returns the elevation of the sun above the horizon in degrees
+        declination, eqTime = self.getSunParameters(timestamp)
+        utc = time.gmtime(timestamp)
+        minutes = utc.tm_hour * 60 + utc.tm_min + utc.tm_sec / 60
+        trueSolarTime = (minutes + eqTime + 4 * lon) % 1440
+        hourAngle = math.radians(trueSolarTime / 4 - 180)
+        lat = math.radians(lat)
+        declination = math.radians(declination)
+        cosZenith = math.sin(lat) * math.sin(declination) + math.cos(lat) * math.cos(
+            declination
+        ) * math.cos(hourAngle)
+        return 90 - math.degrees(math.acos(max(min(cosZenith, 1), -1)))
+
+    def getElevationCurve(self, lat, lon, date, interval=900):
+        # Returns the elevation of the sun every interval seconds through the
+        # given (local) date, as a list of [timestamp, elevation]
+        start = time.mktime((date.year, date.month, date.day, 0, 0, 0, 0, 0, -1))
+        end = time.mktime((date.year, date.month, date.day + 1, 0, 0, 0, 0, 0, -1))
+        curve = []
+        timestamp = start
+        while timestamp < end:
+            curve.append(
+                [int(timestamp), round(self.getElevation(lat, lon, timestamp), 2)]
+            )
+            timestamp += interval
+        return curve
+
+    def calculateDay(self, lat, lon, date):
+        # Start from local noon, and refine each time using the position of
+        # the sun at the previous estimate
+        localNoon = time.mktime((date.year, date.month, date.day, 12, 0, 0, 0, 0, -1))
+        noon = localNoon
+        for i in range(2):
+            noon = self.getSolarNoon(lon, localNoon, noon)
+
+        day = {"noon": noon, "polar": None, "sunrise": None, "sunset": None}
+        for event, direction in (("sunrise", -1), ("sunset", 1)):
+            estimate = noon
+            for i in range(2):
+                hourAngle = self.getSunriseHourAngle(lat, estimate)
+                if hourAngle is None:
+                    break
+                estimate = (
+                    self.getSolarNoon(lon, localNoon, estimate)
+                    + direction * hourAngle * 240
+                )
+            if hourAngle is None:
+                if self.getElevation(lat, lon, noon) > 0:
+                    day["polar"] = "day"
+                else:
+                    day["polar"] = "night"
+                day["sunrise"] = day["sunset"] = None
+                break
+            day[event] = estimate
+        return day
+
+    def getSolarNoon(self, lon, localNoon, timestamp):
+        # Returns the time of solar noon nearest to localNoon, using the
+        # equation of time at timestamp
+        eqTime = self.getSunParameters(timestamp)[1]
+        utc = time.gmtime(localNoon)
+        midnight = localNoon - (utc.tm_hour * 3600 + utc.tm_min * 60 + utc.tm_sec)
+        noon = midnight + (720 - 4 * lon - eqTime) * 60
+        while noon - localNoon > 43200:
+            noon -= 86400
+        while localNoon - noon > 43200:
+            noon += 86400
+        return noon
+
+    def getSunParameters(self, timestamp):
+        # Returns the declination of the sun in degrees, and the equation of
+        # time in minutes, at timestamp
+        julianCentury = (timestamp / 86400 + 2440587.5 - 2451545) / 36525
+        meanLong = (
+            280.46646 + julianCentury * (36000.76983 + julianCentury * 0.0003032)
+        ) % 360
+        meanAnom = 357.52911 + julianCentury * (35999.05029 - 0.0001537 * julianCentury)
+        eccent = 0.016708634 - julianCentury * (
+            0.000042037 + 0.0000001267 * julianCentury
+        )
+        center = (
+            math.sin(math.radians(meanAnom))
+            * (1.914602 - julianCentury * (0.004817 + 0.000014 * julianCentury))
+            + math.sin(math.radians(2 * meanAnom))
+            * (0.019993 - 0.000101 * julianCentury)
+            + math.sin(math.radians(3 * meanAnom)) * 0.000289
+        )
+        omega = math.radians(125.04 - 1934.136 * julianCentury)
+        appLong = meanLong + center - 0.00569 - 0.00478 * math.sin(omega)
+        meanObliq = (
+            23
+            + (
+                26
+                + (
+                    21.448
+                    - julianCentury
+                    * (46.815 + julianCentury * (0.00059 - julianCentury * 0.001813))
+                )
+                / 60
+            )
+            / 60
+        )
+        obliq = math.radians(meanObliq + 0.00256 * math.cos(omega))
+        declination = math.degrees(
+            math.asin(math.sin(obliq) * math.sin(math.radians(appLong)))
+        )
+
+        y = math.tan(obliq / 2) ** 2
+        meanLong = math.radians(meanLong)
+        meanAnom = math.radians(meanAnom)
+        eqTime = 4 * math.degrees(
+            y * math.sin(2 * meanLong)
+            - 2 * eccent * math.sin(meanAnom)
+            + 4 * eccent * y * math.sin(meanAnom) * math.cos(2 * meanLong)
+            - 0.5 * y * y * math.sin(4 * meanLong)
+            - 1.25 * eccent * eccent * math.sin(2 * meanAnom)
+        )
+        return declination, eqTime
+
+    def getSunriseHourAngle(self, lat, timestamp):
+        # Returns the hour angle of sunrise in degrees, using the declination
+        # of the sun at timestamp, or None if the sun doesn't rise or set
+        declination = math.radians(self.getSunParameters(timestamp)[0])
+        lat = math.radians(lat)
+        cosHourAngle = math.cos(math.radians(self.sunriseZenith)) / (
+            math.cos(lat) * math.cos(declination)
+        ) - math.tan(lat) * math.tan(declination)
+        if cosHourAngle < -1 or cosHourAngle > 1:
+            return None
+        return math.degrees(math.acos(cosHourAngle))
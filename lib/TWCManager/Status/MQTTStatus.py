@@ -1,7 +1,9 @@
 # MQTT Status Output
 # Publishes the provided key and value pair to the provided topic prefix
 
+import collections
 import logging
+import threading
 import time
 
 
@@ -14,16 +16,23 @@ class MQTTStatus:
     brokerIP = None
     brokerPort = 1883
     __carsCharging = {}
+    __client = None
     __config = None
     __configConfig = None
     __configMQTT = {}
     connectionState = 0
     __master = None
-    msgQueue = []
-    msgQueueBuffer = []
-    msgQueueMax = 16
+    msgCoalesced = 0
+    msgDropped = 0
+    msgInFlight = 0
+    msgInFlightMax = 8
+    msgQueue = None
+    msgQueueLock = None
+    msgQueueMax = 256
     __msgRate = {}
     __msgRatePerTopic = 60
+    __metricsLastPublished = 0
+    __metricsPublished = None
     password = None
     status = False
     serverTLS = False
@@ -47,10 +56,61 @@ class MQTTStatus:
         self.username = self.__configMQTT.get("username", None)
         self.password = self.__configMQTT.get("password", None)
         self.__msgRatePerTopic = int(self.__configMQTT.get("ratelimit", 60))
+        self.msgQueueMax = int(self.__configMQTT.get("queueMax", self.msgQueueMax))
 
         # Unload if this module is disabled or misconfigured
         if (not self.status) or (not self.brokerIP):
             self.__master.releaseModule("lib.TWCManager.Status", "MQTTStatus")
+            return None
+
+        # Messages waiting to be published, keyed by topic. Only the latest
+        # value for each topic is kept, as the values are retained by the
+        # broker and earlier values would be overwritten straight away.
+        self.msgQueue = collections.OrderedDict()
+        self.msgQueueLock = threading.Lock()
+
+        # We keep a single connection to the MQTT broker open. The client's
+        # network thread reconnects if the connection is lost, and messages
+        # are queued until it is established again.
+        logger.debug("MQTT Status: Attempting to Connect")
+        if hasattr(self.mqtt, "CallbackAPIVersion"):
+            self.__client = self.mqtt.Client(
+                self.mqtt.CallbackAPIVersion.VERSION2,
+                "MQTTStatus",
+                protocol=self.mqtt.MQTTv5,
+            )
+        else:
+            self.__client = self.mqtt.Client("MQTTStatus")
+        if self.username and self.password:
+            self.__client.username_pw_set(self.username, self.password)
+        self.__client.on_connect = self.mqttConnected
+        self.__client.on_disconnect = self.mqttDisconnected
+        self.__client.on_publish = self.mqttPublished
+        self.__client.reconnect_delay_set(min_delay=1, max_delay=60)
+        try:
+            self.__client.connect_async(
+                self.brokerIP, port=self.brokerPort, keepalive=30
+            )
+        except (ConnectionRefusedError, OSError) as e:
+            logger.log(
+                logging.INFO4,
+                "Error connecting to MQTT Broker to publish topic values",
+            )
+            logger.debug(str(e))
+            return None
+        self.connectionState = 1
+        self.__master.startMQTTLoop(self.__client)
+
+    def getQueueStats(self):
+        # Returns the number of messages waiting to be published, and the
+        # number of messages which have been dropped because the queue was
+        # full or replaced by a later value for the same topic
+        with self.msgQueueLock:
+            return {
+                "queued": len(self.msgQueue),
+                "dropped": self.msgDropped,
+                "coalesced": self.msgCoalesced,
+            }
 
     def handleCarsCharging(self, twc, twident, value):
         # When an update comes in for the carsCharging value, check if it was previously 1 for the
@@ -91,81 +151,118 @@ class MQTTStatus:
             else:
                 self.__msgRate[topic] = time.time()
 
-            # Now, we push the message that we'd like to send into the
-            # list of messages to be published once a connection is established
-            msg = {"topic": topic, "payload": value}
-            self.msgQueue.append(msg.copy())
-
-            # If msgQueue size exceeds msgQueueMax, trim the list size
-            # This will discard MQTT messages in environments where the MQTT
-            # broker cannot accept the rate of MQTT messages sent
-            if len(self.msgQueue) > (self.msgQueueMax + 8):
-                del self.msgQueue[: self.msgQueueMax]
-
-            # Now, we attempt to establish a connection to the MQTT broker
-            if self.connectionState == 0:
-                logger.debug("MQTT Status: Attempting to Connect")
-                try:
-                    if hasattr(self.mqtt, "CallbackAPIVersion"):
-                        client = self.mqtt.Client(
-                            self.mqtt.CallbackAPIVersion.VERSION2,
-                            "MQTTStatus",
-                            protocol=self.mqtt.MQTTv5,
-                        )
-                    else:
-                        client = self.mqtt.Client("MQTTStatus")
-                    if self.username and self.password:
-                        client.username_pw_set(self.username, self.password)
-                    client.on_connect = self.mqttConnected
-                    client.connect_async(
-                        self.brokerIP, port=self.brokerPort, keepalive=30
-                    )
-                    self.connectionState = 1
-                    client.loop_start()
-                except ConnectionRefusedError as e:
-                    logger.log(
-                        logging.INFO4,
-                        "Error connecting to MQTT Broker to publish topic values",
-                    )
-                    logger.debug(str(e))
-                    return False
-                except OSError as e:
-                    logger.log(
-                        logging.INFO4,
-                        "Error connecting to MQTT Broker to publish topic values",
-                    )
-                    logger.debug(str(e))
-                    return False
+            self.queueMessage(topic, value)
+            self.publishMetrics()
+            self.publishQueue()
 
-    def mqttConnected(self, client, userdata, flags, rc, properties=None):
-        # This callback function is called once the MQTT client successfully
-        # connects to the MQTT server. It will then publish all queued messages
-        # to the server, and then disconnect.
+    def queueMessage(self, topic, value):
+        # Queue a message to be published. If a message for the same topic is
+        # already waiting, it is replaced with this one. If the queue is full,
+        # the oldest message is dropped to make room.
+        with self.msgQueueLock:
+            if topic in self.msgQueue:
+                self.msgCoalesced += 1
+            elif len(self.msgQueue) >= self.msgQueueMax:
+                self.msgQueue.popitem(last=False)
+                self.msgDropped += 1
+            self.msgQueue[topic] = value
 
-        logger.debug("Connected to MQTT Broker with RC: " + str(rc))
-        logger.log(logging.DEBUG2, "Copy Message Buffer")
-        self.msgQueueBuffer = self.msgQueue.copy()
-        logger.log(logging.DEBUG2, "Clear Message Buffer")
-        self.msgQueue.clear()
+    def publishMetrics(self):
+        # Publish the number of dropped and coalesced messages, at most once
+        # per minute and only if they have changed
+        now = time.time()
+        if now - self.__metricsLastPublished < 60:
+            return
+        self.__metricsLastPublished = now
+
+        stats = self.getQueueStats()
+        metrics = (stats["dropped"], stats["coalesced"])
+        if metrics == self.__metricsPublished:
+            return
+        self.__metricsPublished = metrics
+
+        if stats["dropped"]:
+            logger.log(
+                logging.INFO4,
+                "%d MQTT messages dropped as the broker is not keeping up"
+                % stats["dropped"],
+            )
+        self.queueMessage(self.topicPrefix + "/all/msgDropped", stats["dropped"])
+        self.queueMessage(self.topicPrefix + "/all/msgCoalesced", stats["coalesced"])
+
+    def publishQueue(self):
+        # Hand queued messages to the MQTT client, keeping no more than
+        # msgInFlightMax messages waiting to be written to the broker at once.
+        # This is called when a message is queued, and from the client's
+        # network thread when a connection is established or a message has
+        # been sent, so that the queue is drained as fast as the broker
+        # accepts messages.
+        while True:
+            with self.msgQueueLock:
+                if (
+                    self.connectionState != 2
+                    or self.msgInFlight >= self.msgInFlightMax
+                    or not self.msgQueue
+                ):
+                    return
+                topic, payload = self.msgQueue.popitem(last=False)
+                self.msgInFlight += 1
 
-        for msg in self.msgQueueBuffer:
             logger.log(
                 logging.INFO8,
                 "Publishing MQTT Topic "
-                + str(msg["topic"])
+                + str(topic)
                 + " (value is "
-                + str(msg["payload"])
+                + str(payload)
                 + ")",
             )
             try:
-                pub = client.publish(
-                    msg["topic"], payload=msg["payload"], qos=0, retain=True
+                result = self.__client.publish(
+                    topic, payload=payload, qos=0, retain=True
                 )
-            except e:
+                rc = result.rc
+            except (TypeError, ValueError) as e:
                 logger.log(logging.INFO4, "Error publishing MQTT Topic Status")
                 logger.debug(str(e))
+                with self.msgQueueLock:
+                    self.msgInFlight -= 1
+                continue
+
+            if rc != self.mqtt.MQTT_ERR_SUCCESS:
+                # The connection has been lost. Put the message back at the
+                # front of the queue, unless a newer value has been queued,
+                # and wait for the client to reconnect.
+                with self.msgQueueLock:
+                    self.msgInFlight -= 1
+                    if topic not in self.msgQueue:
+                        self.msgQueue[topic] = payload
+                        self.msgQueue.move_to_end(topic, last=False)
+                return
+
+    def mqttConnected(self, client, userdata, flags, rc, properties=None):
+        # This callback function is called by the client's network thread
+        # each time it connects to the MQTT server. It publishes the messages
+        # which were queued while we were not connected.
+        logger.debug("Connected to MQTT Broker with RC: " + str(rc))
+        if rc != 0:
+            return
+        with self.msgQueueLock:
+            self.connectionState = 2
+            self.msgInFlight = 0
+        self.publishQueue()
+
+    def mqttDisconnected(self, client, userdata, *args):
+        # The client's network thread will try to reconnect. Messages which
+        # were handed to the client but not sent may be lost, but the next
+        # update to those topics will be published once we reconnect.
+        logger.debug("Disconnected from MQTT Broker")
+        with self.msgQueueLock:
+            self.connectionState = 1
+            self.msgInFlight = 0
 
-        client.loop_stop()
-        self.msgQueueBuffer.clear()
-        self.connectionState = 0
-        client.disconnect()
+    def mqttPublished(self, client, userdata, mid, *args):
+        # Called by the client's network thread once a message has been sent
+        with self.msgQueueLock:
+            if self.msgInFlight > 0:
+                self.msgInFlight -= 1
+        self.publishQueue()
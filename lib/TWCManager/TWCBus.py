@@ -0,0 +1,290 @@
+import collections
+import logging
+import threading
+import time
+import traceback
+from TWCManager.HeartbeatScheduler import HeartbeatScheduler
+from TWCManager.Protocol.SLIP import checksum, decode_frame
+
+
+logger = logging.getLogger("\u26FD Bus")
+
+
+class TWCBus:
+    # Drives one TWC load sharing network, through one Interface instance
+    # (an RS485 adapter, or a TCP gateway to one).
+    #
+    # A load sharing network holds at most three slave TWCs, so sites with
+    # more chargers than that split them over several networks, each with its
+    # own interface. Each bus has its own thread, which reads the messages
+    # arriving on its interface and sends its own linkready and heartbeat
+    # messages, so that a slow or busy network doesn't delay the heartbeats
+    # on another one.
+    #
+    # The slave TWCs on every bus are kept together by the master, and share
+    # one allocation of amps and one wiringMaxAmpsAllTWCs limit. Each slave
+    # TWC knows which bus it was found on, and messages for it are sent on
+    # that bus. The master's twcLock is held while a message is handled or a
+    # periodic message is sent, so that the slave TWCs are only changed by
+    # one thread at a time, but not while waiting for data to arrive.
+
+    def __init__(self, master, interface, handlers, index=0):
+        # handlers maps each message type to the function which handles it,
+        # which is called with the decoded message and this bus
+        self.master = master
+        self.config = master.config
+        self.handlers = handlers
+        self.index = index
+        self.interface = interface
+        self.msgRxCount = 0
+        self.numInitMsgsToSend = 10
+        self.pendingFrames = collections.deque()
+        self.protocol = master.getModuleByName("TWCProtocol")
+        self.scheduler = HeartbeatScheduler()
+        self.sendLock = threading.Lock()
+        # Each interface reads slaveTimeout from its own settings, so that
+        # it can differ between buses
+        self.slaveTimeout = interface.slaveTimeout
+        self.thread = None
+
+    def addFrames(self, frames):
+        # Queue the messages received on the interface to be handled
+        if frames:
+            self.scheduler.markRx()
+            self.pendingFrames.extend(frames)
+
+    def getHeartbeatStats(self):
+        return self.scheduler.getStats()
+
+    def getSlaveTWCs(self):
+        # Returns the slave TWCs on this bus, in the order they were found
+        return [
+            slaveTWC for slaveTWC in self.master.getSlaveTWCs() if slaveTWC.bus is self
+        ]
+
+    def handleFrame(self, frame):
+        # Remove leading and trailing C0 bytes and unescape special values
+        msg = decode_frame(frame)
+
+        self.msgRxCount += 1
+
+        # When the sendTWCMsg web command is used to send a message to the
+        # TWC, it sets lastTWCResponseMsg = b''.  When we see that here,
+        # set lastTWCResponseMsg to any unusual message received in response
+        # to the sent message.  Never set lastTWCResponseMsg to a commonly
+        # repeated message like master or slave linkready, heartbeat, or
+        # voltage/kWh report.
+        if (
+            self.master.lastTWCResponseMsg == b""
+            and msg[0:2] != b"\xFB\xE0"
+            and msg[0:2] != b"\xFD\xE0"
+            and msg[0:2] != b"\xFC\xE1"
+            and msg[0:2] != b"\xFB\xE2"
+            and msg[0:2] != b"\xFD\xE2"
+            and msg[0:2] != b"\xFB\xEB"
+            and msg[0:2] != b"\xFD\xEB"
+        ):
+            self.master.lastTWCResponseMsg = bytearray(msg)
+
+        logger.log(logging.INFO9, "Rx@: " + self.master.hex_str(msg))
+
+        # After unescaping special values and removing the leading and
+        # trailing C0 bytes, the messages we know about are always 14 bytes
+        # long in original TWCs, or 16 bytes in newer TWCs (protocolVersion
+        # == 2).
+        if len(msg) != 14 and len(msg) != 16 and len(msg) != 20:
+            logger.info(
+                "ERROR: Ignoring message of unexpected length %d: %s"
+                % (len(msg), self.master.hex_str(msg))
+            )
+            return
+
+        checksumExpected = msg[len(msg) - 1]
+        checksumActual = checksum(msg[:-1])
+
+        if checksumActual != checksumExpected:
+            logger.info(
+                "ERROR: Checksum %X does not match %02X.  Ignoring message: %s"
+                % (checksumActual, checksumExpected, self.master.hex_str(msg))
+            )
+            return
+
+        # Look up the handler for this type of message, depending on
+        # whether we're pretending to be a master or a slave TWC.
+        message = self.protocol.parseMessage(msg)
+        handler = self.handlers.get(message.msgType) if message else None
+        if handler is None or handler(message, self) is False:
+            if self.config["config"]["fakeMaster"] == 1:
+                logger.info(
+                    "*** UNKNOWN MESSAGE FROM SLAVE:"
+                    + self.master.hex_str(msg)
+                    + "\nPlease private message user CDragon at http://teslamotorsclub.com "
+                    "with a copy of this error."
+                )
+            else:
+                logger.info(
+                    "***UNKNOWN MESSAGE from master: " + self.master.hex_str(msg)
+                )
+
+    def handleNextFrame(self):
+        frame = self.pendingFrames.popleft()
+        with self.master.twcLock:
+            self.handleFrame(frame)
+
+    def poll(self):
+        # In this area, we always send a linkready message when we first start.
+        # Whenever there is no data available from other TWCs to respond to,
+        # we'll loop back to this point to send another linkready or heartbeat
+        # message. By only sending our periodic messages when no incoming
+        # message data is available, we reduce the chance that we will start
+        # transmitting a message in the middle of an incoming message, which
+        # would corrupt both messages.
+        #
+        # The interface splits the incoming data into whole messages for us.
+        # We handle one message per pass so that we still get the chance to
+        # send our periodic messages in between.
+        if self.pendingFrames:
+            self.handleNextFrame()
+            return
+
+        wait = self.sendMessages()
+
+        # We don't sleep here, because getFrames() waits for a short time for
+        # incoming data when there is none. That prevents pegging the pi's CPU
+        # at 100% while still responding to messages as soon as they arrive.
+        # If our next message is due before that wait would end, we wait for
+        # it instead, so that it is sent on time.
+        if wait is not None and wait < self.interface.readTimeout:
+            time.sleep(max(wait, 0))
+            return
+        self.addFrames(self.interface.getFrames())
+
+        if self.pendingFrames:
+            self.handleNextFrame()
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                # Print info about unhandled exceptions, then continue.  Search
+                # for 'Traceback' to find these in the log.
+                traceback.print_exc()
+                logger.info("Unhandled Exception:" + traceback.format_exc())
+                # Sleep 5 seconds so the user might see the error.
+                time.sleep(5)
+
+    def send(self, msg):
+        # Messages may be sent from other threads too (for example by the
+        # background tasks), so only one is written to the interface at a time
+        with self.sendLock:
+            self.interface.send(msg)
+            self.scheduler.markTx()
+
+    def sendMessages(self):
+        # Send our periodic messages, if any are due. Returns the number of
+        # seconds until the next one is due, or None if there is nothing to
+        # send until we hear from another TWC.
+        if self.config["config"]["fakeMaster"] == 1:
+            return self.sendMasterMessages()
+        return self.sendSlaveMessages()
+
+    def sendMasterMessages(self):
+        # Send the next linkready or heartbeat message if it is due. Returns
+        # the number of seconds until we next have a message to send, or None
+        # if we have nothing to send until a slave TWC links to us.
+        now = time.monotonic()
+        if self.numInitMsgsToSend > 0:
+            # A real master sends 5 copies of linkready1 and linkready2
+            # whenever it starts up, which we do here.
+            # It doesn't seem to matter if we send these once per second or
+            # once per 100ms so we send them as soon as the slaves have had
+            # time to respond to the last one, to get them over with.
+            wait = self.scheduler.getSendTime(now) - now
+            if wait > 0:
+                return wait
+            with self.master.twcLock:
+                if self.numInitMsgsToSend > 5:
+                    self.master.send_master_linkready1(self)
+                else:
+                    self.master.send_master_linkready2(self)
+            self.numInitMsgsToSend -= 1
+            return self.scheduler.responseTime
+
+        # After finishing the 5 startup linkready1 and linkready2 messages,
+        # master will send a heartbeat message to every slave it's received a
+        # linkready message from. Do that here.
+        # A real master would keep sending linkready messages periodically
+        # as long as no slave was connected, but since real slaves send
+        # linkready once every 10 seconds till they're connected to a
+        # master, we'll just wait for that.
+        with self.master.twcLock:
+            now = time.monotonic()
+            slaveTWCs = {slaveTWC.TWCID: slaveTWC for slaveTWC in self.getSlaveTWCs()}
+            twcid, due = self.scheduler.getNextDue(slaveTWCs, now)
+            if twcid is None:
+                return None
+            wait = self.scheduler.getSendTime(due) - now
+            if wait > 0:
+                return wait
+
+            slaveTWC = slaveTWCs[twcid]
+            if now - slaveTWC.timeLastRxMonotonic > self.slaveTimeout:
+                # A real master stops sending heartbeats to a slave
+                # that hasn't responded for ~26 seconds. It may
+                # still send the slave a heartbeat every once in
+                # awhile but we're just going to scratch the slave
+                # from our little black book and add them again if
+                # they ever send us a linkready.
+                logger.info(
+                    "WARNING: We haven't heard from slave "
+                    "%02X%02X for over %d seconds.  "
+                    "Stop sending them heartbeat messages."
+                    % (slaveTWC.TWCID[0], slaveTWC.TWCID[1], self.slaveTimeout)
+                )
+                self.master.deleteSlaveTWC(slaveTWC.TWCID)
+                self.scheduler.forget(twcid)
+                return 0
+
+            slaveTWC.send_master_heartbeat()
+            self.scheduler.sent(twcid, now)
+        return self.scheduler.responseTime
+
+    def sendSlaveMessages(self):
+        # As long as a slave is running, it sends link ready messages every
+        # 10 seconds. They trigger any master on the network to handshake
+        # with the slave and the master then sends a status update from the
+        # slave every 1-3 seconds. Master's status updates trigger the slave
+        # to send back its own status update.
+        # As long as master has sent a status update within the last 10
+        # seconds, slaves don't send link ready.
+        # I've also verified that masters don't care if we stop sending link
+        # ready as long as we send status updates in response to master's
+        # status updates.
+        if self.config["config"]["fakeMaster"] == 2:
+            return None
+        now = time.monotonic()
+        wait = self.scheduler.getSendTime(self.scheduler.timeLastTx + 10.0) - now
+        if wait > 0:
+            return wait
+
+        fakeTWCID = self.master.getFakeTWCID()
+        logger.info(
+            "Advertise fake slave %02X%02X with sign %02X is "
+            "ready to link once per 10 seconds as long as master "
+            "hasn't sent a heartbeat in the last 10 seconds."
+            % (
+                fakeTWCID[0],
+                fakeTWCID[1],
+                ord(self.master.getSlaveSign()),
+            )
+        )
+        with self.master.twcLock:
+            self.master.send_slave_linkready(self)
+        return 10.0
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="TWCBus" + str(self.index), daemon=True
+        )
+        self.thread.start()
@@ -0,0 +1,171 @@
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+
+
+logger = logging.getLogger("\u26FD History")
+
+
+class TWCHistory:
+    # Stores the charger power history shown by the web interface.
+    #
+    # The history is recorded at a fixed interval, so it is kept in a ring
+    # buffer with one slot per interval, indexed by the number of intervals
+    # since the epoch. Adding a value and looking up a range of values never
+    # needs to search or filter the history, and the oldest values are
+    # overwritten once the retention period has passed.
+    #
+    # The buffer is an mmap'd file next to settings.json. It starts with a
+    # header, followed by an array holding the interval number of each slot
+    # and an array holding each slot's value. A slot whose interval number
+    # isn't the one being looked up holds an older value, and is treated as
+    # having no value.
+
+    header = struct.Struct("=4sHHII")
+    magic = b"TWCH"
+    version = 1
+
+    def __init__(self, path, interval=300, retention=172800):
+        self.interval = int(interval)
+        self.lock = threading.Lock()
+        self.map = None
+        self.path = path
+        self.periods = None
+        self.slots = int(math.ceil(retention / self.interval))
+        self.size = self.header.size + (self.slots * 8)
+        self.values = None
+
+        self.open()
+
+    def add(self, timestamp, value):
+        # Record value for the interval starting at timestamp
+        period = int(timestamp // self.interval)
+        with self.lock:
+            slot = period % self.slots
+            self.periods[slot] = period
+            self.values[slot] = value
+
+    def close(self):
+        with self.lock:
+            if self.map:
+                self.periods.release()
+                self.values.release()
+                self.map.close()
+                self.map = None
+
+    def flush(self):
+        # Write changes through to the history file
+        with self.lock:
+            if self.path:
+                self.map.flush()
+
+    def getRange(self, startTime, endTime):
+        # Returns a list with the value of each interval from the one
+        # containing startTime to the one containing endTime, inclusive.
+        # Intervals without a value are returned as 0.
+        start = int(startTime // self.interval)
+        end = int(endTime // self.interval)
+        result = []
+        with self.lock:
+            for period in range(start, end + 1):
+                slot = period % self.slots
+                if self.periods[slot] == period:
+                    result.append(self.values[slot])
+                else:
+                    result.append(0)
+        return result
+
+    def items(self):
+        # Returns (timestamp, value) for each interval in the history which
+        # has a value, oldest first
+        with self.lock:
+            return self.readItems(self.periods, self.values, self.interval)
+
+    def open(self):
+        existing = []
+        if self.path and os.path.exists(self.path) and not self.fileMatches():
+            # The file was written with a different interval or retention, so
+            # copy what we can from it into a new file
+            logger.info("Resizing history file " + self.path)
+            existing = self.readFile()
+            os.remove(self.path)
+
+        if self.path and not os.path.exists(self.path):
+            try:
+                with open(self.path, "wb") as historyFile:
+                    historyFile.write(
+                        self.header.pack(
+                            self.magic, self.version, self.interval, 0, self.slots
+                        )
+                    )
+                    historyFile.truncate(self.size)
+            except OSError as e:
+                logger.info(
+                    "Unable to create history file, charger history will not be kept after a restart: "
+                    + str(e)
+                )
+                self.path = None
+
+        if self.path:
+            with open(self.path, "r+b") as historyFile:
+                self.map = mmap.mmap(historyFile.fileno(), self.size)
+        else:
+            self.map = mmap.mmap(-1, self.size)
+
+        # The arrays of interval numbers and values are views of the mapped
+        # file, so updating them updates the file
+        view = memoryview(self.map)
+        offset = self.header.size + (self.slots * 4)
+        self.periods = view[self.header.size : offset].cast("I")
+        self.values = view[offset:].cast("f")
+        view.release()
+
+        for timestamp, value in existing:
+            self.add(timestamp, value)
+
+    def fileMatches(self):
+        # Returns True if the history file has the interval and retention
+        # we were asked for
+        try:
+            with open(self.path, "rb") as historyFile:
+                magic, version, interval, reserved, slots = self.header.unpack(
+                    historyFile.read(self.header.size)
+                )
+            return (
+                magic == self.magic
+                and version == self.version
+                and interval == self.interval
+                and slots == self.slots
+                and os.path.getsize(self.path) == self.size
+            )
+        except (OSError, struct.error):
+            return False
+
+    def readFile(self):
+        # Returns the (timestamp, value) pairs stored in the history file,
+        # or an empty list if it can't be read
+        try:
+            with open(self.path, "rb") as historyFile:
+                contents = historyFile.read()
+            magic, version, interval, reserved, slots = self.header.unpack_from(
+                contents
+            )
+            if magic != self.magic or version != self.version:
+                raise ValueError("not a history file")
+            offset = self.header.size + (slots * 4)
+            periods = memoryview(contents)[self.header.size : offset].cast("I")
+            values = memoryview(contents)[offset : offset + (slots * 4)].cast("f")
+            return self.readItems(periods, values, interval)
+        except (OSError, struct.error, TypeError, ValueError) as e:
+            logger.info("Unable to read history file: " + str(e))
+            return []
+
+    def readItems(self, periods, values, interval):
+        return sorted(
+            (periods[slot] * interval, values[slot])
+            for slot in range(len(periods))
+            if periods[slot]
+        )
@@ -1,33 +1,72 @@
 #! /usr/bin/python3
 
+from TWCManager.AsyncRuntime import AsyncRuntime
+from TWCManager.EMSPoller import EMSPoller
+from TWCManager.SolarPosition import SolarPosition
+from TWCManager.TWCBus import TWCBus
+from TWCManager.TWCHistory import TWCHistory
 from TWCManager.TWCSlave import TWCSlave
+from TWCManager.TaskScheduler import TaskScheduler
 from datetime import datetime, timedelta
+import hashlib
 import json
 import logging
 import os.path
-import queue
 from sys import modules
 import threading
 import time
 import math
 import random
 import requests
-import bisect
 
 logger = logging.getLogger("\u26FD Master")
 
 
 class TWCMaster:
     allowed_flex = 0
-    backgroundTasksQueue = queue.Queue()
-    backgroundTasksCmds = {}
+    ampsAllocationInterval = 1
+    ampsAllocationTime = 0
+    asyncRuntime = None
+    backgroundTasks = None
     backgroundTasksLock = threading.Lock()
-    backgroundTasksDelayed = []
+    # The worker pool and priority each background task runs with. Tasks
+    # which talk to the vehicles, poll the EMS modules, and call other
+    # services on the network each have their own pool, apart from the local
+    # tasks, so that a slow or unreachable API only delays tasks which use
+    # it. Tasks with a lower priority number run first, and unlisted tasks
+    # run locally with priority 5.
+    backgroundTaskTypes = {
+        "applyChargeLimit": ("vehicle", 2),
+        "carApiEmailPassword": ("vehicle", 1),
+        "charge": ("vehicle", 1),
+        "checkArrival": ("vehicle", 3),
+        "checkCharge": ("vehicle", 3),
+        "checkDeparture": ("vehicle", 3),
+        "checkGreenEnergy": ("energy", 1),
+        "checkPolicy": ("local", 1),
+        "checkMaxPowerFromGrid": ("energy", 1),
+        "checkVINEntitlement": ("local", 1),
+        "checkVehicleSync": ("vehicle", 4),
+        "getLifetimekWh": ("local", 2),
+        "getVehicleVIN": ("local", 1),
+        "saveSettings": ("local", 3),
+        "snapHistoryData": ("local", 4),
+        "sunrise": ("local", 5),
+        "updateStatus": ("local", 2),
+        "webhook": ("network", 3),
+        "writeSettings": ("local", 3),
+    }
+    backgroundTaskWorkers = {"energy": 1, "local": 1, "network": 1, "vehicle": 1}
+    buses = []
     config = None
     consumptionValues = {}
     consumptionAmpsValues = {}
     debugOutputToFile = False
+    emsLock = threading.Lock()
+    emsPoller = None
+    emsStale = []
     generationValues = {}
+    history = None
     lastMaxAmpsToDivideFromGrid = 0
     lastkWhMessage = time.time()
     lastkWhPoll = 0
@@ -42,6 +81,13 @@ class TWCMaster:
     overrideMasterHeartbeatData = b""
     protocolVersion = 2
     releasedModules = []
+    settingsHash = None
+    # Held while the settings are changed from a background task or saved,
+    # so that they aren't saved part way through a change
+    settingsLock = threading.RLock()
+    settingsSaveDelay = 5
+    settingsSaveScheduled = False
+    settingsSaveStats = {"requested": 0, "written": 0, "coalesced": 0, "unchanged": 0}
     settings = {
         "chargeNowAmps": 0,
         "chargeStopMode": "1",
@@ -65,9 +111,16 @@ class TWCMaster:
     slaveTWCRoundRobin = []
     stopTimeout = datetime.max
     spikeAmpsToCancel6ALimit = 16
+    # Counts the changes to the status, so that each caller of
+    # waitStatusChanged() can tell whether it has changed since it last looked
+    statusCondition = None
+    statusVersion = 0
     subtractChargerLoad = False
     treatGenerationAsGridDelivery = False
     teslaLoginAskLater = False
+    # Held while a message from a TWC is handled or a message is sent to
+    # one, so that the buses don't change the slave TWCs at the same time
+    twcLock = threading.RLock()
     TWCID = None
     updateVersion = False
     version = "1.3.2"
@@ -86,16 +139,43 @@ class TWCMaster:
         self.debugOutputToFile = config["config"].get("debugOutputToFile", False)
         self.TWCID = TWCID
         self.subtractChargerLoad = config["config"].get("subtractChargerLoad", False)
+        self.settingsSaveDelay = config["config"].get("settingsSaveDelay", 5)
+        self.emsPoller = EMSPoller(self)
+        self.solarPosition = SolarPosition()
+        self.statusCondition = threading.Condition()
+        self.backgroundTasks = TaskScheduler(
+            dict(
+                self.backgroundTaskWorkers,
+                **config["config"].get("backgroundTaskWorkers", {}),
+            )
+        )
         self.treatGenerationAsGridDelivery = config["config"].get(
             "treatGenerationAsGridDelivery", False
         )
+
+        # The charger power history is kept in its own file, rather than in
+        # settings.json, so that it can be updated without saving the settings
+        historyPath = None
+        if config["config"].get("settingsPath", None):
+            historyPath = config["config"]["settingsPath"] + "/history.bin"
+        self.history = TWCHistory(
+            historyPath,
+            retention=config["config"].get("historyRetentionDays", 7) * 86400,
+        )
         self.advanceHistorySnap()
 
+        # With the asyncio runtime, the buses, background tasks, web server
+        # and MQTT clients share one event loop rather than each having
+        # threads of their own
+        if config["config"].get("runtime", "threads") == "asyncio":
+            self.asyncRuntime = AsyncRuntime(self)
+
         # Register ourself as a module, allows lookups via the Module architecture
         self.registerModule({"name": "master", "ref": self, "type": "Master"})
 
     def addkWhDelivered(self, kWh):
-        self.settings["kWhDelivered"] = self.settings.get("kWhDelivered", 0) + kWh
+        with self.settingsLock:
+            self.settings["kWhDelivered"] = self.settings.get("kWhDelivered", 0) + kWh
 
     def addSlaveTWC(self, slaveTWC):
         # Adds the Slave TWC to the Round Robin list
@@ -110,6 +190,152 @@ class TWCMaster:
         except ValueError as e:
             logger.debug("Exception in advanceHistorySnap: " + str(e))
 
+    def allocateAmps(self):
+        # Work out how many amps to offer each slave TWC. This runs once per
+        # tick (see getAmpsAllocated()), and each slave's heartbeat then uses
+        # the amps allocated to it, so every slave's offer is worked out from
+        # the same readings rather than from whichever slaves happened to
+        # report in before it.
+
+        # Determine our charging policy. This is the policy engine of the
+        # TWCManager application. Using defined rules, we can determine how
+        # we charge.
+        self.getModuleByName("Policy").setChargingPerPolicy()
+
+        numCarsCharging = self.num_cars_charging_now()
+        maxAmps = self.getMaxAmpsToDivideAmongSlaves()
+        slaveTWCs = self.getSlaveTWCs()
+        charging = [
+            slaveTWC for slaveTWC in slaveTWCs if slaveTWC.reportedAmpsActual >= 1.0
+        ]
+
+        if numCarsCharging > 0:
+            # The cars which are charging share the available amps fairly:
+            # each gets the same share, except that a TWC is never given more
+            # than it can use, and whatever it can't use is shared among the
+            # others.
+            flex = self.getAllowedFlex() / numCarsCharging
+            shares = self.waterFill(
+                min(maxAmps, self.config["config"]["wiringMaxAmpsAllTWCs"]),
+                charging,
+            )
+
+            # TWCs without a car charging are offered what's left over,
+            # but no more than a car's share
+            spareAmps = min(
+                maxAmps - sum(shares.values()), int(maxAmps / numCarsCharging)
+            )
+        else:
+            # With no cars charging, each TWC is offered all of the available
+            # amps, so that a car plugged in to any of them can start. Once
+            # one starts, it is given its share as above.
+            flex = self.getAllowedFlex()
+            shares = {}
+            spareAmps = maxAmps
+
+        for slaveTWC in slaveTWCs:
+            minAmpsToOffer = slaveTWC.getMinAmpsToOffer()
+            desiredAmpsOffered = shares.get(slaveTWC.TWCID, max(spareAmps, 0))
+
+            if (
+                desiredAmpsOffered < minAmpsToOffer
+                and desiredAmpsOffered + flex >= minAmpsToOffer
+                and (
+                    slaveTWC.useFlexAmpsToStartCharge
+                    or slaveTWC.reportedAmpsActual >= 1.0
+                )
+            ):
+                desiredAmpsOffered = minAmpsToOffer
+
+            if desiredAmpsOffered < minAmpsToOffer:
+                if numCarsCharging > 0 and maxAmps / numCarsCharging > minAmpsToOffer:
+                    # There is enough power available to give each car
+                    # minAmpsToOffer, but currently-charging cars are leaving us
+                    # less power than minAmpsToOffer to give this car.
+                    #
+                    # minAmpsToOffer is based on minAmpsPerTWC which is
+                    # user-configurable, whereas slaveTWC.minAmpsTWCSupports is
+                    # based on the minimum amps TWC must be set to reliably start
+                    # a car charging.
+                    #
+                    # Unfortunately, we can't tell if a car is plugged in or wanting
+                    # to charge without offering it minAmpsTWCSupports. As the car
+                    # gradually starts to charge, we will see it using power and
+                    # give the other TWCs less power. This could cause the sum of
+                    # power used by all TWCs to exceed wiringMaxAmpsAllTWCs for a
+                    # few seconds, but I don't think exceeding by up to
+                    # minAmpsTWCSupports for such a short period of time will cause
+                    # problems.
+                    logger.debug(
+                        "desiredAmpsOffered TWC: "
+                        + self.hex_str(slaveTWC.TWCID)
+                        + " increased from "
+                        + str(desiredAmpsOffered)
+                        + " to "
+                        + str(slaveTWC.minAmpsTWCSupports)
+                        + " (minAmpsTWCSupports)"
+                    )
+                    desiredAmpsOffered = slaveTWC.minAmpsTWCSupports
+                else:
+                    # There is not enough power available to give each car
+                    # minAmpsToOffer, so don't offer power to any cars. Alternately,
+                    # we could charge one car at a time and switch cars
+                    # periodically, but I'm not going to try to implement that.
+                    #
+                    # Note that 5A is the lowest value you can set using the Tesla car's
+                    # main screen, so lower values might have some adverse affect on the
+                    # car. I actually tried lower values when the sun was providing
+                    # under 5A of power and found the car would occasionally set itself
+                    # to state 03 and refuse to charge until you re-plugged the charger
+                    # cable. Clicking "Start charging" in the car's UI or in the phone
+                    # app would not start charging.
+                    #
+                    # A 5A charge only delivers ~3 miles of range to the car per hour,
+                    # but it forces the car to remain "on" at a level that it wastes
+                    # some power while it's charging. The lower the amps, the more power
+                    # is wasted. This is another reason not to go below 5A.
+                    #
+                    # So if there isn't at least 5A of power available, pass 0A as the
+                    # desired value. This tells the car to stop charging and it will
+                    # enter state 03 and go to sleep. You will hear the power relay in
+                    # the TWC turn off. When desiredAmpsOffered trends above 6A again,
+                    # it tells the car there's power.
+                    # If a car is set to energy saver mode in the car's UI, the car
+                    # seems to wake every 15 mins or so (unlocking or using phone app
+                    # also wakes it) and next time it wakes, it will see there's power
+                    # and start charging. Without energy saver mode, the car should
+                    # begin charging within about 10 seconds of changing this value.
+                    logger.debug(
+                        "desiredAmpsOffered TWC: "
+                        + self.hex_str(slaveTWC.TWCID)
+                        + " reduced to 0 from "
+                        + str(desiredAmpsOffered)
+                        + " because maxAmpsToDivideAmongSlaves "
+                        + str(maxAmps)
+                        + " / numCarsCharging "
+                        + str(numCarsCharging)
+                        + " < minAmpsToOffer "
+                        + str(minAmpsToOffer)
+                    )
+                    desiredAmpsOffered = 0
+
+            slaveTWC.ampsAllocated = desiredAmpsOffered
+
+        logger.debug(
+            "Allocated "
+            + ", ".join(
+                self.hex_str(slaveTWC.TWCID) + ": " + str(slaveTWC.ampsAllocated)
+                for slaveTWC in slaveTWCs
+            )
+            + " of "
+            + str(maxAmps)
+            + "A with "
+            + str(numCarsCharging)
+            + " cars charging and flex Amps of "
+            + str(flex)
+            + "."
+        )
+
     def cancelStopCarsCharging(self):
         self.delete_background_task({"cmd": "charge", "charge": False})
 
@@ -257,45 +483,26 @@ class TWCMaster:
         return int(len(self.slaveTWCRoundRobin))
 
     def delete_background_task(self, task):
-        if (
-            task["cmd"] in self.backgroundTasksCmds
-            and self.backgroundTasksCmds[task["cmd"]] == task
-        ):
-            del self.backgroundTasksCmds[task["cmd"]]["cmd"]
-            del self.backgroundTasksCmds[task["cmd"]]
-
-    def doneBackgroundTask(self, task):
-        # Delete task['cmd'] from backgroundTasksCmds such that
-        # queue_background_task() can queue another task['cmd'] in the future.
-        if "cmd" in task:
-            del self.backgroundTasksCmds[task["cmd"]]
-
-        # task_done() must be called to let the queue know the task is finished.
-        # backgroundTasksQueue.join() can then be used to block until all tasks
-        # in the queue are done.
-        self.backgroundTasksQueue.task_done()
+        self.backgroundTasks.cancel(task["cmd"], task)
 
     def getAllowedFlex(self):
         return self.allowedFlex
 
-    def getBackgroundTask(self):
-        result = None
-
-        while result is None:
-            # Insert any delayed tasks
-            while (
-                self.backgroundTasksDelayed
-                and self.backgroundTasksDelayed[0][0] <= datetime.now()
-            ):
-                self.queue_background_task(self.backgroundTasksDelayed.pop(0)[1])
-
-            # Get the next task
-            try:
-                result = self.backgroundTasksQueue.get(timeout=30)
-            except queue.Empty:
-                continue
+    def getAmpsAllocated(self, slaveTWC):
+        # Returns the amps allocated to slaveTWC for the current tick. The
+        # first heartbeat of each tick works out the allocation for every
+        # slave, and the rest use it.
+        now = time.time()
+        if (
+            now - self.ampsAllocationTime >= self.ampsAllocationInterval
+            or slaveTWC.ampsAllocated is None
+        ):
+            self.ampsAllocationTime = now
+            self.allocateAmps()
+        return slaveTWC.ampsAllocated
 
-        return result
+    def getBackgroundTaskStats(self):
+        return self.backgroundTasks.getStats()
 
     def getBackgroundTasksLock(self):
         self.backgroundTasksLock.acquire()
@@ -357,8 +564,13 @@ class TWCMaster:
                 matched.append({"name": module, "ref": modinfo["ref"]})
         return matched
 
-    def getInterfaceModule(self):
-        return self.getModulesByType("Interface")[0]["ref"]
+    def getInterfaces(self):
+        # Returns every interface to a TWC load sharing network. An Interface
+        # module may drive several networks, one for each of its instances.
+        interfaces = []
+        for module in self.getModulesByType("Interface"):
+            interfaces.extend(module["ref"].instances)
+        return interfaces
 
     def getScheduledAmpsDaysBitmap(self):
         return self.settings.get("scheduledAmpsDaysBitmap", 0x7F)
@@ -438,7 +650,7 @@ class TWCMaster:
         now = time.time()
         if now >= self.lastkWhPoll + 60:
             for slaveTWC in self.getSlaveTWCs():
-                self.getInterfaceModule().send(
+                slaveTWC.bus.send(
                     bytearray(b"\xFB\xEB")
                     + self.TWCID
                     + slaveTWC.TWCID
@@ -449,6 +661,21 @@ class TWCMaster:
     def getSlaveSign(self):
         return self.slaveSign
 
+    def getSolarDay(self, date=None, curve=False):
+        # Returns the times of sunrise, solar noon and sunset at home on date
+        # (today by default), or None if we don't know where home is. If
+        # curve is True, the elevation of the sun through the day is added.
+        lat, lon = self.getHomeLatLon()
+        if lat == 10000 or lon == 10000:
+            return None
+        if date is None:
+            date = datetime.now().date()
+        day = self.solarPosition.getDay(lat, lon, date)
+        if curve:
+            day["elevation"] = self.solarPosition.getElevation(lat, lon, time.time())
+            day["elevationCurve"] = self.solarPosition.getElevationCurve(lat, lon, date)
+        return day
+
     def getStatus(self):
         chargerLoad = float(self.getChargerLoad())
         data = {
@@ -477,6 +704,9 @@ class TWCMaster:
         else:
             data["generationAmps"] = "%.2f" % 0
             data["generationWatts"] = "%.2f" % 0
+        # EMS modules which didn't respond in time, whose last values are
+        # being used
+        data["staleEMSSources"] = list(self.emsStale)
         if self.getModuleByName("Policy").policyIsGreen():
             data["isGreenPolicy"] = "Yes"
         else:
@@ -529,12 +759,15 @@ class TWCMaster:
         }
         return data
 
+    def getStatusVersion(self):
+        # Returns the number of times the status has changed, to pass to
+        # waitStatusChanged()
+        with self.statusCondition:
+            return self.statusVersion
+
     def getSpikeAmps(self):
         return self.spikeAmpsToCancel6ALimit
 
-    def getTimeLastTx(self):
-        return self.getInterfaceModule().timeLastTx
-
     def getTWCbyVIN(self, vin):
         twc = None
         for slaveTWC in self.getSlaveTWCs():
@@ -551,8 +784,9 @@ class TWCMaster:
         if int(part) == 2:
             prefixByte = bytearray(b"\xFB\xF1")
 
-        if prefixByte:
-            self.getInterfaceModule().send(
+        slaveTWC = self.slaveTWCs.get(slaveID, None)
+        if prefixByte and slaveTWC:
+            slaveTWC.bus.send(
                 prefixByte
                 + self.TWCID
                 + slaveID
@@ -578,8 +812,9 @@ class TWCMaster:
     def getConsumption(self):
         consumptionVal = 0
 
-        for key in self.consumptionValues:
-            consumptionVal += float(self.consumptionValues[key])
+        with self.emsLock:
+            for key in self.consumptionValues:
+                consumptionVal += float(self.consumptionValues[key])
 
         if consumptionVal < 0:
             consumptionVal = 0
@@ -593,8 +828,9 @@ class TWCMaster:
     def getConsumptionAmps(self):
         consumptionAmpsVal = 0
 
-        for key in self.consumptionAmpsValues:
-            consumptionAmpsVal += float(self.consumptionAmpsValues[key])
+        with self.emsLock:
+            for key in self.consumptionAmpsValues:
+                consumptionAmpsVal += float(self.consumptionAmpsValues[key])
 
         if consumptionAmpsVal < 0:
             consumptionAmpsVal = 0
@@ -608,8 +844,9 @@ class TWCMaster:
         generationVal = 0
 
         # Currently, our only logic is to add all of the values together
-        for key in self.generationValues:
-            generationVal += float(self.generationValues[key])
+        with self.emsLock:
+            for key in self.generationValues:
+                generationVal += float(self.generationValues[key])
 
         if generationVal < 0:
             generationVal = 0
@@ -633,6 +870,18 @@ class TWCMaster:
             generationOffset = 0
         return float(generationOffset)
 
+    def getHeartbeatStats(self):
+        # Returns for each slave TWC the bus it is on, and how many heartbeats
+        # we have sent it and how late they were sent
+        result = {}
+        with self.twcLock:
+            for bus in self.buses:
+                for twcid, stats in bus.getHeartbeatStats().items():
+                    result["%02X%02X" % (twcid[0], twcid[1])] = dict(
+                        stats, bus=bus.index
+                    )
+        return result
+
     def getHomeLatLon(self):
         # Returns Lat/Lon coordinates to check if car location is
         # at home
@@ -812,7 +1061,9 @@ class TWCMaster:
             self.config["config"]["settingsPath"] + "/settings.json", "r"
         ) as inconfig:
             try:
-                self.settings = json.load(inconfig)
+                contents = inconfig.read()
+                self.settingsHash = hashlib.sha1(contents.encode("utf-8")).digest()
+                self.settings = json.loads(contents)
             except Exception as e:
                 logger.info(
                     "There was an exception whilst loading settings file "
@@ -857,6 +1108,13 @@ class TWCMaster:
                 "Built-in": 1,
                 "Members": [],
             }
+        # Move any history recorded by earlier versions into the history file
+        if "history" in self.settings:
+            for timestamp, watts in self.settings["history"]:
+                self.history.add(datetime.fromisoformat(timestamp).timestamp(), watts)
+            self.history.flush()
+            del self.settings["history"]
+
         # Fill in old defaults as bridge
         if not self.settings.get("sunrise", None):
             self.settings["sunrise"] = 6
@@ -878,29 +1136,49 @@ class TWCMaster:
             % (self.TWCID[0], self.TWCID[1], self.slaveSign[0])
         )
 
-    def newSlave(self, newSlaveID, maxAmps):
+    def newSlave(self, newSlaveID, maxAmps, bus=None):
+        # Returns the slave TWC with ID newSlaveID on bus, adding it if it's
+        # one we haven't seen before
+        if bus is None:
+            bus = self.buses[0]
         try:
             slaveTWC = self.slaveTWCs[newSlaveID]
             # We didn't get KeyError exception, so this slave is already in
-            # slaveTWCs and we can simply return it.
-            return slaveTWC
+            # slaveTWCs and we can simply return it, unless it has moved to
+            # another bus.
+            if slaveTWC.bus is bus:
+                return slaveTWC
+            logger.info(
+                "Slave TWC %s has moved to bus %d."
+                % (self.hex_str(newSlaveID), bus.index)
+            )
         except KeyError:
-            pass
+            slaveTWC = TWCSlave(newSlaveID, maxAmps, self.config, self)
+            self.slaveTWCs[newSlaveID] = slaveTWC
+            self.addSlaveTWC(slaveTWC)
 
-        slaveTWC = TWCSlave(newSlaveID, maxAmps, self.config, self)
-        self.slaveTWCs[newSlaveID] = slaveTWC
-        self.addSlaveTWC(slaveTWC)
+        slaveTWC.bus = bus
 
-        if self.countSlaveTWC() > 3:
+        # Each load sharing network holds at most 3 slave TWCs, but there may
+        # be more than that across all of the buses
+        busSlaveTWCs = bus.getSlaveTWCs()
+        if len(busSlaveTWCs) > 3:
             logger.info(
                 "WARNING: More than 3 slave TWCs seen on network. Dropping oldest: "
-                + self.hex_str(self.getSlaveTWCID(0))
+                + self.hex_str(busSlaveTWCs[0].TWCID)
                 + "."
             )
-            self.deleteSlaveTWC(self.getSlaveTWCID(0))
+            self.deleteSlaveTWC(busSlaveTWCs[0].TWCID)
 
         return slaveTWC
 
+    def notifyStatusChanged(self):
+        # Called whenever a value reported by getStatus() or by a slave TWC
+        # changes, to wake anything waiting in waitStatusChanged()
+        with self.statusCondition:
+            self.statusVersion += 1
+            self.statusCondition.notify_all()
+
     def num_cars_charging_now(self):
         carsCharging = 0
         for slaveTWC in self.getSlaveTWCs():
@@ -960,27 +1238,11 @@ class TWCMaster:
         return carsCharging
 
     def queue_background_task(self, task, delay=0):
-        if delay > 0:
-            bisect.insort(
-                self.backgroundTasksDelayed,
-                (datetime.now() + timedelta(seconds=delay), task),
-            )
-            return
-
-        if task["cmd"] in self.backgroundTasksCmds:
-            # Some tasks, like cmd='charge', will be called once per second until
-            # a charge starts or we determine the car is done charging.  To avoid
-            # wasting memory queing up a bunch of these tasks when we're handling
-            # a charge cmd already, don't queue two of the same task.
-            self.backgroundTasksCmds[task["cmd"]].update(task)
-            return
-
-        # Insert task['cmd'] in backgroundTasksCmds to prevent queuing another
-        # task['cmd'] till we've finished handling this one.
-        self.backgroundTasksCmds[task["cmd"]] = task
-
-        # Queue the task to be handled by background_tasks_thread.
-        self.backgroundTasksQueue.put(task)
+        # Queue the task to be handled by run_background_task. While a task
+        # with the same cmd is waiting or running, this updates that task
+        # instead of queuing another.
+        category, priority = self.backgroundTaskTypes.get(task["cmd"], ("local", 5))
+        self.backgroundTasks.queue(task["cmd"], task, category, priority, delay)
 
     def registerModule(self, module):
         # This function is used during module instantiation to either reference a
@@ -1021,18 +1283,19 @@ class TWCMaster:
         # This function is called when a vehicle charge session ends.
         # If we have a last vehicle VIN set, close off the charging session
         # for this vehicle and save the settings.
-        if not self.settings.get("Vehicles", None):
-            self.settings["Vehicles"] = {}
-        if self.settings["Vehicles"].get(slaveTWC.lastVIN, None):
-            if self.settings["Vehicles"][slaveTWC.lastVIN].get("startkWh", 0) > 0:
-                # End current session
-                delta = (
-                    slaveTWC.lifetimekWh
-                    - self.settings["Vehicles"][slaveTWC.lastVIN]["startkWh"]
-                )
-                self.settings["Vehicles"][slaveTWC.lastVIN]["startkWh"] = 0
-                self.settings["Vehicles"][slaveTWC.lastVIN]["totalkWh"] += delta
-                self.queue_background_task({"cmd": "saveSettings"})
+        with self.settingsLock:
+            if not self.settings.get("Vehicles", None):
+                self.settings["Vehicles"] = {}
+            if self.settings["Vehicles"].get(slaveTWC.lastVIN, None):
+                if self.settings["Vehicles"][slaveTWC.lastVIN].get("startkWh", 0) > 0:
+                    # End current session
+                    delta = (
+                        slaveTWC.lifetimekWh
+                        - self.settings["Vehicles"][slaveTWC.lastVIN]["startkWh"]
+                    )
+                    self.settings["Vehicles"][slaveTWC.lastVIN]["startkWh"] = 0
+                    self.settings["Vehicles"][slaveTWC.lastVIN]["totalkWh"] += delta
+                    self.queue_background_task({"cmd": "saveSettings"})
 
         # Update Charge Session details in logging modules
         logger.info(
@@ -1069,30 +1332,33 @@ class TWCMaster:
         # Record Slave TWC ID as being capable of reporting VINs, if it is not
         # already.
         twcid = "%02X%02X" % (slaveTWC.TWCID[0], slaveTWC.TWCID[1])
-        if not self.settings.get("SlaveTWCs", None):
-            self.settings["SlaveTWCs"] = {}
-        if not self.settings["SlaveTWCs"].get(twcid, None):
-            self.settings["SlaveTWCs"][twcid] = {}
-        if not self.settings["SlaveTWCs"][twcid].get("supportsVINQuery", 0):
-            self.settings["SlaveTWCs"][twcid]["supportsVINQuery"] = 1
-            self.queue_background_task({"cmd": "saveSettings"})
-
-        # Increment sessions counter for this VIN in persistent settings file
-        if not self.settings.get("Vehicles", None):
-            self.settings["Vehicles"] = {}
-        if not self.settings["Vehicles"].get(slaveTWC.currentVIN, None):
-            self.settings["Vehicles"][slaveTWC.currentVIN] = {
-                "chargeSessions": 1,
-                "startkWh": slaveTWC.lifetimekWh,
-                "totalkWh": 0,
-            }
-        else:
-            self.settings["Vehicles"][slaveTWC.currentVIN]["chargeSessions"] += 1
-            self.settings["Vehicles"][slaveTWC.currentVIN][
-                "startkWh"
-            ] = slaveTWC.lifetimekWh
-            if not self.settings["Vehicles"][slaveTWC.currentVIN].get("totalkWh", None):
-                self.settings["Vehicles"][slaveTWC.currentVIN]["totalkWh"] = 0
+        with self.settingsLock:
+            if not self.settings.get("SlaveTWCs", None):
+                self.settings["SlaveTWCs"] = {}
+            if not self.settings["SlaveTWCs"].get(twcid, None):
+                self.settings["SlaveTWCs"][twcid] = {}
+            if not self.settings["SlaveTWCs"][twcid].get("supportsVINQuery", 0):
+                self.settings["SlaveTWCs"][twcid]["supportsVINQuery"] = 1
+                self.queue_background_task({"cmd": "saveSettings"})
+
+            # Increment sessions counter for this VIN in persistent settings file
+            if not self.settings.get("Vehicles", None):
+                self.settings["Vehicles"] = {}
+            if not self.settings["Vehicles"].get(slaveTWC.currentVIN, None):
+                self.settings["Vehicles"][slaveTWC.currentVIN] = {
+                    "chargeSessions": 1,
+                    "startkWh": slaveTWC.lifetimekWh,
+                    "totalkWh": 0,
+                }
+            else:
+                self.settings["Vehicles"][slaveTWC.currentVIN]["chargeSessions"] += 1
+                self.settings["Vehicles"][slaveTWC.currentVIN][
+                    "startkWh"
+                ] = slaveTWC.lifetimekWh
+                if not self.settings["Vehicles"][slaveTWC.currentVIN].get(
+                    "totalkWh", None
+                ):
+                    self.settings["Vehicles"][slaveTWC.currentVIN]["totalkWh"] = 0
         self.queue_background_task({"cmd": "saveSettings"})
 
         # Update Charge Session details in logging modules
@@ -1128,9 +1394,13 @@ class TWCMaster:
         )
 
     def removeNormalChargeLimit(self, ID):
-        if "chargeLimits" in self.settings and str(ID) in self.settings["chargeLimits"]:
-            del self.settings["chargeLimits"][str(ID)]
-            self.queue_background_task({"cmd": "saveSettings"})
+        with self.settingsLock:
+            if (
+                "chargeLimits" in self.settings
+                and str(ID) in self.settings["chargeLimits"]
+            ):
+                del self.settings["chargeLimits"][str(ID)]
+                self.queue_background_task({"cmd": "saveSettings"})
 
     def resetChargeNowAmps(self):
         # Sets chargeNowAmps back to zero, so we follow the green energy
@@ -1163,39 +1433,119 @@ class TWCMaster:
                 slaveTWC.lastVINQuery = 0
 
     def saveNormalChargeLimit(self, ID, outsideLimit, lastApplied):
-        if not "chargeLimits" in self.settings:
-            self.settings["chargeLimits"] = dict()
+        with self.settingsLock:
+            if not "chargeLimits" in self.settings:
+                self.settings["chargeLimits"] = dict()
 
-        self.settings["chargeLimits"][str(ID)] = (outsideLimit, lastApplied)
+            self.settings["chargeLimits"][str(ID)] = (outsideLimit, lastApplied)
         self.queue_background_task({"cmd": "saveSettings"})
 
     def saveSettings(self):
-        # Saves the volatile application settings (such as charger timings,
-        # API credentials, etc) to a JSON file
+        # Requests that the volatile application settings (such as charger
+        # timings, API credentials, etc) are saved to a JSON file.
+        #
+        # Settings are changed in bursts, so rather than writing the file for
+        # every change, the file is written settingsSaveDelay seconds after
+        # the first request, along with any other changes requested in the
+        # meantime.
+        with self.settingsLock:
+            self.settingsSaveStats["requested"] += 1
+            if self.settingsSaveScheduled:
+                self.settingsSaveStats["coalesced"] += 1
+                return
+
+            if self.settingsSaveDelay > 0:
+                self.settingsSaveScheduled = True
+                self.queue_background_task(
+                    {"cmd": "writeSettings"}, delay=self.settingsSaveDelay
+                )
+                return
+        self.writeSettings()
+
+    def writeSettings(self):
+        # Saves the volatile application settings to a JSON file, unless they
+        # haven't changed since they were last loaded or saved
         fileName = self.config["config"]["settingsPath"] + "/settings.json"
 
-        # Step 1 - Merge any config from other modules
-        carapi = self.getModuleByName("TeslaAPI")
-        self.settings["carApiBearerToken"] = carapi.getCarApiBearerToken()
-        self.settings["carApiRefreshToken"] = carapi.getCarApiRefreshToken()
-        self.settings["carApiTokenExpireTime"] = carapi.getCarApiTokenExpireTime()
+        with self.settingsLock:
+            # Any change made from now on needs another save
+            self.settingsSaveScheduled = False
+
+            # Step 1 - Merge any config from other modules
+            carapi = self.getModuleByName("TeslaAPI")
+            self.settings["carApiBearerToken"] = carapi.getCarApiBearerToken()
+            self.settings["carApiRefreshToken"] = carapi.getCarApiRefreshToken()
+            self.settings["carApiTokenExpireTime"] = carapi.getCarApiTokenExpireTime()
+
+            # Step 2 - Serialize the settings, and skip writing them if they
+            # are the same as the file already contains. Not every change to
+            # the settings is made holding settingsLock, so a change made
+            # while they are serialized raises RuntimeError, in which case we
+            # try again shortly.
+            try:
+                contents = json.dumps(self.settings)
+            except RuntimeError as e:
+                logger.log(
+                    logging.INFO8, "Settings changed while saving, will retry: %s", e
+                )
+                contents = None
+            except (TypeError, ValueError) as e:
+                logger.info("Exception raised while attempting to save settings file:")
+                logger.info(str(e))
+                self.lastSaveFailed = 1
+                return
+        if contents is None:
+            self.saveSettings()
+            return
+        settingsHash = hashlib.sha1(contents.encode("utf-8")).digest()
+        if settingsHash == self.settingsHash:
+            self.settingsSaveStats["unchanged"] += 1
+            return
 
-        # Step 2 - Write the settings dict to a JSON file
+        # Step 3 - Write the settings to a temporary file and rename it over
+        # the settings file, so that the settings file is never left partly
+        # written if we are interrupted. The settings hold API tokens and
+        # private keys, so only we may read the file. The directory is synced
+        # too, so that the rename itself is on disk.
+        tempFileName = fileName + ".tmp"
         try:
-            with open(fileName, "w") as outconfig:
-                json.dump(self.settings, outconfig)
+            fd = os.open(tempFileName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as outconfig:
+                # An earlier temporary file may have been left with other modes
+                os.fchmod(outconfig.fileno(), 0o600)
+                outconfig.write(contents)
+                outconfig.flush()
+                os.fsync(outconfig.fileno())
+            os.replace(tempFileName, fileName)
+            dirFd = os.open(os.path.dirname(fileName) or ".", os.O_RDONLY)
+            try:
+                os.fsync(dirFd)
+            finally:
+                os.close(dirFd)
             self.lastSaveFailed = 0
         except PermissionError as e:
             logger.info(
                 "Permission Denied trying to save to settings.json. Please check the permissions of the file and try again."
             )
             self.lastSaveFailed = 1
-        except TypeError as e:
+            return
+        except OSError as e:
             logger.info("Exception raised while attempting to save settings file:")
             logger.info(str(e))
             self.lastSaveFailed = 1
+            return
 
-    def send_master_linkready1(self):
+        self.settingsHash = settingsHash
+        self.settingsSaveStats["written"] += 1
+        logger.log(
+            logging.INFO8,
+            "Saved settings file. %d writes, %d requests combined, %d unchanged",
+            self.settingsSaveStats["written"],
+            self.settingsSaveStats["coalesced"],
+            self.settingsSaveStats["unchanged"],
+        )
+
+    def send_master_linkready1(self, bus):
         logger.log(logging.INFO8, "Send master linkready1")
 
         # When master is powered on or reset, it sends 5 to 7 copies of this
@@ -1244,14 +1594,14 @@ class TWCMaster:
         # send slave linkready every 10 seconds whether or not they got master
         # linkready1/2 and if a master sees slave linkready, it will start sending
         # the slave master heartbeat once per second and the two are then connected.
-        self.getInterfaceModule().send(
+        bus.send(
             bytearray(b"\xFC\xE1")
             + self.TWCID
             + self.masterSign
             + bytearray(b"\x00\x00\x00\x00\x00\x00\x00\x00")
         )
 
-    def send_master_linkready2(self):
+    def send_master_linkready2(self, bus):
         logger.log(logging.INFO8, "Send master linkready2")
 
         # This linkready2 message is also sent 5 times when master is booted/reset
@@ -1270,14 +1620,14 @@ class TWCMaster:
         # Once a master starts sending heartbeat messages to a slave, it
         # no longer sends the global linkready2 message (or if it does,
         # they're quite rare so I haven't seen them).
-        self.getInterfaceModule().send(
+        bus.send(
             bytearray(b"\xFB\xE2")
             + self.TWCID
             + self.masterSign
             + bytearray(b"\x00\x00\x00\x00\x00\x00\x00\x00")
         )
 
-    def send_slave_linkready(self):
+    def send_slave_linkready(self, bus):
         # In the message below, \x1F\x40 (hex 0x1f40 or 8000 in base 10) refers to
         # this being a max 80.00Amp charger model.
         # EU chargers are 32A and send 0x0c80 (3200 in base 10).
@@ -1295,12 +1645,22 @@ class TWCMaster:
         if self.protocolVersion == 2:
             msg += bytearray(b"\x00\x00")
 
-        self.getInterfaceModule().send(msg)
+        bus.send(msg)
+
+    def sendMessage(self, msg):
+        # Sends a message given to us by the web interface. It goes out on
+        # the bus of the slave TWC it is addressed to if we know that TWC,
+        # or on the first bus if we don't.
+        bus = self.buses[0]
+        slaveTWC = self.slaveTWCs.get(bytes(msg[4:6]), None)
+        if slaveTWC and slaveTWC.bus:
+            bus = slaveTWC.bus
+        bus.send(msg)
 
     def sendStartCommand(self):
         # This function will loop through each of the Slave TWCs, and send them the start command.
         for slaveTWC in self.getSlaveTWCs():
-            self.getInterfaceModule().send(
+            slaveTWC.bus.send(
                 bytearray(b"\xFC\xB1")
                 + self.TWCID
                 + slaveTWC.TWCID
@@ -1312,7 +1672,7 @@ class TWCMaster:
         # If the subTWC parameter is supplied, we only stop the specified TWC
         for slaveTWC in self.getSlaveTWCs():
             if (not subTWC) or (subTWC == slaveTWC.TWCID):
-                self.getInterfaceModule().send(
+                slaveTWC.bus.send(
                     bytearray(b"\xFC\xB2")
                     + self.TWCID
                     + slaveTWC.TWCID
@@ -1341,13 +1701,53 @@ class TWCMaster:
         # Accepts consumption values from one or more data sources
         # For now, this gives a sum value of all, but in future we could
         # average across sources perhaps, or do a primary/secondary priority
-        self.consumptionValues[source] = value
+        with self.emsLock:
+            changed = self.consumptionValues.get(source, None) != value
+            self.consumptionValues = dict(self.consumptionValues, **{source: value})
+        if changed:
+            self.notifyStatusChanged()
 
     def setConsumptionAmps(self, source, value):
-        self.consumptionAmpsValues[source] = value
+        with self.emsLock:
+            self.consumptionAmpsValues = dict(
+                self.consumptionAmpsValues, **{source: value}
+            )
+
+    def setEMSSamples(self, samples):
+        # Replaces the consumption and generation values of every EMS module
+        # at once with the values read by EMSPoller.poll(), so that they are
+        # never read part way through being updated
+        consumption = {}
+        consumptionAmps = {}
+        generation = {}
+        stale = []
+        for name, sample in samples.items():
+            consumption[name] = sample["consumption"]
+            if "consumptionAmps" in sample:
+                consumptionAmps[name] = sample["consumptionAmps"]
+            generation[name] = sample["generation"]
+            if sample["stale"]:
+                stale.append(name)
+
+        with self.emsLock:
+            changed = (
+                consumption != self.consumptionValues
+                or generation != self.generationValues
+                or stale != self.emsStale
+            )
+            self.consumptionValues = consumption
+            self.consumptionAmpsValues = consumptionAmps
+            self.generationValues = generation
+            self.emsStale = stale
+        if changed:
+            self.notifyStatusChanged()
 
     def setGeneration(self, source, value):
-        self.generationValues[source] = value
+        with self.emsLock:
+            changed = self.generationValues.get(source, None) != value
+            self.generationValues = dict(self.generationValues, **{source: value})
+        if changed:
+            self.notifyStatusChanged()
 
     def setHomeLat(self, lat):
         self.settings["homeLat"] = lat
@@ -1458,24 +1858,25 @@ class TWCMaster:
 
         if avgCurrent > 0:
             periodTimestamp = snaptime - timedelta(minutes=5)
-
-            if not "history" in self.settings:
-                self.settings["history"] = []
-
-            self.settings["history"].append(
-                (
-                    periodTimestamp.isoformat(timespec="seconds"),
-                    self.convertAmpsToWatts(avgCurrent)
-                    * self.getRealPowerFactor(avgCurrent),
-                )
+            self.history.add(
+                periodTimestamp.timestamp(),
+                self.convertAmpsToWatts(avgCurrent)
+                * self.getRealPowerFactor(avgCurrent),
             )
-
-            self.settings["history"] = [
-                e
-                for e in self.settings["history"]
-                if datetime.fromisoformat(e[0]) >= (now - timedelta(days=2))
-            ]
-            self.queue_background_task({"cmd": "saveSettings"})
+            self.history.flush()
+
+    def startBuses(self, handlers):
+        # Start driving each TWC load sharing network, handling the messages
+        # received on it with handlers
+        self.buses = [
+            TWCBus(self, interface, handlers, index)
+            for index, interface in enumerate(self.getInterfaces())
+        ]
+        for bus in self.buses:
+            if self.asyncRuntime:
+                self.asyncRuntime.startBus(bus)
+            else:
+                bus.start()
 
     def startCarsCharging(self):
         # This function is the opposite functionality to the stopCarsCharging function
@@ -1489,6 +1890,14 @@ class TWCMaster:
         elif stopMode == 3:
             self.queue_background_task({"cmd": "charge", "charge": True})
 
+    def startMQTTLoop(self, client):
+        # Start handling the network traffic of an MQTT client, after
+        # connect_async() has been called on it
+        if self.asyncRuntime:
+            self.asyncRuntime.attachMQTT(client)
+        else:
+            client.loop_start()
+
     def stopCarsCharging(self):
         # This is called by components (mainly TWCSlave) who want to signal to us to
         # call our configured routine for stopping vehicles from charging.
@@ -1578,8 +1987,36 @@ class TWCMaster:
                     slaveTWC.lastVIN,
                     "",
                 )
+        self.notifyStatusChanged()
+
+    def waterFill(self, amps, slaveTWCs):
+        # Share amps among slaveTWCs so that the smallest share is as large
+        # as possible: each TWC gets an equal share, except that TWCs which
+        # can't use that much get what they can use, and the rest is shared
+        # equally among the others. Returns the share of each TWC by TWCID.
+        shares = {}
+        demands = sorted(
+            (slaveTWC.getAmpsDemand(), slaveTWC.TWCID) for slaveTWC in slaveTWCs
+        )
+        for i, (demand, TWCID) in enumerate(demands):
+            shares[TWCID] = min(demand, max(amps, 0) / (len(demands) - i))
+            amps -= shares[TWCID]
+        return shares
+
+    def waitStatusChanged(self, version, timeout=None):
+        # Wait up to timeout seconds for the status to change from version,
+        # which is the version returned by the caller's last call (or by
+        # getStatusVersion()). Returns the current version, to pass to the
+        # next call, so a change made between two calls is never missed, and
+        # callers don't affect each other.
+        with self.statusCondition:
+            self.statusCondition.wait_for(
+                lambda: self.statusVersion != version, timeout
+            )
+            return self.statusVersion
 
     def refreshingTotalAmpsInUseStatus(self):
+        self.notifyStatusChanged()
         for module in self.getModulesByType("Status"):
             module["ref"].setStatus(
                 bytes("all", "UTF-8"),
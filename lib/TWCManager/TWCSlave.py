@@ -1,5 +1,6 @@
 from datetime import datetime
 import logging
+import math
 import re
 import time
 
@@ -8,6 +9,8 @@ logger = logging.getLogger("\u26FD Slave")
 
 
 class TWCSlave:
+    # The TWCBus of the load sharing network this slave was found on
+    bus = None
     config = None
     configConfig = None
     TWCID = None
@@ -51,6 +54,7 @@ class TWCSlave:
     reportedAmpsActualSignificantChangeMonitor = -1
     timeReportedAmpsActualChangedSignificantly = time.time()
 
+    ampsAllocated = None
     lastAmpsOffered = -1
     lastAmpsDesired = -1
     useFlexAmpsToStartCharge = False
@@ -77,6 +81,9 @@ class TWCSlave:
         self.TWCID = TWCID
         self.maxAmps = maxAmps
         self.APIcontrol = False
+        # The time we last heard from this slave on the monotonic clock, which
+        # is used to decide when it has stopped responding
+        self.timeLastRxMonotonic = time.monotonic()
 
         self.wiringMaxAmps = self.configConfig.get("wiringMaxAmpsPerTWC", 6)
         self.useFlexAmpsToStartCharge = self.configConfig.get(
@@ -321,7 +328,7 @@ class TWCSlave:
                 # Increase array length to 9
                 self.master.slaveHeartbeatData.append(0x00)
 
-        self.master.getModulesByType("Interface")[0]["ref"].send(
+        self.bus.send(
             bytearray(b"\xFD\xE0")
             + self.master.getFakeTWCID()
             + bytearray(masterID)
@@ -345,7 +352,8 @@ class TWCSlave:
                 # We were previously told to stop responding to slaves, but
                 # the time limit for this has been exceeded. Start responding
                 # again
-                self.master.settings["respondToSlaves"] = 1
+                with self.master.settingsLock:
+                    self.master.settings["respondToSlaves"] = 1
 
         # Meaning of data:
         #
@@ -544,7 +552,7 @@ class TWCSlave:
                 # try starting charge via car api.
                 self.master.startCarsCharging()
 
-        self.master.getModulesByType("Interface")[0]["ref"].send(
+        self.bus.send(
             bytearray(b"\xFB\xE0")
             + self.master.getFakeTWCID()
             + bytearray(self.TWCID)
@@ -558,10 +566,13 @@ class TWCSlave:
 
         now = time.time()
         self.timeLastRx = now
+        self.timeLastRxMonotonic = time.monotonic()
 
         self.reportedAmpsMax = ((heartbeatData[1] << 8) + heartbeatData[2]) / 100
         self.reportedAmpsActual = ((heartbeatData[3] << 8) + heartbeatData[4]) / 100
-        self.reportedState = heartbeatData[0]
+        if self.reportedState != heartbeatData[0]:
+            self.reportedState = heartbeatData[0]
+            self.master.notifyStatusChanged()
 
         if self.reportedState == 0x02:
             logger.info(
@@ -646,15 +657,10 @@ class TWCSlave:
         if yesterday < 0:
             yesterday += 7
 
-        # Determine our charging policy. This is the policy engine of the
-        # TWCManager application. Using defined rules, we can determine how
-        # we charge.
-        self.master.getModuleByName("Policy").setChargingPerPolicy()
-
-        # Determine how many cars are charging and how many amps they're using
-        numCarsCharging = self.master.num_cars_charging_now()
-        desiredAmpsOffered = self.master.getMaxAmpsToDivideAmongSlaves()
-        flex = self.master.getAllowedFlex()
+        # The amps to offer each slave are worked out for all of them at once
+        # by TWCMaster.allocateAmps(), which also evaluates the policy
+        desiredAmpsOffered = self.master.getAmpsAllocated(self)
+        minAmpsToOffer = self.getMinAmpsToOffer()
 
         # Get charge rate control mode from settings
         # 1 = Use TWC Exclusively to control Charge Rate
@@ -662,47 +668,6 @@ class TWCSlave:
         # 3 = Use TWC >= 6A + Tesla API < 6A to control Charge Rate
         chargeRateControl = int(self.master.settings.get("chargeRateControl", 1))
 
-        if numCarsCharging > 0:
-            desiredAmpsOffered -= sum(
-                slaveTWC.reportedAmpsActual
-                for slaveTWC in self.master.getSlaveTWCs()
-                if slaveTWC.TWCID != self.TWCID
-            )
-            flex = self.master.getAllowedFlex() / numCarsCharging
-
-            # Allocate this slave a fraction of maxAmpsToDivideAmongSlaves divided
-            # by the number of cars actually charging.
-            fairShareAmps = int(
-                self.master.getMaxAmpsToDivideAmongSlaves() / numCarsCharging
-            )
-            if desiredAmpsOffered > fairShareAmps:
-                desiredAmpsOffered = fairShareAmps
-
-            logger.debug(
-                "desiredAmpsOffered TWC: "
-                + self.master.hex_str(self.TWCID)
-                + " reduced from "
-                + str(self.master.getMaxAmpsToDivideAmongSlaves())
-                + " to "
-                + str(desiredAmpsOffered)
-                + " with "
-                + str(numCarsCharging)
-                + " cars charging and flex Amps of "
-                + str(flex)
-                + "."
-            )
-
-        minAmpsToOffer = self.config["config"]["minAmpsPerTWC"]
-        if self.minAmpsTWCSupports > minAmpsToOffer:
-            minAmpsToOffer = self.minAmpsTWCSupports
-
-        if (
-            desiredAmpsOffered < minAmpsToOffer
-            and desiredAmpsOffered + flex >= minAmpsToOffer
-            and (self.useFlexAmpsToStartCharge or self.reportedAmpsActual >= 1.0)
-        ):
-            desiredAmpsOffered = minAmpsToOffer
-
         dampenChanges = False
         if self.master.getModuleByName("Policy").policyIsGreen():
             if (now - self.timeLastAmpsDesiredFlipped) < self.startStopDelay:
@@ -711,97 +676,15 @@ class TWCSlave:
             self.timeLastAmpsDesiredFlipped = 0
 
         if desiredAmpsOffered < minAmpsToOffer:
+            # We are either offering no power, as there isn't enough to charge
+            # every car, or offering minAmpsTWCSupports to find out whether a
+            # car is waiting to charge. See TWCMaster.allocateAmps().
             logger.debug(
                 "desiredAmpsOffered: "
                 + str(desiredAmpsOffered)
                 + " < minAmpsToOffer: "
                 + str(minAmpsToOffer)
-                + " (flexAmps: "
-                + str(flex)
-                + ")"
             )
-            if numCarsCharging > 0:
-                if (
-                    self.master.getMaxAmpsToDivideAmongSlaves() / numCarsCharging
-                    > minAmpsToOffer
-                ):
-                    # There is enough power available to give each car
-                    # minAmpsToOffer, but currently-charging cars are leaving us
-                    # less power than minAmpsToOffer to give this car.
-                    #
-                    # minAmpsToOffer is based on minAmpsPerTWC which is
-                    # user-configurable, whereas self.minAmpsTWCSupports is based on
-                    # the minimum amps TWC must be set to reliably start a car
-                    # charging.
-                    #
-                    # Unfortunately, we can't tell if a car is plugged in or wanting
-                    # to charge without offering it minAmpsTWCSupports. As the car
-                    # gradually starts to charge, we will see it using power and
-                    # tell other TWCs on the network to use less power. This could
-                    # cause the sum of power used by all TWCs to exceed
-                    # wiringMaxAmpsAllTWCs for a few seconds, but I don't think
-                    # exceeding by up to minAmpsTWCSupports for such a short period
-                    # of time will cause problems.
-                    logger.debug(
-                        "desiredAmpsOffered TWC: "
-                        + self.master.hex_str(self.TWCID)
-                        + " increased from "
-                        + str(desiredAmpsOffered)
-                        + " to "
-                        + str(self.minAmpsTWCSupports)
-                        + " (self.minAmpsTWCSupports)"
-                    )
-
-                    desiredAmpsOffered = self.minAmpsTWCSupports
-
-                else:
-                    # There is not enough power available to give each car
-                    # minAmpsToOffer, so don't offer power to any cars. Alternately,
-                    # we could charge one car at a time and switch cars
-                    # periodically, but I'm not going to try to implement that.
-                    #
-                    # Note that 5A is the lowest value you can set using the Tesla car's
-                    # main screen, so lower values might have some adverse affect on the
-                    # car. I actually tried lower values when the sun was providing
-                    # under 5A of power and found the car would occasionally set itself
-                    # to state 03 and refuse to charge until you re-plugged the charger
-                    # cable. Clicking "Start charging" in the car's UI or in the phone
-                    # app would not start charging.
-                    #
-                    # A 5A charge only delivers ~3 miles of range to the car per hour,
-                    # but it forces the car to remain "on" at a level that it wastes
-                    # some power while it's charging. The lower the amps, the more power
-                    # is wasted. This is another reason not to go below 5A.
-                    #
-                    # So if there isn't at least 5A of power available, pass 0A as the
-                    # desired value. This tells the car to stop charging and it will
-                    # enter state 03 and go to sleep. You will hear the power relay in
-                    # the TWC turn off. When desiredAmpsOffered trends above 6A again,
-                    # it tells the car there's power.
-                    # If a car is set to energy saver mode in the car's UI, the car
-                    # seems to wake every 15 mins or so (unlocking or using phone app
-                    # also wakes it) and next time it wakes, it will see there's power
-                    # and start charging. Without energy saver mode, the car should
-                    # begin charging within about 10 seconds of changing this value.
-                    logger.debug(
-                        "desiredAmpsOffered TWC: "
-                        + self.master.hex_str(self.TWCID)
-                        + " reduced to 0 from "
-                        + str(desiredAmpsOffered)
-                        + " because maxAmpsToDivideAmongSlaves "
-                        + str(self.master.getMaxAmpsToDivideAmongSlaves())
-                        + " / numCarsCharging "
-                        + str(numCarsCharging)
-                        + " < minAmpsToOffer "
-                        + str(minAmpsToOffer)
-                    )
-                    desiredAmpsOffered = 0
-
-            else:
-                # no cars are charging, and desiredAmpsOffered < minAmpsToOffer
-                # so we need to set desiredAmpsOffered to 0
-                logger.debug("no cars charging, setting desiredAmpsOffered to 0")
-                desiredAmpsOffered = 0
         elif chargeRateControl == 2 or (
             chargeRateControl == 3 and desiredAmpsOffered < 6
         ):
@@ -1125,6 +1008,7 @@ class TWCSlave:
 
             if self.lastAmpsOffered != oldLastAmpsOffered:
                 self.timeLastAmpsOfferedChanged = time.time()
+                self.master.notifyStatusChanged()
         return self.lastAmpsOffered
 
     def setLifetimekWh(self, kwh):
@@ -1161,11 +1045,33 @@ class TWCSlave:
                 "W",
             )
 
+    def getAmpsDemand(self):
+        # Returns the most amps this TWC can make use of, for
+        # TWCMaster.allocateAmps(). That is normally its wiringMaxAmps, but a
+        # car which has been drawing at least 2A less than it was offered for
+        # over a minute is being limited by the car itself, so it is only
+        # given a little more than it uses and the rest goes to other cars.
+        # If it starts drawing more, it is given its full share again.
+        if (
+            self.reportedAmpsActual >= 1.0
+            and self.lastAmpsOffered - self.reportedAmpsActual >= 2.0
+            and time.time() - self.timeReportedAmpsActualChangedSignificantly > 60
+        ):
+            return min(
+                max(math.ceil(self.reportedAmpsActual) + 2, self.getMinAmpsToOffer()),
+                self.wiringMaxAmps,
+            )
+        return self.wiringMaxAmps
+
     def getCurrentChargerLoad(self):
         return self.master.convertAmpsToWatts(
             self.reportedAmpsActual
         ) * self.master.getRealPowerFactor(self.reportedAmpsActual)
 
+    def getMinAmpsToOffer(self):
+        # Returns the fewest amps worth offering this TWC to charge a car
+        return max(self.config["config"]["minAmpsPerTWC"], self.minAmpsTWCSupports)
+
     def getLastVehicle(self):
         currentVehicle = None
         lastVehicle = None
@@ -0,0 +1,291 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+import traceback
+from TWCManager.DaemonExecutor import DaemonExecutor
+
+
+logger = logging.getLogger("\u26FD Tasks")
+
+
+class TaskScheduler:
+    # Runs the background tasks queued by TWCMaster.queue_background_task().
+    #
+    # Tasks are run by pools of worker threads, one pool per category, so
+    # that a task which is waiting on the network (for example a Tesla API
+    # call which retries for a minute) doesn't hold up tasks in the other
+    # pools, such as writing the settings file. Within a pool, the task with
+    # the lowest priority number runs first, and tasks with the same priority
+    # run in the order they were queued.
+    #
+    # Tasks queued with a delay are kept in a heap ordered by the time they
+    # are due, and a timer thread sleeps until the earliest one is due before
+    # passing it to its pool.
+    #
+    # Only one task for each key (the task's cmd) is waiting or running at a
+    # time. Queuing a task whose key is already waiting or running updates
+    # that task instead.
+    #
+    # With the asyncio runtime, the timer thread and the idle worker threads
+    # are replaced by a coroutine on the event loop, which hands each task to
+    # an executor for its pool once it is due.
+
+    def __init__(self, pools):
+        # pools maps each category name to its number of worker threads
+        self.condition = threading.Condition()
+        self.handler = None
+        self.loop = None
+        self.pending = {}
+        self.pools = {}
+        self.ready = {}
+        self.running = False
+        self.sequence = itertools.count()
+        self.stats = {}
+        self.timers = []
+        self.unfinished = 0
+        self.wakeup = None
+
+        for category, workers in pools.items():
+            self.pools[category] = max(int(workers), 1)
+            self.ready[category] = []
+
+    def cancel(self, key, task):
+        # Stop the task waiting for key from running, if it is equal to task.
+        # Another task for key can be queued straight away.
+        with self.condition:
+            entry = self.pending.get(key, None)
+            if entry and entry["task"] == task:
+                entry["cancelled"] = True
+                del self.pending[key]
+
+    def getStats(self):
+        # Returns the number of tasks waiting in each pool and on the timer,
+        # and for each key the number of times it has run, the average and
+        # longest time it waited to start once it was due, and the average
+        # and longest time it took to run, in seconds
+        with self.condition:
+            result = {
+                "queueDepth": {
+                    category: len(ready) for category, ready in self.ready.items()
+                },
+                "delayed": len(self.timers),
+                "tasks": {},
+            }
+            for key, stats in sorted(self.stats.items()):
+                result["tasks"][key] = {
+                    "category": stats["category"],
+                    "count": stats["count"],
+                    "errors": stats["errors"],
+                    "waitAvg": round(stats["wait"] / stats["count"], 4),
+                    "waitMax": round(stats["waitMax"], 4),
+                    "runAvg": round(stats["run"] / stats["count"], 4),
+                    "runMax": round(stats["runMax"], 4),
+                }
+            return result
+
+    def join(self, timeout=None):
+        # Wait until every task which is due has finished. Tasks which are
+        # still waiting for their delay to pass are not waited for.
+        # Returns False if the timeout passed first.
+        with self.condition:
+            return self.condition.wait_for(lambda: self.unfinished == 0, timeout)
+
+    def qsize(self):
+        # Returns the number of tasks which are due and waiting for a worker
+        with self.condition:
+            return sum(len(ready) for ready in self.ready.values())
+
+    def queue(self, key, task, category, priority, delay=0):
+        with self.condition:
+            if delay > 0:
+                heapq.heappush(
+                    self.timers,
+                    (
+                        time.monotonic() + delay,
+                        next(self.sequence),
+                        key,
+                        task,
+                        category,
+                        priority,
+                    ),
+                )
+            else:
+                self.queueReady(key, task, category, priority, time.monotonic())
+            self.condition.notify_all()
+        self.notifyAsync()
+
+    def notifyAsync(self):
+        # Wake the coroutine which runs the tasks with the asyncio runtime
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def queueReady(self, key, task, category, priority, due):
+        # Must be called with self.condition held
+        if key in self.pending:
+            # Some tasks, like cmd='charge', will be queued once per second
+            # until a charge starts or we determine the car is done charging.
+            # To avoid queuing up a bunch of these tasks when we're handling
+            # one already, update the existing task instead.
+            self.pending[key]["task"].update(task)
+            return
+
+        if category not in self.ready:
+            category = "local"
+
+        entry = {"task": task, "cancelled": False}
+        self.pending[key] = entry
+        self.unfinished += 1
+        heapq.heappush(
+            self.ready[category],
+            (priority, next(self.sequence), due, key, entry),
+        )
+
+    def recordStats(self, key, category, wait, run, failed):
+        with self.condition:
+            stats = self.stats.setdefault(
+                key,
+                {
+                    "category": category,
+                    "count": 0,
+                    "errors": 0,
+                    "run": 0,
+                    "runMax": 0,
+                    "wait": 0,
+                    "waitMax": 0,
+                },
+            )
+            stats["count"] += 1
+            stats["errors"] += int(failed)
+            stats["run"] += run
+            stats["runMax"] = max(stats["runMax"], run)
+            stats["wait"] += wait
+            stats["waitMax"] = max(stats["waitMax"], wait)
+
+    def runTimers(self):
+        with self.condition:
+            while True:
+                if not self.timers:
+                    self.condition.wait()
+                    continue
+
+                remaining = self.timers[0][0] - time.monotonic()
+                if remaining > 0:
+                    # Wake when the earliest task is due, or when a task is
+                    # queued which may be due sooner
+                    self.condition.wait(remaining)
+                    continue
+
+                due, seq, key, task, category, priority = heapq.heappop(self.timers)
+                self.queueReady(key, task, category, priority, due)
+                self.condition.notify_all()
+
+    async def runAsync(self):
+        # Runs the tasks with the asyncio runtime. Each pool has an executor
+        # with as many threads as the pool has workers, which are only
+        # started when there are tasks for them.
+        executors = {
+            category: DaemonExecutor(workers, "Task-" + category)
+            for category, workers in self.pools.items()
+        }
+        running = dict.fromkeys(self.pools, 0)
+
+        def finished(category):
+            running[category] -= 1
+            self.wakeup.set()
+
+        while True:
+            self.wakeup.clear()
+            started = []
+            with self.condition:
+                now = time.monotonic()
+                while self.timers and self.timers[0][0] <= now:
+                    due, seq, key, task, category, priority = heapq.heappop(self.timers)
+                    self.queueReady(key, task, category, priority, due)
+                for category, ready in self.ready.items():
+                    while ready and running[category] < self.pools[category]:
+                        started.append((category, heapq.heappop(ready)))
+                        running[category] += 1
+                timeout = self.timers[0][0] - now if self.timers else None
+
+            for category, (priority, seq, due, key, entry) in started:
+                future = self.loop.run_in_executor(
+                    executors[category], self.runTask, category, due, key, entry
+                )
+                future.add_done_callback(
+                    lambda f, category=category: finished(category)
+                )
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def runTask(self, category, due, key, entry):
+        if not entry["cancelled"]:
+            start = time.monotonic()
+            failed = False
+            try:
+                self.handler(entry["task"])
+            except Exception:
+                failed = True
+                logger.info(
+                    "%s: "
+                    + traceback.format_exc()
+                    + ", occurred when processing background task",
+                    "BackgroundError",
+                    extra={"colored": "red"},
+                )
+            self.recordStats(
+                key, category, start - due, time.monotonic() - start, failed
+            )
+
+        with self.condition:
+            # Another task for key can be queued from now on
+            if self.pending.get(key, None) is entry:
+                del self.pending[key]
+            self.unfinished -= 1
+            self.condition.notify_all()
+
+    def runWorker(self, category):
+        ready = self.ready[category]
+        while True:
+            with self.condition:
+                while not ready:
+                    self.condition.wait()
+                priority, seq, due, key, entry = heapq.heappop(ready)
+            self.runTask(category, due, key, entry)
+
+    def start(self, handler):
+        # Start running tasks, by passing each one to handler(task). Tasks
+        # queued before this is called are held until it is.
+        with self.condition:
+            if self.running:
+                return
+            self.handler = handler
+            self.running = True
+
+        threading.Thread(target=self.runTimers, name="TaskTimer", daemon=True).start()
+        for category, workers in self.pools.items():
+            for worker in range(workers):
+                threading.Thread(
+                    target=self.runWorker,
+                    args=(category,),
+                    name="Task-%s-%d" % (category, worker),
+                    daemon=True,
+                ).start()
+
+    def startAsync(self, handler, loop):
+        # Start running tasks on the asyncio runtime's event loop, by passing
+        # each one to handler(task)
+        with self.condition:
+            if self.running:
+                return
+            self.handler = handler
+            self.loop = loop
+            self.running = True
+            self.wakeup = asyncio.Event()
+
+        loop.create_task(self.runAsync())
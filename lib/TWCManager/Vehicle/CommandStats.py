@@ -0,0 +1,41 @@
+# Records how long the commands sent to vehicles take, so that the time taken
+# by the same command over BLE and over the Tesla API can be compared.
+#
+# This module is shared by the Vehicle modules, and is not loaded as a module
+# of its own.
+
+import threading
+
+
+class CommandStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def getStats(self):
+        # Returns for each command the number of times it was sent, how many
+        # of those failed, and the average, longest and last time it took to
+        # complete, in seconds
+        with self.lock:
+            return {
+                command: {
+                    "count": stats["count"],
+                    "errors": stats["errors"],
+                    "latencyAvg": round(stats["total"] / stats["count"], 3),
+                    "latencyLast": round(stats["last"], 3),
+                    "latencyMax": round(stats["max"], 3),
+                }
+                for command, stats in sorted(self.stats.items())
+            }
+
+    def record(self, command, latency, success):
+        with self.lock:
+            stats = self.stats.setdefault(
+                command, {"count": 0, "errors": 0, "last": 0, "max": 0, "total": 0}
+            )
+            stats["count"] += 1
+            if not success:
+                stats["errors"] += 1
+            stats["last"] = latency
+            stats["max"] = max(stats["max"], latency)
+            stats["total"] += latency
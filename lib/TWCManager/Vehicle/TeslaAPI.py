@@ -1,14 +1,17 @@
 import base64
+from concurrent.futures import CancelledError
 import hashlib
 import json
 import logging
 import os
 import re
-import requests
-from threading import Thread
+from threading import Lock
 import time
-from urllib.parse import parse_qs
 import jwt
+from TWCManager.DaemonExecutor import DaemonExecutor
+from TWCManager.Vehicle.CommandStats import CommandStats
+from TWCManager.Vehicle.TeslaAPIClient import TeslaAPIClient
+from TWCManager.Vehicle.VehicleState import VehicleState
 
 logger = logging.getLogger("\U0001F697 TeslaAPI")
 
@@ -39,7 +42,12 @@ class TeslaAPI:
     lastChargeLimitApplied = 0
     lastChargeCheck = 0
     chargeUpdateInterval = 1800
-    carApiVehicles = []
+    client = None
+    commandPool = None
+    commandsPending = None
+    commandsPendingLock = None
+    commandStats = None
+    commandWorkers = 4
     config = None
     master = None
     __email = None
@@ -51,6 +59,9 @@ class TeslaAPI:
     refreshURL = "https://auth.tesla.com/oauth2/v3/token"
     __resp = None
     session = None
+    syncCheckInterval = 5 * 60
+    syncCheckQueued = False
+    vehicles = None
 
     # Transient errors are ones that usually disappear if we retry the car API
     # command a minute or less later.
@@ -69,6 +80,11 @@ class TeslaAPI:
 
     def __init__(self, master):
         self.master = master
+        self.client = TeslaAPIClient(self)
+        self.commandStats = CommandStats()
+        self.commandsPending = {}
+        self.commandsPendingLock = Lock()
+        self.vehicles = {}
         try:
             self.config = master.config
             proxyURL = self.config["config"].get("teslaProxy", "")
@@ -82,14 +98,24 @@ class TeslaAPI:
             self.chargeUpdateInterval = self.config["config"].get(
                 "cloudUpdateInterval", 1800
             )
+            self.commandWorkers = self.config["config"].get("teslaApiCommandWorkers", 4)
         except KeyError:
             pass
 
         self.generateChallenge()
 
     def addVehicle(self, json):
+        # Vehicles are tracked by VIN. When the vehicle list is fetched again,
+        # vehicles we already know about keep their existing object (and the
+        # state held in it), and only their ID and name are updated.
         if "vin" in json:
-            self.carApiVehicles.append(CarApiVehicle(json, self, self.config))
+            vehicle = self.vehicles.get(json["vin"], None)
+            if vehicle:
+                vehicle.ID = json["id"]
+                vehicle.name = json["display_name"] or vehicle.VIN
+            else:
+                self.vehicles[json["vin"]] = CarApiVehicle(json, self, self.config)
+            self.queueVehicleSyncCheck()
 
     def apiDebugInterface(self, command, vehicleID, parameters):
         # Provides an interface from the Web UI to allow commands to be run interactively
@@ -119,22 +145,22 @@ class TeslaAPI:
     def apiRefresh(self):
         # Refresh tokens expire in 45
         # days when first issued, so we'll get a new token every 15 days.
-        headers = {"accept": "application/json", "Content-Type": "application/json"}
+        #
+        # Don't call this directly; call self.client.refreshToken(), which
+        # makes sure only one refresh happens at a time.
         data = {
             "client_id": self.refreshClientID,
             "grant_type": "refresh_token",
             "refresh_token": self.getCarApiRefreshToken(),
             "scope": "offline_access",
         }
-        req = None
         now = time.time()
-        try:
-            req = requests.post(self.refreshURL, headers=headers, json=data)
-            logger.log(logging.INFO2, "Car API request" + str(req))
-            req.raise_for_status()
-            apiResponseDict = json.loads(req.text)
-        except requests.exceptions.RequestException:
-            if req.status_code == 401:
+        req, apiResponseDict = self.client.request(
+            "POST", self.refreshURL, body=data, auth=False
+        )
+        logger.log(logging.INFO2, "Car API request" + str(req))
+        if req is None or not req.ok:
+            if req is not None and req.status_code == 401:
                 logger.log(
                     logging.INFO2,
                     "TeslaAPI",
@@ -150,13 +176,10 @@ class TeslaAPI:
             # remote access to your car after too many authorization errors.
             self.master.queue_background_task({"cmd": "saveSettings"})
             return False
-        except json.decoder.JSONDecodeError:
+        if apiResponseDict is None:
             logger.log(
                 logging.INFO2, "JSON Decode Error parsing API Token Refresh Response"
             )
-            pass
-        except ValueError:
-            pass
 
         try:
             logger.log(logging.INFO4, "Car API auth response" + str(apiResponseDict))
@@ -209,18 +232,8 @@ class TeslaAPI:
             or self.getCarApiTokenExpireTime() - now < 60 * 60
         ):
             if self.getCarApiRefreshToken() != "":
-                headers = {
-                    "accept": "application/json",
-                    "Content-Type": "application/json",
-                }
-                data = {
-                    "client_id": self.clientID,
-                    "client_secret": self.clientSecret,
-                    "grant_type": "refresh_token",
-                    "refresh_token": self.getCarApiRefreshToken(),
-                }
                 logger.log(logging.INFO8, "Attempting token refresh")
-                self.apiRefresh()
+                self.client.refreshToken()
 
             elif email is not None and password is not None:
                 logger.log(logging.INFO8, "Attempting password auth")
@@ -240,24 +253,13 @@ class TeslaAPI:
                 url = self.baseURL
                 if "owner-api" in url:
                     url = url.replace("vehicles", "products")
-                headers = {
-                    "accept": "application/json",
-                    "Authorization": "Bearer " + self.getCarApiBearerToken(),
-                }
-                try:
-                    req = requests.get(url, headers=headers, verify=self.verifyCert)
-                    logger.log(logging.INFO8, "Car API cmd vehicles " + str(req))
-                    apiResponseDict = json.loads(req.text)
-                except requests.exceptions.RequestException:
+                req, apiResponseDict = self.client.request("GET", url)
+                logger.log(logging.INFO8, "Car API cmd vehicles " + str(req))
+                if req is None:
                     logger.info("Failed to make API call " + url)
-                    if req:
-                        logger.log(logging.INFO6, "Response: " + req.text)
-                    pass
-                except json.decoder.JSONDecodeError:
+                elif apiResponseDict is None:
                     logger.info("Could not parse JSON result from " + url)
-                    if req:
-                        logger.log(logging.INFO6, "Response: " + req.text)
-                    pass
+                    logger.log(logging.INFO6, "Response: " + req.text)
 
                 try:
                     logger.debug("Car API vehicle list" + str(apiResponseDict) + "\n")
@@ -353,6 +355,7 @@ class TeslaAPI:
                         # when it periodically awakens for some reason.
                         vehicle.firstWakeAttemptTime = 0
                         vehicle.delayNextWakeAttempt = 0
+                        vehicle.state.set("state", state, "TeslaAPI")
                         # Don't alter vehicle.lastAPIAccessTime because
                         # vehicle.ready() uses it to return True if the last wake
                         # was under 2 mins ago.
@@ -582,9 +585,11 @@ class TeslaAPI:
     def car_api_charge(self, charge):
         # Do not call this function directly.  Call by using background thread:
         # queue_background_task({'cmd':'charge', 'charge':<True/False>})
+        #
+        # Returns a dict of the result of the command ("success" or "error")
+        # for each vehicle it was sent to, keyed by VIN.
 
         now = time.time()
-        apiResponseDict = {}
         if not charge:
             # Whenever we are going to tell vehicles to stop charging, set
             # vehicle.stopAskingToStartCharging = False on all vehicles.
@@ -597,19 +602,19 @@ class TeslaAPI:
                 logging.DEBUG2,
                 "car_api_charge return because not long enough since last carApiLastStartOrStopChargeTime",
             )
-            return "error"
+            return {}
 
         if self.car_api_available(charge=charge) is False:
             logger.log(
                 logging.INFO8,
                 "car_api_charge return because car_api_available() == False",
             )
-            return "error"
+            return {}
 
         startOrStop = "start" if charge else "stop"
-        result = "success"
         logger.log(logging.INFO8, "startOrStop is set to " + str(startOrStop))
 
+        vehicles = []
         for vehicle in self.getCarApiVehicles():
             if charge and vehicle.stopAskingToStartCharging:
                 logger.log(
@@ -619,202 +624,233 @@ class TeslaAPI:
                     + " because vehicle.stopAskingToStartCharging == True",
                 )
                 continue
+            vehicles.append(vehicle)
+
+        # Send the command to each vehicle on its own worker, so that waking
+        # one vehicle or retrying a command to it doesn't hold up the others
+        limits = {"applied": False, "lock": Lock()}
+        pending = [
+            (vehicle, self.submitChargeCommand(vehicle, charge, limits))
+            for vehicle in vehicles
+        ]
+
+        results = {}
+        for vehicle, future in pending:
+            try:
+                result = future.result()
+            except CancelledError:
+                # Replaced by the opposite command before it was sent
+                logger.log(
+                    logging.INFO8,
+                    startOrStop + " charge for " + vehicle.name + " was superseded",
+                )
+                result = None
+            except Exception as e:
+                logger.info(
+                    "Error sending " + startOrStop + " charge to " + vehicle.name,
+                    exc_info=e,
+                )
+                result = "error"
+            if result:
+                results[vehicle.VIN] = result
+                logger.info(
+                    "Car API " + startOrStop + " charge result for %s: %s",
+                    vehicle.name,
+                    result,
+                )
 
-            if not vehicle.ready():
-                continue
+        return results
 
-            if (
-                vehicle.update_charge()
-                and vehicle.batteryLevel < self.minChargeLevel
-                and not charge
-            ):
-                # If the vehicle's charge state is lower than the configured minimum,
-                #   don't stop it from charging, even if we'd otherwise not charge.
-                continue
+    def car_api_charge_vehicle(self, vehicle, charge, limits):
+        # Sends the start or stop charge command to a single vehicle, on one
+        # of the command pool's workers. Returns "success" or "error", or None
+        # if the command was not sent to this vehicle.
+        startOrStop = "start" if charge else "stop"
+        result = "success"
 
-            # Only update carApiLastStartOrStopChargeTime if car_api_available() managed
-            # to wake cars.  Setting this prevents any command below from being sent
-            # more than once per minute.
-            self.updateLastStartOrStopChargeTime()
+        if not vehicle.ready():
+            return None
 
-            # only start/stop charging cars parked at home.
+        if (
+            vehicle.update_charge()
+            and vehicle.batteryLevel < self.minChargeLevel
+            and not charge
+        ):
+            # If the vehicle's charge state is lower than the configured minimum,
+            #   don't stop it from charging, even if we'd otherwise not charge.
+            return None
 
-            if vehicle.update_location() is False:
-                result = "error"
-                continue
+        # Only update carApiLastStartOrStopChargeTime if car_api_available() managed
+        # to wake cars.  Setting this prevents any command below from being sent
+        # more than once per minute.
+        self.updateLastStartOrStopChargeTime()
 
-            if not vehicle.atHome:
-                # Vehicle is not at home, so don't change its charge state.
-                message = (
-                    vehicle.name
-                    + " is not at home.  Do not "
-                    + startOrStop
-                    + " charge."
-                )
-                # Stop asking to start charging when not at home.
-                if startOrStop == "start":
-                    vehicle.stopAskingToStartCharging = True
-                    message += "  Stop asking to start charging."
-                logger.info(message)
-                continue
+        # only start/stop charging cars parked at home.
 
-            # If you send charge_start/stop less than 1 second after calling
-            # update_location(), the charge command usually returns:
-            #   {'response': {'result': False, 'reason': 'could_not_wake_buses'}}
-            # Waiting 2 seconds seems to consistently avoid the error, but let's
-            # wait 5 seconds in case of hardware differences between cars.
-            time.sleep(5)
+        if vehicle.update_location() is False:
+            return "error"
 
-            if charge:
-                self.applyChargeLimit(self.lastChargeLimitApplied, checkArrival=True)
+        if not vehicle.atHome:
+            # Vehicle is not at home, so don't change its charge state.
+            message = (
+                vehicle.name + " is not at home.  Do not " + startOrStop + " charge."
+            )
+            # Stop asking to start charging when not at home.
+            if startOrStop == "start":
+                vehicle.stopAskingToStartCharging = True
+                message += "  Stop asking to start charging."
+            logger.info(message)
+            return None
+
+        # If you send charge_start/stop less than 1 second after calling
+        # update_location(), the charge command usually returns:
+        #   {'response': {'result': False, 'reason': 'could_not_wake_buses'}}
+        # Waiting 2 seconds seems to consistently avoid the error, but let's
+        # wait 5 seconds in case of hardware differences between cars.
+        # Each vehicle waits on its own worker, so this doesn't delay the
+        # others.
+        time.sleep(5)
+
+        if charge:
+            # The charge limit is applied to every vehicle at once, so only
+            # the first vehicle to get here applies it, and the others wait
+            # until it has been applied
+            with limits["lock"]:
+                if not limits["applied"]:
+                    self.applyChargeLimit(
+                        self.lastChargeLimitApplied, checkArrival=True
+                    )
+                    limits["applied"] = True
 
-            url = self.baseURL + "/"
-            url = url + str(vehicle.VIN) + "/command/charge_" + startOrStop
-            headers = {
-                "accept": "application/json",
-                "Authorization": "Bearer " + self.getCarApiBearerToken(),
-            }
+        url = self.baseURL + "/"
+        url = url + str(vehicle.VIN) + "/command/charge_" + startOrStop
 
-            # Retry up to 3 times on certain errors.
-            for _ in range(0, 3):
-                try:
-                    req = requests.post(url, headers=headers, verify=self.verifyCert)
-                    logger.log(
-                        logging.INFO8,
-                        "Car API cmd charge_" + startOrStop + " " + str(req),
-                    )
-                    apiResponseDict = json.loads(req.text)
-                except requests.exceptions.RequestException:
-                    pass
-                except json.decoder.JSONDecodeError:
-                    pass
+        req, apiResponseDict = self.client.request("POST", url, vehicle=vehicle)
+        logger.log(
+            logging.INFO8,
+            "Car API cmd charge_" + startOrStop + " " + str(req),
+        )
 
-                try:
-                    logger.log(
-                        logging.INFO4,
-                        vehicle.name
-                        + ": "
-                        + startOrStop
-                        + " charge response"
-                        + str(apiResponseDict),
-                    )
-                    # Responses I've seen in apiResponseDict:
-                    # Car is done charging:
-                    #   {'response': {'result': False, 'reason': 'complete'}}
-                    # Car wants to charge but may not actually be charging. Oddly, this
-                    # is the state reported when car is not plugged in to a charger!
-                    # It's also reported when plugged in but charger is not offering
-                    # power or even when the car is in an error state and refuses to
-                    # charge.
-                    #   {'response': {'result': False, 'reason': 'charging'}}
-                    # Car not reachable:
-                    #   {'response': None, 'error_description': '', 'error': 'vehicle unavailable: {:error=>"vehicle unavailable:"}'}
-                    # This weird error seems to happen randomly and re-trying a few
-                    # seconds later often succeeds:
-                    #   {'response': {'result': False, 'reason': 'could_not_wake_buses'}}
-                    # I've seen this a few times on wake_up, charge_start, and drive_state:
-                    #   {'error': 'upstream internal error', 'response': None, 'error_description': ''}
-                    # I've seen this once on wake_up:
-                    #   {'error': 'operation_timedout for txid `4853e3ad74de12733f8cc957c9f60040`}', 'response': None, 'error_description': ''}
-                    # Start or stop charging success:
-                    #   {'response': {'result': True, 'reason': ''}}
-                    if apiResponseDict["response"] is None:
-                        # This generally indicates an error like 'vehicle
-                        # unavailable', but it's not something I think the caller can do
-                        # anything about, so return generic 'error'.
+        try:
+            logger.log(
+                logging.INFO4,
+                vehicle.name
+                + ": "
+                + startOrStop
+                + " charge response"
+                + str(apiResponseDict),
+            )
+            # Responses I've seen in apiResponseDict:
+            # Car is done charging:
+            #   {'response': {'result': False, 'reason': 'complete'}}
+            # Car wants to charge but may not actually be charging. Oddly, this
+            # is the state reported when car is not plugged in to a charger!
+            # It's also reported when plugged in but charger is not offering
+            # power or even when the car is in an error state and refuses to
+            # charge.
+            #   {'response': {'result': False, 'reason': 'charging'}}
+            # Car not reachable:
+            #   {'response': None, 'error_description': '', 'error': 'vehicle unavailable: {:error=>"vehicle unavailable:"}'}
+            # This weird error seems to happen randomly and re-trying a few
+            # seconds later often succeeds:
+            #   {'response': {'result': False, 'reason': 'could_not_wake_buses'}}
+            # I've seen this a few times on wake_up, charge_start, and drive_state:
+            #   {'error': 'upstream internal error', 'response': None, 'error_description': ''}
+            # I've seen this once on wake_up:
+            #   {'error': 'operation_timedout for txid `4853e3ad74de12733f8cc957c9f60040`}', 'response': None, 'error_description': ''}
+            # Start or stop charging success:
+            #   {'response': {'result': True, 'reason': ''}}
+            if apiResponseDict["response"] is None:
+                # This generally indicates an error like 'vehicle
+                # unavailable', but it's not something I think the caller can do
+                # anything about, so return generic 'error'.
+                result = "error"
+                # Don't send another command to this vehicle for
+                # carApiErrorRetryMins mins.
+                self.updateCarApiLastErrorTime(vehicle)
+            else:
+                if apiResponseDict["response"]["result"] == True:
+                    self.resetCarApiLastErrorTime(vehicle)
+                elif charge:
+                    reason = self.findReason(apiResponseDict)
+                    if reason in [
+                        "complete",
+                        "charging",
+                        "is_charging",
+                        "disconnected",
+                        "requested",
+                    ]:
+                        # We asked the car to charge, but it responded
+                        # that it can't, either because it's reached
+                        # target charge state (reason == 'complete'), or
+                        # it's already trying to charge (reason ==
+                        # 'charging' or 'requested') or it's not
+                        # connected to a charger (reason ==
+                        # 'disconnected'). In these cases, it won't help
+                        # to keep asking it to charge, so set
+                        # vehicle.stopAskingToStartCharging = True.
+                        #
+                        # Remember, this only means at least one car in
+                        # the list wants us to stop asking and we don't
+                        # know which car in the list is connected to our
+                        # TWC.
+                        logger.info(
+                            vehicle.name
+                            + " is done charging or already trying to charge or not connected to a charger."
+                            + "  Stop asking to start charging."
+                        )
+                        vehicle.stopAskingToStartCharging = True
+                        self.resetCarApiLastErrorTime(vehicle)
+                    elif reason == "could_not_wake_buses":
+                        # This error often happens if you call
+                        # charge_start too quickly after another command
+                        # like drive_state. Even if you delay 5 seconds
+                        # between the commands, this error still comes
+                        # up occasionally. The client has already retried
+                        # the command a few times, so we'll try again in a
+                        # minute because we set
+                        # carApiLastStartOrStopChargeTime = now earlier.
+                        pass
+                    else:
+                        # Start charge failed with an error I
+                        # haven't seen before, so wait
+                        # carApiErrorRetryMins mins before trying again.
+                        logger.info(
+                            'ERROR "'
+                            + reason
+                            + '" when trying to '
+                            + startOrStop
+                            + " car charging via Tesla car API.  Will try again later."
+                            + "\nIf this error persists, please file an issue at https://github.com/ngardiner/TWCManager/ with a copy of this error.",
+                        )
                         result = "error"
-                        # Don't send another command to this vehicle for
-                        # carApiErrorRetryMins mins.
                         self.updateCarApiLastErrorTime(vehicle)
-                    else:
-                        if apiResponseDict["response"]["result"] == True:
-                            self.resetCarApiLastErrorTime(vehicle)
-                        elif charge:
-                            reason = self.findReason(apiResponseDict)
-                            if reason in [
-                                "complete",
-                                "charging",
-                                "is_charging",
-                                "disconnected",
-                                "requested",
-                            ]:
-                                # We asked the car to charge, but it responded
-                                # that it can't, either because it's reached
-                                # target charge state (reason == 'complete'), or
-                                # it's already trying to charge (reason ==
-                                # 'charging' or 'requested') or it's not
-                                # connected to a charger (reason ==
-                                # 'disconnected'). In these cases, it won't help
-                                # to keep asking it to charge, so set
-                                # vehicle.stopAskingToStartCharging = True.
-                                #
-                                # Remember, this only means at least one car in
-                                # the list wants us to stop asking and we don't
-                                # know which car in the list is connected to our
-                                # TWC.
-                                logger.info(
-                                    vehicle.name
-                                    + " is done charging or already trying to charge or not connected to a charger."
-                                    + "  Stop asking to start charging."
-                                )
-                                vehicle.stopAskingToStartCharging = True
-                                self.resetCarApiLastErrorTime(vehicle)
-                            elif reason == "could_not_wake_buses":
-                                # This error often happens if you call
-                                # charge_start too quickly after another command
-                                # like drive_state. Even if you delay 5 seconds
-                                # between the commands, this error still comes
-                                # up occasionally. Retrying often succeeds, so
-                                # wait 5 secs and retry.
-                                # If all retries fail, we'll try again in a
-                                # minute because we set
-                                # carApiLastStartOrStopChargeTime = now earlier.
-                                time.sleep(5)
-                                continue
-                            else:
-                                # Start charge failed with an error I
-                                # haven't seen before, so wait
-                                # carApiErrorRetryMins mins before trying again.
-                                logger.info(
-                                    'ERROR "'
-                                    + reason
-                                    + '" when trying to '
-                                    + startOrStop
-                                    + " car charging via Tesla car API.  Will try again later."
-                                    + "\nIf this error persists, please file an issue at https://github.com/ngardiner/TWCManager/ with a copy of this error.",
-                                )
-                                result = "error"
-                                self.updateCarApiLastErrorTime(vehicle)
-                        else:
-                            # Stop charge failed with an error I
-                            # haven't seen before, so wait
-                            # carApiErrorRetryMins mins before trying again.
-                            reason = self.findReason(apiResponseDict)
-                            logger.info(
-                                'ERROR "'
-                                + reason
-                                + '" when trying to '
-                                + startOrStop
-                                + " car charging via Tesla car API.  Will try again later."
-                                + "\nIf this error persists, please file an issue at https://github.com/ngardiner/TWCManager/ with a copy of this error.",
-                            )
-                            result = "error"
-                            self.updateCarApiLastErrorTime(vehicle)
-
-                except (KeyError, TypeError):
-                    # This catches cases like trying to access
-                    # apiResponseDict['response'] when 'response' doesn't exist in
-                    # apiResponseDict.
+                else:
+                    # Stop charge failed with an error I
+                    # haven't seen before, so wait
+                    # carApiErrorRetryMins mins before trying again.
+                    reason = self.findReason(apiResponseDict)
                     logger.info(
-                        "ERROR: Failed to "
+                        'ERROR "'
+                        + reason
+                        + '" when trying to '
                         + startOrStop
                         + " car charging via Tesla car API.  Will try again later."
+                        + "\nIf this error persists, please file an issue at https://github.com/ngardiner/TWCManager/ with a copy of this error.",
                     )
+                    result = "error"
                     self.updateCarApiLastErrorTime(vehicle)
-                break
 
-        if self.getLastStartOrStopChargeTime() == now:
-            logger.info("Car API " + startOrStop + " charge result: " + result)
+        except (KeyError, TypeError):
+            # This catches cases like trying to access
+            # apiResponseDict['response'] when 'response' doesn't exist in
+            # apiResponseDict.
+            logger.info(
+                "ERROR: Failed to "
+                + startOrStop
+                + " car charging via Tesla car API.  Will try again later."
+            )
+            self.updateCarApiLastErrorTime(vehicle)
 
         return result
 
@@ -1017,13 +1053,16 @@ class TeslaAPI:
         if vehicle:
             lastError = max(vehicle.lastErrorTime, lastError)
 
+        # The API may also have told us how long to wait with Retry-After
+        retryAfter = self.client.getRetryAfter()
+
         if lastError == 0:
-            return 0
+            return retryAfter
         else:
             backoff = self.getCarApiErrorRetryMins(vehicle) * 60
             lasterrortime = time.time() - lastError
             if lasterrortime >= backoff:
-                return 0
+                return retryAfter
             else:
                 logger.log(
                     logging.DEBUG2,
@@ -1034,11 +1073,25 @@ class TeslaAPI:
                     + ", last error was "
                     + str(lastError),
                 )
-                return int(backoff - lasterrortime)
+                return max(int(backoff - lasterrortime), retryAfter)
 
     def getCarApiTokenExpireTime(self):
         return self.carApiTokenExpireTime
 
+    def getCommandStats(self):
+        # Returns how long each command sent to a vehicle took, to compare
+        # with the TeslaBLE module's getCommandStats()
+        return self.commandStats.getStats()
+
+    def getCommandPool(self):
+        # Returns the pool of workers which send commands to each vehicle,
+        # starting it the first time it is needed. Its workers are daemon
+        # threads, so a vehicle which never answers can't stop us exiting.
+        with self.commandsPendingLock:
+            if self.commandPool is None:
+                self.commandPool = DaemonExecutor(self.commandWorkers, "TeslaAPI")
+        return self.commandPool
+
     def getLastStartOrStopChargeTime(self):
         return int(self.carApiLastStartOrStopChargeTime)
 
@@ -1056,6 +1109,29 @@ class TeslaAPI:
     def getCarApiVehicles(self):
         return self.carApiVehicles
 
+    def getVehicleByVIN(self, vin):
+        # Returns the vehicle object identified by the given VIN, or None
+        return self.vehicles.get(vin, None)
+
+    def checkVehicleSync(self):
+        # Run as the checkVehicleSync background task every
+        # syncCheckInterval seconds while there are vehicles to check
+        self.syncCheckQueued = False
+        try:
+            for vehicle in self.getCarApiVehicles():
+                vehicle.checkSyncNotStale()
+        finally:
+            self.queueVehicleSyncCheck()
+
+    def queueVehicleSyncCheck(self):
+        # Queue the next check that the data from external sync sources is
+        # still being updated, unless one is already queued
+        if not self.syncCheckQueued and self.vehicles:
+            self.syncCheckQueued = True
+            self.master.queue_background_task(
+                {"cmd": "checkVehicleSync"}, self.syncCheckInterval
+            )
+
     def resetCarApiLastErrorTime(self, vehicle=None):
         self.carApiLastErrorTime = 0
         if vehicle:
@@ -1074,7 +1150,6 @@ class TeslaAPI:
         logger.log(logging.INFO2, "State: " + code.group(2))
 
         # Exchange auth code for bearer token
-        headers = {"accept": "application/json", "Content-Type": "application/json"}
         data = {
             "client_id": "ownerapi",
             "grant_type": "authorization_code",
@@ -1082,22 +1157,14 @@ class TeslaAPI:
             "code_verifier": self.__apiVerifier.decode("UTF-8"),
             "redirect_uri": self.__callbackURL,
         }
-        req = None
-        now = time.time()
-        try:
-            req = requests.post(self.__authURL, headers=headers, json=data)
-            logger.log(logging.INFO2, "Car API request" + str(req))
-            apiResponseDict = json.loads(req.text)
-        except requests.exceptions.RequestException:
+        req, params = self.client.request("POST", self.__authURL, body=data, auth=False)
+        logger.log(logging.INFO2, "Car API request" + str(req))
+        if req is None:
             logger.error("Request Exception parsing API Token Exchange Response")
-            pass
-        except ValueError:
-            pass
-        except json.decoder.JSONDecodeError:
+            return "unknown"
+        if params is None:
             logger.error("JSON Decode Error parsing API Token Exchange Response")
-            pass
-
-        params = json.loads(req.text)
+            params = {}
 
         # Check for errors
         if "error" in params:
@@ -1168,7 +1235,7 @@ class TeslaAPI:
                 or self.getCarApiTokenExpireTime() - time.time() < 60 * 60
             )
         ):
-            return self.apiRefresh()
+            return self.client.refreshToken()
         return True
 
     def setCarApiTokenExpireTime(self, value):
@@ -1191,23 +1258,16 @@ class TeslaAPI:
         url = self.baseURL + "/"
         url = url + str(vehicle.VIN) + "/command/set_charging_amps"
 
-        headers = {
-            "accept": "application/json",
-            "Authorization": "Bearer " + self.getCarApiBearerToken(),
-        }
-
         body = {"charging_amps": charge_rate}
 
-        try:
-            req = requests.post(url, headers=headers, json=body, verify=self.verifyCert)
-            logger.log(
-                logging.INFO8,
-                f"Car API cmd set_charging_amps {charge_rate}A {str(req)}",
-            )
-            apiResponseDict = json.loads(req.text)
-        except requests.exceptions.RequestException:
-            return False
-        except json.decoder.JSONDecodeError:
+        req, apiResponseDict = self.client.request(
+            "POST", url, body=body, vehicle=vehicle
+        )
+        logger.log(
+            logging.INFO8,
+            f"Car API cmd set_charging_amps {charge_rate}A {str(req)}",
+        )
+        if apiResponseDict is None:
             return False
 
         # Set charge rates < 5 twice, see https://github.com/tdorssers/TeslaPy/pull/42
@@ -1217,6 +1277,26 @@ class TeslaAPI:
         else:
             return apiResponseDict
 
+    def submitChargeCommand(self, vehicle, charge, limits):
+        # Queues the start or stop charge command for vehicle on the command
+        # pool, and returns its future. Only one command per vehicle waits to
+        # be sent: if the same command is already waiting or being sent, its
+        # future is returned instead, and a waiting command which is the
+        # opposite of this one is cancelled, so that repeated calls to
+        # car_api_charge() can't pile up behind a vehicle which is slow to
+        # answer.
+        pool = self.getCommandPool()
+        with self.commandsPendingLock:
+            pending = self.commandsPending.get(vehicle.VIN, None)
+            if pending and not pending[1].done():
+                if pending[0] == charge:
+                    return pending[1]
+                pending[1].cancel()
+
+            future = pool.submit(self.car_api_charge_vehicle, vehicle, charge, limits)
+            self.commandsPending[vehicle.VIN] = (charge, future)
+        return future
+
     def updateCarApiLastErrorTime(self, vehicle=None):
         timestamp = time.time()
         logger.log(
@@ -1252,30 +1332,17 @@ class TeslaAPI:
         url = self.baseURL + "/"
         url = url + str(vehicle.VIN) + "/wake_up"
 
-        headers = {
-            "accept": "application/json",
-            "Authorization": "Bearer " + self.getCarApiBearerToken(),
-        }
-        try:
-            req = requests.post(url, headers=headers, verify=self.verifyCert)
-            logger.log(logging.INFO8, "Car API cmd wake_up" + str(req))
-            req.raise_for_status()
-            apiResponseDict = json.loads(req.text)
-        except requests.exceptions.RequestException:
-            if req.status_code == 401 and "expired" in req.text:
-                # If the token is expired, refresh it and try again
-                if self.apiRefresh():
-                    return self.wakeVehicle(vehicle)
-            elif req.status_code == 429:
-                # We're explicitly being told to back off
-                self.errorCount = max(30, self.errorCount)
-                self.updateCarApiLastErrorTime(vehicle)
-            return False
-        except json.decoder.JSONDecodeError:
+        req, apiResponseDict = self.client.request("POST", url, vehicle=vehicle)
+        logger.log(logging.INFO8, "Car API cmd wake_up" + str(req))
+        if req is None or not req.ok or apiResponseDict is None:
             return False
 
         return apiResponseDict
 
+    @property
+    def carApiVehicles(self):
+        return list(self.vehicles.values())
+
     @property
     def numCarsAtHome(self):
         return len([car for car in self.carApiVehicles if car.atHome])
@@ -1297,7 +1364,6 @@ class CarApiVehicle:
     carapi = None
     __config = None
     debuglevel = 0
-    verifyCert = None
     ID = None
     name = ""
     syncSource = "TeslaAPI"
@@ -1310,34 +1376,32 @@ class CarApiVehicle:
 
     errorCount = 0
     lastErrorTime = 0
-    lastVehicleStatusTime = 0
     stopAskingToStartCharging = False
     stopTryingToApplyLimit = False
 
-    batteryLevel = 10000
-    chargeLimit = -1
-    lat = 10000
-    lon = 10000
-    atHome = False
-    timeToFullCharge = 0.0
-
-    # Sync values are updated by an external module such as TeslaMate
-    syncTimestamp = 0
+    # The vehicle's location, charge and sleep state are kept in state, which
+    # is written by this module when it polls the Tesla API and by external
+    # modules such as TeslaMate
+    state = None
     syncTimeout = 60 * 60
-    syncLat = 10000
-    syncLon = 10000
-    syncState = "asleep"
+
+    # States in which the vehicle will answer commands without being woken
+    awakeStates = ("online", "charging", "updating", "driving")
 
     def __init__(self, json, carapi, config):
         self.carapi = carapi
         self.__config = config
-        self.verifyCert = config["config"].get("teslaProxyCert", True)
         self.ID = json["id"]
         self.VIN = json["vin"]
         self.name = json["display_name"] or self.VIN or str(self.ID) or "unknown"
-
-        # Launch sync monitoring thread
-        Thread(target=self.checkSyncNotStale).start()
+        self.state = VehicleState(
+            atHome=False,
+            batteryLevel=10000,
+            chargeLimit=-1,
+            lat=10000,
+            lon=10000,
+            timeToFullCharge=0.0,
+        )
 
     def checkSyncNotStale(self):
         # Once an external system begins providing sync functionality to defer
@@ -1345,25 +1409,49 @@ class CarApiVehicle:
         # potential condition which may occur in which the external system goes
         # away and leaves us with stale data.
 
-        # To guard against this, this threaded function will loop every x minutes
-        # and check the last sync timestamp. If it has not updated in that interval,
-        # we switch back to using the API
+        # To guard against this, TeslaAPI.checkVehicleSync() calls this every
+        # few minutes to check the last sync timestamp. If it has not updated
+        # within syncTimeout, we switch back to using the API
 
-        while True:
-            if (
-                self.syncSource != "TeslaAPI"
-                and self.self.is_awake()
-                and (self.syncTimestamp < (time.time() - self.syncTimeout))
-            ):
-                logger.error(
-                    "Data from "
-                    + self.syncSource
-                    + " for "
-                    + self.name
-                    + " is stale. Switching back to TeslaAPI"
-                )
-                self.syncSource = "TeslaAPI"
-            time.sleep(self.syncTimeout)
+        if (
+            self.syncSource != "TeslaAPI"
+            and self.is_awake()
+            and self.state.getLastUpdate(self.syncSource)
+            < (time.time() - self.syncTimeout)
+        ):
+            logger.error(
+                "Data from "
+                + self.syncSource
+                + " for "
+                + self.name
+                + " is stale. Switching back to TeslaAPI"
+            )
+            self.state.expire(self.syncSource)
+            self.syncSource = "TeslaAPI"
+
+    @property
+    def atHome(self):
+        return self.state.get("atHome")
+
+    @property
+    def batteryLevel(self):
+        return self.state.get("batteryLevel")
+
+    @property
+    def chargeLimit(self):
+        return self.state.get("chargeLimit")
+
+    @property
+    def lat(self):
+        return self.state.get("lat")
+
+    @property
+    def lon(self):
+        return self.state.get("lon")
+
+    @property
+    def timeToFullCharge(self):
+        return self.state.get("timeToFullCharge")
 
     def ready(self):
         if self.carapi.getCarApiRetryRemaining(self):
@@ -1400,100 +1488,62 @@ class CarApiVehicle:
 
     # Permits opportunistic API requests
     def is_awake(self):
-        if self.syncSource == "TeslaAPI":
-            url = self.carapi.getCarApiBaseURL() + "/" + str(self.VIN)
-            (result, response) = self.get_car_api(
-                url, checkReady=False, provesOnline=False
-            )
-            return result and response.get("state", "") == "online"
-        else:
-            return (
-                self.syncState == "online"
-                or self.syncState == "charging"
-                or self.syncState == "updating"
-                or self.syncState == "driving"
-            )
+        # Use the last known state if it is recent enough, whichever module
+        # reported it
+        if self.state.isFresh("state"):
+            return self.state.get("state") in self.awakeStates
+
+        url = self.carapi.getCarApiBaseURL() + "/" + str(self.VIN)
+        (result, response) = self.get_car_api(url, checkReady=False, provesOnline=False)
+        if result:
+            self.state.set("state", response.get("state", ""), "TeslaAPI")
+        return result and response.get("state", "") in self.awakeStates
 
     def get_car_api(self, url, checkReady=True, provesOnline=True):
         if checkReady and not self.ready():
             return False, None
 
-        apiResponseDict = {}
-
-        headers = {
-            "accept": "application/json",
-            "Authorization": "Bearer " + self.carapi.getCarApiBearerToken(),
-        }
-
-        # Retry up to 3 times on certain errors.
-        for _ in range(0, 3):
-            try:
-                req = requests.get(url, headers=headers, verify=self.verifyCert)
-                req.raise_for_status()
-                logger.log(logging.INFO8, "Car API cmd " + url + " " + str(req))
-                apiResponseDict = json.loads(req.text)
-                # This error can happen here as well:
-                #   {'response': {'reason': 'could_not_wake_buses', 'result': False}}
-                # This one is somewhat common:
-                #   {'response': None, 'error': 'vehicle unavailable: {:error=>"vehicle unavailable:"}', 'error_description': ''}
-            except requests.exceptions.RequestException:
-                if req.status_code == 401 and "expired" in req.text:
-                    # If the token is expired, refresh it and try again
-                    if self.apiRefresh():
-                        continue
-                elif req.status_code == 429:
-                    # We're explicitly being told to back off
-                    self.errorCount = max(30, self.errorCount)
-                    self.carapi.updateCarApiLastErrorTime(self)
-                return False, None
-            except json.decoder.JSONDecodeError:
-                pass
+        req, apiResponseDict = self.carapi.client.request("GET", url, vehicle=self)
+        logger.log(logging.INFO8, "Car API cmd " + url + " " + str(req))
+        if req is None or not req.ok:
+            return False, None
 
-            try:
-                logger.debug("Car API vehicle status" + str(apiResponseDict))
+        # This error can happen here as well, and the client will have retried
+        # the request a few times before giving up:
+        #   {'response': {'reason': 'could_not_wake_buses', 'result': False}}
+        # This one is somewhat common:
+        #   {'response': None, 'error': 'vehicle unavailable: {:error=>"vehicle unavailable:"}', 'error_description': ''}
+        try:
+            logger.debug("Car API vehicle status" + str(apiResponseDict))
 
-                response = apiResponseDict["response"]
+            response = apiResponseDict["response"]
 
-                # A successful call to drive_state will not contain a
-                # response['reason'], so we check if the 'reason' key exists.
-                if (
-                    "reason" in response
-                    and response["reason"] == "could_not_wake_buses"
-                ):
-                    # Retry after 5 seconds.  See notes in car_api_charge where
-                    # 'could_not_wake_buses' is handled.
-                    time.sleep(5)
-                    continue
-            except (KeyError, TypeError):
-                # This catches cases like trying to access
-                # apiResponseDict['response'] when 'response' doesn't exist in
-                # apiResponseDict.
-                logger.info(
-                    "ERROR: Can't access vehicle status for "
-                    + self.name
-                    + ".  Will try again later."
-                )
+            # A successful call to drive_state will not contain a
+            # response['reason'], so we check if the 'reason' key exists.
+            if "reason" in response and response["reason"] == "could_not_wake_buses":
                 self.carapi.updateCarApiLastErrorTime(self)
                 return False, None
-
-            if provesOnline:
-                self.lastAPIAccessTime = time.time()
-
-            return (True, response)
-        else:
+        except (KeyError, TypeError):
+            # This catches cases like trying to access
+            # apiResponseDict['response'] when 'response' doesn't exist in
+            # apiResponseDict.
+            logger.info(
+                "ERROR: Can't access vehicle status for "
+                + self.name
+                + ".  Will try again later."
+            )
             self.carapi.updateCarApiLastErrorTime(self)
-            return (False, None)
+            return False, None
 
-    def update_location(self, cacheTime=300):
-        if self.syncSource == "TeslaAPI":
-            return self.update_vehicle_data(cacheTime)
+        if provesOnline:
+            self.lastAPIAccessTime = time.time()
 
-        else:
-            self.lat = self.syncLat
-            self.lon = self.syncLon
-            self.atHome = self.carapi.is_location_home(self.lat, self.lon)
+        return (True, response)
 
+    def update_location(self, cacheTime=300):
+        if self.state.isFresh("atHome", cacheTime):
             return True
+        return self.update_vehicle_data(cacheTime)
 
     def update_vehicle_data(self, cacheTime=300):
         url = (
@@ -1504,9 +1554,10 @@ class CarApiVehicle:
             )
         )
 
-        now = time.time()
-
-        if now - self.lastVehicleStatusTime < cacheTime:
+        if all(
+            self.state.isFresh(field, cacheTime)
+            for field in ("atHome", "batteryLevel", "chargeLimit")
+        ):
             return True
 
         try:
@@ -1517,27 +1568,30 @@ class CarApiVehicle:
 
         if result:
             drive = response["drive_state"]
-            self.lat = drive["latitude"]
-            self.lon = drive["longitude"]
-            self.atHome = self.carapi.is_location_home(self.lat, self.lon)
-
             charge = response["charge_state"]
-            self.chargeLimit = charge["charge_limit_soc"]
-            self.batteryLevel = charge["battery_level"]
-            self.timeToFullCharge = charge["time_to_full_charge"]
+            self.state.update(
+                {
+                    "atHome": self.carapi.is_location_home(
+                        drive["latitude"], drive["longitude"]
+                    ),
+                    "batteryLevel": charge["battery_level"],
+                    "chargeLimit": charge["charge_limit_soc"],
+                    "lat": drive["latitude"],
+                    "lon": drive["longitude"],
+                    "state": response.get("state", "online"),
+                    "timeToFullCharge": charge["time_to_full_charge"],
+                },
+                "TeslaAPI",
+            )
 
             self.name = response["vehicle_state"]["vehicle_name"] or self.name
 
-            self.lastVehicleStatusTime = now
-
         return result
 
     def update_charge(self):
-        if self.syncSource == "TeslaAPI":
-            return self.update_vehicle_data()
-
-        else:
+        if self.state.isFresh("batteryLevel") and self.state.isFresh("chargeLimit"):
             return True
+        return self.update_vehicle_data()
 
     def apply_charge_limit(self, limit):
         if self.stopTryingToApplyLimit:
@@ -1558,46 +1612,30 @@ class CarApiVehicle:
 
         url = self.carapi.getCarApiBaseURL() + "/"
         url = url + str(self.VIN) + "/command/set_charge_limit"
-
-        headers = {
-            "accept": "application/json",
-            "Authorization": "Bearer " + self.carapi.getCarApiBearerToken(),
-        }
         body = {"percent": limit}
 
-        for _ in range(0, 3):
-            try:
-                req = requests.post(
-                    url, headers=headers, json=body, verify=self.verifyCert
-                )
-                logger.log(logging.INFO8, "Car API cmd set_charge_limit " + str(req))
-
-                apiResponseDict = json.loads(req.text)
-            except requests.exceptions.RequestException:
-                pass
-            except json.decoder.JSONDecodeError:
-                pass
+        req, apiResponseDict = self.carapi.client.request(
+            "POST", url, body=body, vehicle=self
+        )
+        logger.log(logging.INFO8, "Car API cmd set_charge_limit " + str(req))
 
+        result = False
+        reason = ""
+        try:
+            result = apiResponseDict["response"]["result"]
+            reason = self.carapi.findReason(apiResponseDict)
+        except (KeyError, TypeError):
+            # This catches unexpected cases like trying to access
+            # apiResponseDict['response'] when 'response' doesn't exist
+            # in apiResponseDict.
             result = False
-            reason = ""
-            try:
-                result = apiResponseDict["response"]["result"]
-                reason = self.carapi.findReason(apiResponseDict)
-            except (KeyError, TypeError):
-                # This catches unexpected cases like trying to access
-                # apiResponseDict['response'] when 'response' doesn't exist
-                # in apiResponseDict.
-                result = False
-
-            if result is True or reason == "already_set":
-                self.stopTryingToApplyLimit = True
-                self.lastAPIAccessTime = now
-                self.carapi.resetCarApiLastErrorTime(self)
-                return True
-            elif reason == "could_not_wake_buses":
-                time.sleep(5)
-                continue
-            else:
-                self.carapi.updateCarApiLastErrorTime(self)
 
+        if result is True or reason == "already_set":
+            self.stopTryingToApplyLimit = True
+            self.lastAPIAccessTime = now
+            self.state.set("chargeLimit", limit, "TeslaAPI")
+            self.carapi.resetCarApiLastErrorTime(self)
+            return True
+
+        self.carapi.updateCarApiLastErrorTime(self)
         return False
@@ -0,0 +1,177 @@
+# Sends requests to the Tesla API (or the Tesla HTTP proxy) and its
+# authentication server for the TeslaAPI module.
+#
+# All requests share one requests.Session, so the connection to the API is
+# kept open between requests rather than set up again for each one.
+#
+# Requests made with auth=True carry the current bearer token. If the API
+# says the token has expired, the token is refreshed and the request is sent
+# again. Only one refresh runs at a time: a request which finds a refresh
+# already in progress waits for it and then uses the new token, rather than
+# refreshing the token again.
+#
+# If the API answers 429 Too Many Requests, no further requests are sent
+# until the time given by its Retry-After header has passed. Commands which
+# fail with could_not_wake_buses are retried here, after a short wait.
+#
+# The time taken by each command sent to a vehicle, including any retries, is
+# recorded in the TeslaAPI module's commandStats.
+#
+# This module is shared by the Vehicle modules, and is not loaded as a module
+# of its own.
+
+from email.utils import parsedate_to_datetime
+import json
+import logging
+import requests
+import threading
+import time
+
+logger = logging.getLogger("\U0001F697 TeslaAPI")
+
+
+class TeslaAPIClient:
+    # Number of seconds to wait before sending a command again after
+    # could_not_wake_buses, and how many times to send it
+    busesRetryDelay = 5
+    retries = 3
+
+    # If Retry-After asks us to wait this many seconds or fewer, wait and send
+    # the request again rather than failing it
+    retryAfterWaitMax = 10
+
+    timeout = 60
+
+    def __init__(self, carapi):
+        self.carapi = carapi
+        # Re-entrant, as saving the new tokens can itself ask for a refresh
+        self.refreshLock = threading.RLock()
+        self.retryAfter = 0
+        self.session = requests.Session()
+
+    def getRetryAfter(self):
+        # Returns the number of seconds until requests can be sent again after
+        # a 429 response, or 0
+        return max(int(self.retryAfter - time.time()), 0)
+
+    def parseRetryAfter(self, response):
+        # Returns the number of seconds the Retry-After header asks us to
+        # wait, which may be given as a number of seconds or as a date, or
+        # None if there isn't one
+        value = response.headers.get("Retry-After", None)
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def refreshToken(self, token=None):
+        # Refresh the bearer token, unless it has already been replaced since
+        # token was used. Returns True if there is a new token.
+        if token is None:
+            token = self.carapi.getCarApiBearerToken()
+        with self.refreshLock:
+            if self.carapi.getCarApiBearerToken() != token:
+                # Another request refreshed the token while we waited
+                return True
+            return self.carapi.apiRefresh()
+
+    def request(self, method, url, body=None, auth=True, vehicle=None):
+        # Send a request, returning the response and its JSON body. The
+        # response is None if no response was received, and the body is None
+        # if it wasn't valid JSON. vehicle is the vehicle the request is for,
+        # if any, which is told about 429 responses.
+        start = time.monotonic()
+        response, data = self.send(method, url, body, auth, vehicle)
+
+        # Commands are sent to vehicles as POST requests, and named by the
+        # last part of the URL, eg. charge_start or wake_up
+        if method == "POST" and auth:
+            self.carapi.commandStats.record(
+                url.rsplit("/", 1)[-1],
+                time.monotonic() - start,
+                response is not None and response.ok and data is not None,
+            )
+        return response, data
+
+    def send(self, method, url, body, auth, vehicle):
+        response = None
+        for attempt in range(0, self.retries):
+            if self.getRetryAfter():
+                logger.log(
+                    logging.INFO8,
+                    "Not sending request to %s for %d more seconds, as asked by the API",
+                    url,
+                    self.getRetryAfter(),
+                )
+                return response, None
+
+            headers = {"accept": "application/json"}
+            token = None
+            if auth:
+                token = self.carapi.getCarApiBearerToken()
+                headers["Authorization"] = "Bearer " + token
+            if body is not None:
+                headers["Content-Type"] = "application/json"
+
+            try:
+                response = self.session.request(
+                    method,
+                    url,
+                    headers=headers,
+                    json=body,
+                    timeout=self.timeout,
+                    verify=self.carapi.verifyCert if auth else True,
+                )
+            except requests.exceptions.RequestException as e:
+                logger.log(logging.INFO8, "Car API request to %s failed: %s", url, e)
+                return None, None
+
+            if response.status_code == 401 and "expired" in response.text and auth:
+                # If the token is expired, refresh it and try again
+                if self.refreshToken(token):
+                    continue
+                return response, None
+
+            if response.status_code == 429:
+                # We're explicitly being told to back off
+                delay = self.parseRetryAfter(response)
+                if delay is None:
+                    self.carapi.errorCount = max(30, self.carapi.errorCount)
+                    self.carapi.updateCarApiLastErrorTime(vehicle)
+                    return response, None
+
+                self.retryAfter = time.time() + delay
+                logger.info(
+                    "Car API asked us to wait %d seconds before sending more requests",
+                    delay,
+                )
+                if delay <= self.retryAfterWaitMax and attempt + 1 < self.retries:
+                    time.sleep(delay)
+                    continue
+                return response, None
+
+            try:
+                data = json.loads(response.text)
+            except json.decoder.JSONDecodeError:
+                return response, None
+
+            # This error often happens if a command is sent too quickly after
+            # another command, and retrying a few seconds later often succeeds:
+            #   {'response': {'result': False, 'reason': 'could_not_wake_buses'}}
+            try:
+                reason = data["response"]["reason"]
+            except (KeyError, TypeError):
+                reason = None
+            if reason == "could_not_wake_buses" and attempt + 1 < self.retries:
+                time.sleep(self.busesRetryDelay)
+                continue
+
+            return response, data
+
+        return response, None
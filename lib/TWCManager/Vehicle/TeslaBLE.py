@@ -5,25 +5,32 @@ from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives import hashes
 import logging
 import os
-import subprocess
-from threading import Timer
-import time
+from threading import Lock
+from TWCManager.Vehicle.CommandStats import CommandStats
+from TWCManager.Vehicle.TeslaBLESession import TeslaBLESession
 
 logger = logging.getLogger("\U0001F697 TeslaBLE")
 
 
 class TeslaBLE:
     binaryPath = "/home/twcmanager/gobin/tesla-control"
+    commandStats = None
     commandTimeout = 10
     config = None
     master = None
-    pipe = None
-    pipeName = "/tmp/ble_data"
+    sessionPath = None
+    sessions = None
 
     def __init__(self, master):
         self.master = master
+        self.commandStats = CommandStats()
+        self.sessions = {}
+        self.sessionsLock = Lock()
         try:
             self.config = self.master.config
+            self.commandTimeout = self.config["config"].get(
+                "bleCommandTimeout", self.commandTimeout
+            )
         except KeyError:
             pass
 
@@ -43,148 +50,115 @@ class TeslaBLE:
                 self.stopCharging(vehicle)
                 return self.pingVehicle(vehicle)
 
-    def parseCommandOutput(self, output):
-        success = False
-        if "Updated session info for DOMAIN_VEHICLE_SECURITY" in output:
-            success = True
-
-        return success
+    def getCommandStats(self):
+        # Returns how long each BLE command took, to compare with the
+        # TeslaAPI module's getCommandStats()
+        return self.commandStats.getStats()
+
+    def getSession(self, vin):
+        # Returns the BLE session for the given VIN, which is kept for as
+        # long as we run
+        with self.sessionsLock:
+            if vin not in self.sessions:
+                self.sessions[vin] = TeslaBLESession(self, vin)
+            return self.sessions[vin]
+
+    def getSessionPath(self):
+        # The directory which holds the key and saved session of each
+        # vehicle, which only we can read
+        if not self.sessionPath:
+            self.sessionPath = os.path.join(
+                self.config["config"].get("settingsPath", "/etc/twcmanager"), "ble"
+            )
+            os.makedirs(self.sessionPath, mode=0o700, exist_ok=True)
+        return self.sessionPath
 
     def peerWithVehicle(self, vin):
-        self.sendPublicKey(vin)
-        result = subprocess.run(
-            [
-                self.binaryPath,
-                "-debug",
-                "-ble",
-                "-vin",
-                vin,
-                "add-key-request",
-                self.pipeName,
-                "owner",
-                "cloud_key",
-            ],
-            stdout=subprocess.PIPE,
-        )
-        self.closeFile()
-        return self.parseCommandOutput(ret)
+        success, output = self.getSession(vin).addKey()
+        return success
 
     def pingVehicle(self, vin):
-        ret = self.sendCommand(vin, "ping")
-        return self.parseCommandOutput(ret)
+        success = self.sendCommand(vin, "ping")
+        if success:
+            self.updateVehicleState(vin)
+        return success
 
     def sendCommand(self, vin, command, args=None):
-        self.sendPrivateKey(vin)
-        command_string = [
-            self.binaryPath,
-            "-debug",
-            "-ble",
-            "-vin",
-            vin,
-            "-key-file",
-            self.pipeName,
-            command,
-        ]
-        if args:
-            command_string.append(args)
-
-        result = subprocess.Popen(
-            command_string,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        timer = Timer(self.commandTimeout, result.kill)
-        try:
-            timer.start()
-            stdout, stderr = result.communicate()
-        finally:
-            timer.cancel()
-
-        self.closeFile()
-        return stderr.decode("utf-8")
+        # Returns True if the vehicle carried out the command
+        success, output = self.getSession(vin).sendCommand(command, args)
+        if not success:
+            logger.log(
+                logging.INFO8, "BLE command %s for %s failed: %s", command, vin, output
+            )
+        return success
 
     def setChargeRate(self, charge_rate, vehicle=None, set_again=False):
-        ret = self.sendCommand(vehicle, "charging-set-amps", charge_rate)
-        return self.parseCommandOutput(ret)
+        return self.sendCommand(vehicle, "charging-set-amps", charge_rate)
 
     def startCharging(self, vin):
         self.wakeVehicle(vin)
-        ret = self.sendCommand(vin, "charging-start")
-        return self.parseCommandOutput(ret)
+        return self.sendCommand(vin, "charging-start")
 
     def stopCharging(self, vin):
-        ret = self.sendCommand(vin, "charging-stop")
-        return self.parseCommandOutput(ret)
+        return self.sendCommand(vin, "charging-stop")
 
     def scanForVehicles(self):
         # This function allows other modules to prompt us to connect to BLE
         # vehicles.
 
         # Ensure we have a Private Key defined for each known vehicle
-        if self.master.settings.get("Vehicles", None):
-            for vehicle in self.master.settings["Vehicles"].keys():
-                if not "privKey" in self.master.settings["Vehicles"][vehicle]:
-                    logger.log(
-                        logging.INFO2,
-                        "Vehicle "
-                        + str(vehicle)
-                        + " has no Private Key defined for BLE. Creating one.",
-                    )
-                    private_key = ec.generate_private_key(
-                        ec.SECP256R1(), default_backend()
-                    )
-                    self.master.settings["Vehicles"][vehicle]["privKey"] = (
-                        base64.b64encode(
-                            private_key.private_bytes(
-                                serialization.Encoding.PEM,
-                                serialization.PrivateFormat.PKCS8,
-                                serialization.NoEncryption(),
-                            )
-                        ).decode()
-                    )
-                    public_key = private_key.public_key()
-                    self.master.settings["Vehicles"][vehicle]["pubKey"] = (
-                        base64.b64encode(
-                            public_key.public_bytes(
-                                serialization.Encoding.X962,
-                                serialization.PublicFormat.UncompressedPoint,
-                            )
-                        ).decode()
-                    )
-                    self.master.settings["Vehicles"][vehicle]["pubKeyPEM"] = (
-                        base64.b64encode(
-                            public_key.public_bytes(
-                                serialization.Encoding.PEM,
-                                serialization.PublicFormat.SubjectPublicKeyInfo,
-                            )
-                        ).decode()
-                    )
-                    self.master.queue_background_task({"cmd": "saveSettings"})
-        else:
-            logger.log(logging.INFO2, "No known vehicles.")
+        with self.master.settingsLock:
+            if self.master.settings.get("Vehicles", None):
+                for vehicle in self.master.settings["Vehicles"].keys():
+                    if not "privKey" in self.master.settings["Vehicles"][vehicle]:
+                        logger.log(
+                            logging.INFO2,
+                            "Vehicle "
+                            + str(vehicle)
+                            + " has no Private Key defined for BLE. Creating one.",
+                        )
+                        private_key = ec.generate_private_key(
+                            ec.SECP256R1(), default_backend()
+                        )
+                        self.master.settings["Vehicles"][vehicle]["privKey"] = (
+                            base64.b64encode(
+                                private_key.private_bytes(
+                                    serialization.Encoding.PEM,
+                                    serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption(),
+                                )
+                            ).decode()
+                        )
+                        public_key = private_key.public_key()
+                        self.master.settings["Vehicles"][vehicle]["pubKey"] = (
+                            base64.b64encode(
+                                public_key.public_bytes(
+                                    serialization.Encoding.X962,
+                                    serialization.PublicFormat.UncompressedPoint,
+                                )
+                            ).decode()
+                        )
+                        self.master.settings["Vehicles"][vehicle]["pubKeyPEM"] = (
+                            base64.b64encode(
+                                public_key.public_bytes(
+                                    serialization.Encoding.PEM,
+                                    serialization.PublicFormat.SubjectPublicKeyInfo,
+                                )
+                            ).decode()
+                        )
+                        self.master.queue_background_task({"cmd": "saveSettings"})
+            else:
+                logger.log(logging.INFO2, "No known vehicles.")
 
     def wakeVehicle(self, vin):
         self.sendCommand(vin, "wake")
 
-    def closeFile(self):
-        self.pipe.close()
-        os.unlink(self.pipeName)
-
-    def openFile(self):
-        # Open output file for passing data to tesla-control
-        self.pipe = open(self.pipeName, "wb", 0)
-
-    def sendPublicKey(self, vin):
-        self.openFile()
-        self.pipe.write(
-            base64.b64decode(self.master.settings["Vehicles"][vin]["pubKeyPEM"]),
-        )
-
-    def sendPrivateKey(self, vin):
-        self.openFile()
-        self.pipe.write(
-            base64.b64decode(self.master.settings["Vehicles"][vin]["privKey"]),
-        )
+    def updateVehicleState(self, vin):
+        # A vehicle which answers over BLE is within range of us, so it must
+        # be at home
+        vehicle = self.master.getModuleByName("TeslaAPI").getVehicleByVIN(vin)
+        if vehicle:
+            vehicle.state.set("atHome", True, "TeslaBLE")
 
     def updateSettings(self):
         # Called by TWCMaster when settings are read/updated
@@ -0,0 +1,147 @@
+# Sends commands to one vehicle over BLE using tesla-control, for the
+# TeslaBLE module. TeslaBLE keeps one of these for each VIN.
+#
+# tesla-control runs a single command and exits, so there is no connection
+# which could be kept open between commands. What can be kept is the session
+# which is set up with the vehicle before the first command: tesla-control is
+# run with -session-cache, which saves the session when a command finishes
+# and uses it for the next one, so the handshake with the vehicle is only done
+# again when the vehicle no longer accepts the saved session. The vehicle's
+# key is written to a file which only we can read when it is first needed (or
+# changes), rather than before every command.
+#
+# Commands for a vehicle are sent one at a time, and are stopped if they
+# haven't finished within commandTimeout seconds. If a command fails, the
+# saved session is thrown away. If the command had used a saved session and
+# tesla-control reported an error (rather than timing out, which usually
+# means the vehicle is out of range), it is sent once more with a new session.
+#
+# This module is shared by the Vehicle modules, and is not loaded as a module
+# of its own.
+
+import base64
+import logging
+import os
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger("\U0001F697 TeslaBLE")
+
+
+class TeslaBLESession:
+    def __init__(self, ble, vin):
+        self.ble = ble
+        self.vin = vin
+        self.lock = threading.Lock()
+        path = ble.getSessionPath()
+        self.cacheFile = os.path.join(path, vin + ".cache")
+        self.keyFile = os.path.join(path, vin + ".key")
+        self.publicKeyFile = os.path.join(path, vin + ".pem")
+
+    def addKey(self):
+        # Ask the vehicle to add our key. This has to be confirmed by tapping
+        # a key card on the vehicle, so it isn't sent again if it fails.
+        self.writeKey(self.publicKeyFile, "pubKeyPEM")
+        return self.run(
+            "add-key-request",
+            ["add-key-request", self.publicKeyFile, "owner", "cloud_key"],
+            retry=False,
+        )
+
+    def reset(self):
+        # Throw away the saved session, so that the next command sets up a
+        # new one
+        try:
+            os.unlink(self.cacheFile)
+        except FileNotFoundError:
+            pass
+
+    def run(self, name, args, retry=True):
+        # Run tesla-control with args for this vehicle, recording how long
+        # it took as command name. Returns True if the command succeeded, and
+        # the output of tesla-control.
+        with self.lock:
+            cached = os.path.exists(self.cacheFile)
+            success, output = self.runOnce(name, args)
+            if not success:
+                self.reset()
+                if cached and retry and output:
+                    logger.log(
+                        logging.INFO8,
+                        "Retrying BLE command %s for %s with a new session",
+                        name,
+                        self.vin,
+                    )
+                    success, output = self.runOnce(name, args)
+        return success, output
+
+    def runOnce(self, name, args):
+        command = [self.ble.binaryPath, "-debug", "-ble", "-vin", self.vin] + args
+        start = time.monotonic()
+        try:
+            result = subprocess.run(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=self.ble.commandTimeout,
+            )
+            output = result.stderr.decode("utf-8", "replace")
+            success = result.returncode == 0
+        except subprocess.TimeoutExpired:
+            output = ""
+            success = False
+            logger.log(
+                logging.INFO4,
+                "BLE command %s for %s did not finish within %ds",
+                name,
+                self.vin,
+                self.ble.commandTimeout,
+            )
+        except OSError as e:
+            output = ""
+            success = False
+            logger.log(logging.INFO4, "Could not run tesla-control: %s", e)
+        latency = time.monotonic() - start
+
+        self.ble.commandStats.record(name, latency, success)
+        logger.log(
+            logging.INFO8,
+            "BLE command %s for %s %s in %.2fs",
+            name,
+            self.vin,
+            "succeeded" if success else "failed",
+            latency,
+        )
+        return success, output
+
+    def sendCommand(self, command, args=None):
+        self.writeKey(self.keyFile, "privKey")
+        params = [
+            "-key-file",
+            self.keyFile,
+            "-session-cache",
+            self.cacheFile,
+            command,
+        ]
+        if args is not None:
+            params.append(str(args))
+        return self.run(command, params)
+
+    def writeKey(self, filename, setting):
+        # Write the vehicle's key from settings to filename, unless it is
+        # already there, so that only we can read it
+        key = base64.b64decode(self.ble.master.settings["Vehicles"][self.vin][setting])
+        try:
+            with open(filename, "rb") as file:
+                if file.read() == key:
+                    return
+        except OSError:
+            pass
+
+        # A new key can't use a session set up with the old one
+        if setting == "privKey":
+            self.reset()
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as file:
+            file.write(key)
@@ -24,6 +24,9 @@ class TeslaMateVehicle:
     __mqtt_port = 1883
     __mqtt_prefix = None
     lastSync = 0
+    # Number of seconds a value reported by TeslaMate is used for, a few of
+    # TeslaMate's update periods, before the vehicle is asked again
+    stateTTL = 180
     status = None
     syncTokens = False
     vehicles = {}
@@ -59,6 +62,7 @@ class TeslaMateVehicle:
         self.__mqtt_pass = self.__configTeslaMate.get("mqtt_pass", None)
         self.__mqtt_prefix = self.__configTeslaMate.get("mqtt_prefix", None)
 
+        self.stateTTL = self.__configTeslaMate.get("stateTTL", self.stateTTL)
         self.syncTelemetry = self.__configTeslaMate.get("syncTelemetry", False)
         self.syncTokens = self.__configTeslaMate.get("syncTokens", False)
 
@@ -108,7 +112,7 @@ class TeslaMateVehicle:
             logger.debug(str(e))
             return False
 
-        self.__client.loop_start()
+        self.__master.startMQTTLoop(self.__client)
 
     def doSyncTokens(self, firstrun=False):
         # Connect to TeslaMate database and synchronize API tokens
@@ -185,17 +189,15 @@ class TeslaMateVehicle:
         payload = str(message.payload.decode("utf-8"))
 
         if topic[0] == self.__mqtt_prefix and topic[1] == "cars":
+            vehicle = self.vehicles.get(topic[2], None)
+
             if topic[3] == "battery_level":
-                if self.vehicles.get(topic[2], None):
-                    self.vehicles[topic[2]].batteryLevel = int(payload)
-                    self.vehicles[topic[2]].lastChargeStatusTime = time.time()
-                    self.vehicles[topic[2]].syncTimestamp = time.time()
+                if vehicle:
+                    self.updateState(vehicle, {"batteryLevel": int(payload)})
 
             elif topic[3] == "charge_limit_soc":
-                if self.vehicles.get(topic[2], None):
-                    self.vehicles[topic[2]].chargeLimit = int(payload)
-                    self.vehicles[topic[2]].lastChargeStatusTime = time.time()
-                    self.vehicles[topic[2]].syncTimestamp = time.time()
+                if vehicle:
+                    self.updateState(vehicle, {"chargeLimit": int(payload)})
 
             elif topic[3] == "display_name":
                 # We can map the car ID in TeslaMate to the vehicle
@@ -203,25 +205,20 @@ class TeslaMateVehicle:
                 self.updateVehicles(topic[2], payload)
 
             elif topic[3] == "latitude":
-                if self.vehicles.get(topic[2], None):
-                    self.vehicles[topic[2]].syncLat = float(payload)
-                    self.vehicles[topic[2]].syncTimestamp = time.time()
+                if vehicle:
+                    self.updateState(vehicle, {"lat": float(payload)})
 
             elif topic[3] == "longitude":
-                if self.vehicles.get(topic[2], None):
-                    self.vehicles[topic[2]].syncLon = float(payload)
-                    self.vehicles[topic[2]].syncTimestamp = time.time()
+                if vehicle:
+                    self.updateState(vehicle, {"lon": float(payload)})
 
             elif topic[3] == "state":
-                if self.vehicles.get(topic[2], None):
-                    self.vehicles[topic[2]].syncState = payload
-                    self.vehicles[topic[2]].syncTimestamp = time.time()
+                if vehicle:
+                    self.updateState(vehicle, {"state": payload})
 
             elif topic[3] == "time_to_full_charge":
-                if self.vehicles.get(topic[2], None):
-                    self.vehicles[topic[2]].timeToFullCharge = int(float(payload))
-                    self.vehicles[topic[2]].lastChargeStatusTime = time.time()
-                    self.vehicles[topic[2]].syncTimestamp = time.time()
+                if vehicle:
+                    self.updateState(vehicle, {"timeToFullCharge": int(float(payload))})
 
             else:
                 pass
@@ -229,6 +226,21 @@ class TeslaMateVehicle:
     def mqttSubscribe(self, client, userdata, mid, reason_codes, properties=None):
         logger.info("Subscribe operation completed with mid " + str(mid))
 
+    def updateState(self, vehicle, values):
+        # Values from TeslaMate stay fresh for stateTTL seconds, or until the
+        # vehicle's sync check finds that TeslaMate has stopped sending
+        # anything, whichever comes first
+        if "lat" in values or "lon" in values:
+            # Latitude and longitude arrive separately, so wait until we have
+            # both before working out whether the vehicle is at home
+            lat = values.get("lat", vehicle.lat)
+            lon = values.get("lon", vehicle.lon)
+            if lat != 10000 and lon != 10000:
+                values["atHome"] = self.__master.getModuleByName(
+                    "TeslaAPI"
+                ).is_location_home(lat, lon)
+        vehicle.state.update(values, "TeslaMateVehicle", ttl=self.stateTTL)
+
     def updateVehicles(self, vehicle_id, vehicle_name):
         # Called by mqttMessage each time we get the display_name topic
         # We check to see if this aligns with a vehicle we know of from the API
@@ -0,0 +1,114 @@
+# Holds the last known state of a vehicle, such as its location, battery level
+# and whether it is awake, as reported by any of the modules which can find it
+# out (the Tesla API, TeslaMate or BLE).
+#
+# Each field is stored with the time it was written, the module which wrote it
+# and how long it stays fresh for. Modules which read the state use get(),
+# which never fetches anything, and use isFresh() to decide whether a field is
+# recent enough to use or needs to be fetched again.
+#
+# This module is shared by the Vehicle modules, and is not loaded as a module
+# of its own.
+
+import threading
+import time
+
+
+class VehicleState:
+    # Number of seconds each field stays fresh for once written, unless the
+    # module writing it says otherwise
+    defaultTTL = 300
+    ttl = {
+        "atHome": 300,
+        "batteryLevel": 300,
+        "chargeLimit": 300,
+        "lat": 300,
+        "lon": 300,
+        "name": 24 * 60 * 60,
+        "state": 60,
+        "timeToFullCharge": 300,
+    }
+
+    def __init__(self, **defaults):
+        # defaults are returned by get() for fields which haven't been written
+        self.defaults = defaults
+        self.fields = {}
+        self.lock = threading.Lock()
+
+    def expire(self, source):
+        # Mark every field written by source as no longer fresh, however old
+        # a value the caller will accept
+        with self.lock:
+            for field, entry in self.fields.items():
+                if entry["source"] == source:
+                    entry["expired"] = True
+
+    def get(self, field, default=None):
+        entry = self.fields.get(field, None)
+        if entry is None:
+            return self.defaults.get(field, default)
+        return entry["value"]
+
+    def getAge(self, field):
+        # Returns the number of seconds since field was written, or None if it
+        # never has been
+        entry = self.fields.get(field, None)
+        if entry is None:
+            return None
+        return time.time() - entry["time"]
+
+    def getFields(self):
+        # Returns the value, age and source of each field which has been
+        # written
+        now = time.time()
+        with self.lock:
+            return {
+                field: {
+                    "value": entry["value"],
+                    "age": round(now - entry["time"], 1),
+                    "source": entry["source"],
+                }
+                for field, entry in self.fields.items()
+            }
+
+    def getLastUpdate(self, source):
+        # Returns the last time any field was written by source, or 0
+        with self.lock:
+            return max(
+                (
+                    entry["time"]
+                    for entry in self.fields.values()
+                    if entry["source"] == source
+                ),
+                default=0,
+            )
+
+    def getSource(self, field):
+        entry = self.fields.get(field, None)
+        return entry["source"] if entry else None
+
+    def isFresh(self, field, maxAge=None):
+        # Returns True if field was written within its TTL, or within maxAge
+        # seconds if the caller will accept an older value
+        entry = self.fields.get(field, None)
+        if entry is None or entry["expired"]:
+            return False
+        limit = entry["ttl"] if maxAge is None else max(entry["ttl"], maxAge)
+        return time.time() - entry["time"] < limit
+
+    def set(self, field, value, source, ttl=None):
+        self.update({field: value}, source, ttl)
+
+    def update(self, values, source, ttl=None):
+        # Write several fields at once. ttl applies to all of them, and
+        # defaults to each field's own TTL.
+        now = time.time()
+        with self.lock:
+            for field, value in values.items():
+                self.fields[field] = {
+                    "expired": False,
+                    "source": source,
+                    "time": now,
+                    "ttl": self.ttl.get(field, self.defaultTTL) if ttl is None else ttl,
+                    "value": value,
+                }
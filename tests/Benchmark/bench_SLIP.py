@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Benchmark of TWC message framing.
+#
+# Encodes and decodes a stream of TWC messages, some of which contain bytes
+# which need to be escaped, using the byte by byte loops which each interface
+# module used to carry and the shared SLIP codec in TWCManager.Protocol.SLIP.
+# Every frame is checked to round-trip correctly, and the number of frames
+# per second for each implementation is reported.
+#
+# The number of frames defaults to one million, and can be passed as the
+# first argument, eg:
+#
+#   ./bench_SLIP.py 100000
+
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "lib")
+)
+
+from TWCManager.Protocol.SLIP import checksum, decode_frame, encode_frame
+
+frames = 1000000
+
+
+def legacy_encode(msg):
+    msg = bytearray(msg)
+    checksum = 0
+    for i in range(1, len(msg)):
+        checksum += msg[i]
+
+    msg.append(checksum & 0xFF)
+
+    i = 0
+    while i < len(msg):
+        if msg[i] == 0xC0:
+            msg[i : i + 1] = b"\xdb\xdc"
+            i = i + 1
+        elif msg[i] == 0xDB:
+            msg[i : i + 1] = b"\xdb\xdd"
+            i = i + 1
+        i = i + 1
+
+    return bytearray(b"\xc0" + msg + b"\xc0")
+
+
+def legacy_decode(inmsg):
+    msg = bytearray() + inmsg
+    i = 0
+    while i < len(msg):
+        if msg[i] == 0xDB:
+            if msg[i + 1] == 0xDC:
+                msg[i : i + 2] = [0xC0]
+            elif msg[i + 1] == 0xDD:
+                msg[i : i + 2] = [0xDB]
+            else:
+                msg[i : i + 2] = [0xDB]
+        i = i + 1
+
+    msg = msg[1 : len(msg) - 1]
+
+    checksum = 0
+    for i in range(1, len(msg) - 1):
+        checksum += msg[i]
+    if (checksum & 0xFF) != msg[-1]:
+        raise ValueError("Checksum mismatch")
+    return msg
+
+
+def codec_decode(frame):
+    msg = decode_frame(frame)
+    if checksum(msg[:-1]) != msg[-1]:
+        raise ValueError("Checksum mismatch")
+    return msg
+
+
+def messages():
+    # Slave heartbeats, one of which reports amps that need escaping, and
+    # a kWh report with a DB byte in it
+    msgs = [
+        b"\xfd\xe0\x41\x42\x77\x77\x01\x0c\x80\x0b\xb8\x00\x00\x00\x00",
+        b"\xfd\xe0\x41\x42\x77\x77\x01\x0c\xc0\x0b\xdb\x00\x00\x00\x00",
+        b"\xfd\xeb\x41\x42\x00\x00\x00\xdb\x00\xe6\x00\xf1\x00\xe8\x00",
+        b"\xfb\xe0\x77\x77\x41\x42\x05\x0c\x80\x00\x00\x00\x00\x00\x00",
+    ]
+    return msgs
+
+
+def run(name, encode, decode, msgs, count):
+    start = time.perf_counter()
+    done = 0
+    while done < count:
+        for msg in msgs:
+            if decode(encode(msg))[:-1] != msg:
+                print("%s failed to round-trip %s" % (name, msg.hex()))
+                sys.exit(1)
+        done += len(msgs)
+    elapsed = time.perf_counter() - start
+    print(
+        "%-14s %9d frames %7.2fs %10.0f frames/sec"
+        % (name, done, elapsed, done / elapsed)
+    )
+    return done / elapsed
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        frames = int(sys.argv[1])
+
+    msgs = messages()
+    before = run("Legacy loops", legacy_encode, legacy_decode, msgs, frames)
+    after = run("SLIP codec", encode_frame, codec_decode, msgs, frames)
+    print("Speedup: %.1fx" % (after / before))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+# Benchmark of TWC message parsing.
+#
+# Replays a stream of received (unescaped, checksum verified) TWC messages
+# through the chained regular expression search which TWCManager used to
+# identify messages, and through the type-keyed decoder table in TWCProtocol,
+# and reports how many messages per second each of them parses.
+#
+# By default a synthetic stream is used, which is made up mostly of slave
+# heartbeats with occasional linkready, kWh and VIN messages, as seen on a
+# network with three slave TWCs. A captured stream can be replayed instead by
+# passing the path of a file containing one message per line in hex, as
+# printed in the Rx@ debug log lines, eg:
+#
+#   ./bench_parseMessage.py rx_capture.txt
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "lib")
+)
+
+from TWCManager.Protocol.TWCProtocol import TWCProtocol
+
+# Number of times to replay the message stream
+iterations = 2000
+
+
+def checksum(msg):
+    return bytes([sum(msg[1:]) & 0xFF])
+
+
+def synthetic_stream():
+    slaves = [b"\x41\x42", b"\x43\x44", b"\x45\x46"]
+    master = b"\x77\x77"
+    stream = []
+    for slave in slaves:
+        msg = b"\xfd\xe2" + slave + b"\x77\x1f\x40" + b"\x00" * 8
+        stream.append(msg + checksum(msg))
+    for i in range(30):
+        for slave in slaves:
+            msg = b"\xfd\xe0" + slave + master + b"\x01\x0c\x80\x0b\xb8\x00\x00\x00\x00"
+            stream.append(msg + checksum(msg))
+    for slave in slaves:
+        msg = b"\xfd\xeb" + slave + b"\x00\x00\x00\x38\x00\xe6\x00\xf1\x00\xe8\x00"
+        stream.append(msg + checksum(msg))
+        for vinPart, vin in (
+            (b"\xee", b"5YJ3E1E"),
+            (b"\xef", b"A1JF000"),
+            (b"\xf1", b"123"),
+        ):
+            msg = b"\xfd" + vinPart + slave + vin.ljust(9, b"\x00")
+            stream.append(msg + checksum(msg))
+    return stream
+
+
+def captured_stream(path):
+    stream = []
+    with open(path) as capture:
+        for line in capture:
+            line = line.strip()
+            if line:
+                stream.append(bytes.fromhex(line))
+    return stream
+
+
+def parse_regex(msg):
+    # The master mode message search, as it was performed by TWCManager
+    # before the decoder table was introduced.
+    msgMatch = re.search(rb"^\xfd\xb1(..)\x00\x00.+\Z", msg, re.DOTALL)
+    if msgMatch:
+        return ("StartAck", msgMatch.group(1))
+    msgMatch = re.search(rb"^\xfd\xb2(..)\x00\x00.+\Z", msg, re.DOTALL)
+    if msgMatch:
+        return ("StopAck", msgMatch.group(1))
+    msgMatch = re.search(
+        rb"^\xfd\xe2(..)(.)(..)\x00\x00\x00\x00\x00\x00.+\Z", msg, re.DOTALL
+    )
+    if msgMatch:
+        maxAmps = ((msgMatch.group(3)[0] << 8) + msgMatch.group(3)[1]) / 100
+        return ("SlaveLinkready", msgMatch.group(1), msgMatch.group(2), maxAmps)
+    msgMatch = re.search(rb"\A\xfd\xe0(..)(..)(.......+?).\Z", msg, re.DOTALL)
+    if msgMatch:
+        return ("SlaveHeartbeat",) + msgMatch.groups()
+    msgMatch = re.search(rb"\A\xfd\xeb(..)(....)(..)(..)(..)(.+?).\Z", msg, re.DOTALL)
+    if msgMatch:
+        lifetimekWh = msgMatch.group(2)
+        kWh = (
+            (lifetimekWh[0] << 24)
+            + (lifetimekWh[1] << 16)
+            + (lifetimekWh[2] << 8)
+            + lifetimekWh[3]
+        )
+        volts = [(v[0] << 8) + v[1] for v in msgMatch.group(3, 4, 5)]
+        return ("SlaveKWh", msgMatch.group(1), kWh, volts)
+    msgMatch = re.search(rb"\A\xfd(\xee|\xef|\xf1)(..)(.+?).\Z", msg, re.DOTALL)
+    if msgMatch:
+        return ("SlaveVIN",) + msgMatch.groups()
+    msgMatch = re.search(
+        rb"\A\xfc(\xe1|\xe2)(..)(.)\x00\x00\x00\x00\x00\x00\x00\x00.+\Z",
+        msg,
+        re.DOTALL,
+    )
+    if msgMatch:
+        return ("MasterLinkready",) + msgMatch.groups()
+    return None
+
+
+def run(name, parse, stream):
+    count = 0
+    start = time.perf_counter()
+    for i in range(iterations):
+        for msg in stream:
+            parse(msg)
+        count += len(stream)
+    elapsed = time.perf_counter() - start
+    print("%-16s %10.0f msgs/sec" % (name, count / elapsed))
+    return count / elapsed
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        stream = captured_stream(sys.argv[1])
+    else:
+        stream = synthetic_stream()
+
+    protocol = TWCProtocol(None)
+
+    # Make sure that both parsers recognise the same messages before timing
+    for msg in stream:
+        if (parse_regex(msg) is None) != (protocol.parseMessage(msg) is None):
+            print("Parsers disagree on message: " + msg.hex())
+            sys.exit(1)
+
+    print("Parsing %d messages x %d iterations" % (len(stream), iterations))
+    before = run("Regex search", parse_regex, stream)
+    after = run("Decoder table", protocol.parseMessage, stream)
+    print("Speedup: %.1fx" % (after / before))
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Benchmark of charge policy evaluation.
+#
+# Evaluates the default charge policy, extended with a number of custom
+# restrictions on each policy entry, using the macro interpreter which the
+# Policy module used to run on every evaluation and the policy compiled into
+# functions by Policy.compilePolicies(). Each evaluation checks the policy
+# entries in order until one matches, as setChargingPerPolicy() does, and the
+# number of evaluations per second for each implementation is reported.
+#
+# The number of restrictions added to each policy entry defaults to 20, and
+# can be passed as the first argument, eg:
+#
+#   ./bench_policy.py 50
+
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "lib")
+)
+
+logging.INFO7 = 14
+logging.INFO8 = 13
+
+from TWCManager.Policy.Policy import Policy
+
+restrictions = 20
+iterations = 20000
+
+
+class FakeMaster:
+    def __init__(self, config):
+        self.config = config
+        self.modules = {}
+        self.settings = {
+            "chargeNowAmps": 0,
+            "chargeNowTimeEnd": 0,
+            "hourResumeTrackGreenEnergy": -1,
+            "nonScheduledAction": 1,
+            "nonScheduledAmpsMax": 16,
+            "scheduledAmpsMax": 0,
+            "sunrise": 6,
+            "sunset": 20,
+            "minAmps": 6,
+            "awayMode": 0,
+        }
+
+    def checkScheduledCharging(self):
+        return 0
+
+    def getMaxAmpsToDivideGreenEnergy(self):
+        return 12
+
+
+def legacy_value(policy, value):
+    ltNow = time.localtime()
+    if not isinstance(value, str):
+        return value
+    if value == "now":
+        return time.time()
+    if value == "hourOfDay":
+        return ltNow.tm_hour + ltNow.tm_min / 60
+    if value.startswith("tm_") and hasattr(ltNow, value):
+        return getattr(ltNow, value)
+    if value == "getMaxAmpsToDivideGreenEnergy()":
+        return policy.master.getMaxAmpsToDivideGreenEnergy()
+    elif value == "checkScheduledCharging()":
+        return policy.master.checkScheduledCharging()
+    if value.find(".") != -1:
+        pieces = value.split(".")
+        if pieces[0] == "settings":
+            return policy.master.settings.get(pieces[1], 0)
+        elif pieces[0] == "config":
+            return policy.config["config"].get(pieces[1], 0)
+        elif pieces[0] == "modules":
+            if pieces[1] in policy.master.modules:
+                module = policy.master.getModuleByName(pieces[1])
+                return getattr(module, pieces[2], value)
+    return value
+
+
+def legacy_condition(policy, match, condition, value, exitOn):
+    matchValue = legacy_value(policy, match)
+    value = legacy_value(policy, value)
+    logging.getLogger("Policy").log(
+        logging.INFO8,
+        f"Evaluating Policy match (%s [{matchValue}]), condition (%s), value (%s)",
+        match,
+        condition,
+        value,
+    )
+    if all([isinstance(a, list) for a in (matchValue, condition, value)]):
+        return legacy_conditions(policy, matchValue, condition, value, not exitOn)
+    if condition == "gt":
+        return True if matchValue > value else False
+    elif condition == "gte":
+        return True if matchValue >= value else False
+    elif condition == "lt":
+        return True if matchValue < value else False
+    elif condition == "lte":
+        return True if matchValue <= value else False
+    elif condition == "eq":
+        return True if matchValue == value else False
+    elif condition == "ne":
+        return True if matchValue != value else False
+    elif condition == "false":
+        return False
+    elif condition == "none":
+        return True
+    raise ValueError("Unknown condition " + condition)
+
+
+def legacy_conditions(policy, matches, conditions, values, exitOn=False):
+    for match, condition, value in zip(matches, conditions, values):
+        if legacy_condition(policy, match, condition, value, exitOn) == exitOn:
+            return exitOn
+    return not exitOn
+
+
+def legacy_evaluate(policy):
+    for entry in policy.charge_policy:
+        if legacy_conditions(
+            policy, entry["match"], entry["condition"], entry["value"]
+        ):
+            return entry["name"]
+    return None
+
+
+def compiled_evaluate(policy):
+    for entry, compiled in policy.compiled_policy:
+        if compiled["conditions"]():
+            return entry["name"]
+    return None
+
+
+def make_policy(count):
+    # Restrictions which all pass, so that every condition is evaluated
+    # before the policy entry is rejected by its own conditions
+    restriction = {
+        "match": [],
+        "condition": [],
+        "value": [],
+    }
+    macros = [
+        ("settings.minAmps", "gte", 6),
+        ("config.wiringMaxAmpsAllTWCs", "gt", 0),
+        ("tm_hour", "lt", 24),
+        ("settings.awayMode", "ne", 1),
+        ("checkScheduledCharging()", "eq", 0),
+        (["settings.awayMode", "tm_min"], ["eq", "gte"], [0, 0]),
+    ]
+    for i in range(count):
+        match, condition, value = macros[i % len(macros)]
+        restriction["match"].append(match)
+        restriction["condition"].append(condition)
+        restriction["value"].append(value)
+
+    config = {
+        "config": {"wiringMaxAmpsAllTWCs": 32},
+        "policy": {
+            "extend": {
+                "restrictions": {
+                    name: restriction
+                    for name in (
+                        "Charge Now",
+                        "Scheduled Charging",
+                        "Track Green Energy",
+                        "Non Scheduled Charging",
+                    )
+                }
+            }
+        },
+    }
+    return Policy(FakeMaster(config))
+
+
+def run(name, evaluate, policy, count):
+    start = time.perf_counter()
+    result = None
+    for i in range(count):
+        result = evaluate(policy)
+    elapsed = time.perf_counter() - start
+    print(
+        "%-12s %7d evaluations %7.2fs %10.0f evaluations/sec (%s)"
+        % (name, count, elapsed, count / elapsed, result)
+    )
+    return count / elapsed
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        restrictions = int(sys.argv[1])
+
+    policy = make_policy(restrictions)
+    if legacy_evaluate(policy) != compiled_evaluate(policy):
+        print("Compiled policy chose a different policy entry")
+        sys.exit(1)
+
+    print(
+        "%d policy entries, %d conditions"
+        % (
+            len(policy.charge_policy),
+            sum(len(entry["match"]) for entry in policy.charge_policy),
+        )
+    )
+    before = run("Interpreted", legacy_evaluate, policy, iterations)
+    after = run("Compiled", compiled_evaluate, policy, iterations)
+    print("Speedup: %.1fx" % (after / before))